@@ -0,0 +1,580 @@
+# Benchmarks for warcraftlogs_get_data.py that run without the real API.
+# A local server stands in for the warcraftlogs API. It answers with recorded responses (from the response cache or a
+# JSONL file) or with synthetic reports, and can be made slow or strict about the rate limit. The scenarios measure
+# the fetch, transform and write throughput and the time for a player or report lookup, so a change can be compared
+# against a saved baseline on a laptop.
+#
+# Run all the scenarios and save the results:
+#     python warcraftlogs_benchmark.py --output benchmark.json
+# Compare against the saved results (exits with 1 if a scenario got more than 25% slower):
+#     python warcraftlogs_benchmark.py --compare benchmark.json
+
+import re
+import json
+import time
+import random
+import shutil
+import sqlite3
+import zlib
+import argparse
+import tempfile
+import threading
+import statistics
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+import warcraftlogs_get_data as wlog
+
+# Size of the synthetic reports.
+SYNTHETIC_FIGHTS = 50
+SYNTHETIC_ACTORS = 40
+PLAYERS_PER_FIGHT = 5
+
+# Default behaviour of the mock server.
+MOCK_LATENCY_MS = 0
+MOCK_JITTER_MS = 0
+MOCK_LIMIT_PER_HOUR = 1_000_000
+MOCK_RESET_SECONDS = 3600
+
+# Number of timed rounds per scenario, and how much slower a scenario may get before --compare fails.
+BENCHMARK_ROUNDS = 5
+MAX_REGRESSION = 0.25
+
+DUNGEONS = ['Ara-Kara, City of Echoes', 'The Dawnbreaker', 'Operation: Floodgate', 'Priory of the Sacred Flame',
+            'Eco-Dome Al\'dani', 'Halls of Atonement', 'Tazavesh, the Veiled Market', 'The Stonevault']
+CLASSES = ['Warrior', 'Paladin', 'Hunter', 'Rogue', 'Priest', 'DeathKnight', 'Shaman', 'Mage', 'Warlock', 'Monk',
+           'Druid', 'DemonHunter', 'Evoker']
+
+# Functions for making synthetic reports.
+# The reports are made from a seed based on the report code, so the same code always gives the same report.
+
+def make_synthetic_report(code: str, fights: int = SYNTHETIC_FIGHTS, actors: int = SYNTHETIC_ACTORS) -> dict:
+    """
+    Makes the metadata for a synthetic report, in the same form as get_report_metadata() returns.
+
+    Args:
+        code (str): The report code, used as seed.
+        fights (int): Number of dungeon-runs in the report.
+        actors (int): Number of characters in the report.
+
+    Returns:
+        report (dict): title, startTime, endTime, masterData and fights.
+    """
+    rng = random.Random(code)
+    report_start = 1_758_000_000_000 + rng.randrange(0, 7 * 24 * 3600) * 1000
+    actor_list = [{'name': f'Player{i}', 'gameID': 100_000 + rng.randrange(1_000_000), 'id': i} for i in range(1, actors + 1)]
+
+    fight_list = []
+    fight_start = 0
+    for fight_id in range(1, fights + 1):
+        duration = rng.randrange(20 * 60, 40 * 60) * 1000
+        zone = rng.randrange(len(DUNGEONS))
+        fight_list.append({'id': fight_id, 'startTime': fight_start, 'endTime': fight_start + duration,
+                           'friendlyPlayers': rng.sample(range(1, actors + 1), min(PLAYERS_PER_FIGHT, actors)),
+                           'gameZone': {'id': 10_000 + zone, 'name': DUNGEONS[zone]},
+                           'difficulty': 10, 'keystoneLevel': rng.randrange(2, 20)})
+        fight_start += duration + rng.randrange(60, 600) * 1000
+
+    return {'title': f'Synthetic report {code}', 'startTime': report_start, 'endTime': report_start + fight_start,
+            'masterData': {'actors': actor_list}, 'fights': fight_list}
+
+def make_synthetic_entries(report: dict, fight_id: int, table_name: str) -> list:
+    """
+    Makes the entries of a table for a fight in a synthetic report.
+
+    Args:
+        report (dict): The report from make_synthetic_report().
+        fight_id (int): The fight.
+        table_name (str): 'damage', 'healing' or 'deaths'.
+
+    Returns:
+        entries (list): The entries, in the same form as the API returns them.
+    """
+    rng = random.Random(f"{report['title']}-{fight_id}-{table_name}")
+    fight = report['fights'][fight_id - 1]
+    actors = {actor['id']: actor for actor in report['masterData']['actors']}
+    entries = []
+    for actor_id in fight['friendlyPlayers']:
+        actor = actors[actor_id]
+        entry = {'name': actor['name'], 'id': actor_id, 'guid': actor['gameID'], 'type': CLASSES[actor_id % len(CLASSES)],
+                 'icon': CLASSES[actor_id % len(CLASSES)]}
+        if table_name == 'deaths':
+            for _ in range(rng.choice([0, 0, 0, 1, 2])):
+                entries.append(dict(entry, deathTime=rng.randrange(fight['endTime'] - fight['startTime'])))
+            continue
+        entries.append(dict(entry, itemLevel=round(rng.uniform(680, 700), 1), total=rng.randrange(10_000_000, 9_000_000_000)))
+    return entries
+
+def make_synthetic_fight_tables(report: dict) -> dict:
+    """
+    Makes the fight tables for every fight in a synthetic report, in the same form as get_fight_tables() returns.
+
+    Args:
+        report (dict): The report from make_synthetic_report().
+
+    Returns:
+        fight_tables (dict): fight ID as key and a dict with the entries for damage, healing and deaths as value.
+    """
+    return {fight['id']: {alias: make_synthetic_entries(report, fight['id'], alias) for alias in wlog.FIGHT_TABLES}
+            for fight in report['fights']}
+
+# The mock API server.
+
+class ReplayStore:
+    """
+    Recorded responses, found by the same query hash as the ResponseCache uses.
+    The report codes in the recordings are saved in codes, so the fetch scenario can ask for them.
+
+    Args:
+        cache_path (str): A response cache (response_cache.sqlite) to replay, or None.
+        jsonl_path (str): A JSONL file with one {"report_code": ..., "query": ..., "response": ...} per line, or None.
+    """
+
+    def __init__(self, cache_path: str = None, jsonl_path: str = None):
+        self.responses = {}
+        self.codes = []
+        if cache_path:
+            connection = sqlite3.connect(cache_path)
+            for report_code, query_hash, data in connection.execute("SELECT report_code, query_hash, data FROM responses"):
+                self.responses[query_hash] = json.loads(zlib.decompress(data))
+                if report_code not in self.codes:
+                    self.codes.append(report_code)
+            connection.close()
+        if jsonl_path:
+            with open(jsonl_path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.responses[wlog.ResponseCache.query_hash(record['query'])] = record['response']
+                        if record.get('report_code') and record['report_code'] not in self.codes:
+                            self.codes.append(record['report_code'])
+
+    def get(self, query: str) -> dict:
+        """
+        Gets the recorded response for a query.
+
+        Args:
+            query (str): The query that was sent, with or without the rateLimitData fields.
+
+        Returns:
+            response (dict or None): The recorded response, None if the query wasn't recorded.
+        """
+        query = query.replace(wlog.RATE_LIMIT_FIELDS, '')
+        return self.responses.get(wlog.ResponseCache.query_hash(query))
+
+class MockWarcraftLogsServer:
+    """
+    Local HTTP server that answers GraphQL queries like the warcraftlogs API.
+
+    Recorded responses are used when there is one for the query, otherwise a synthetic report is made from the
+    report code. Every query costs points (1 + one per fight table), and when the budget is used up the server answers
+    429 with a Retry-After header until it's reset. Use as 'with MockWarcraftLogsServer() as server:'.
+
+    Args:
+        latency_ms (float): Time before every answer.
+        jitter_ms (float): Random extra time (0 to jitter_ms) before every answer.
+        limit_per_hour (int): Rate limit points per reset.
+        reset_seconds (float): Seconds between the resets of the points.
+        error_rate (float): Part of the queries that get a 503 answer.
+        replay (ReplayStore): Recorded responses, or None.
+        fights (int): Number of fights in the synthetic reports.
+        actors (int): Number of characters in the synthetic reports.
+        report_codes (list): The report codes returned by the reports-query.
+    """
+
+    def __init__(self, latency_ms: float = MOCK_LATENCY_MS, jitter_ms: float = MOCK_JITTER_MS, limit_per_hour: int = MOCK_LIMIT_PER_HOUR,
+                 reset_seconds: float = MOCK_RESET_SECONDS, error_rate: float = 0.0, replay: ReplayStore = None,
+                 fights: int = SYNTHETIC_FIGHTS, actors: int = SYNTHETIC_ACTORS, report_codes: list = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.limit_per_hour = limit_per_hour
+        self.reset_seconds = reset_seconds
+        self.error_rate = error_rate
+        self.replay = replay
+        self.fights = fights
+        self.actors = actors
+        self.report_codes = report_codes or [f'SYN{i:04d}' for i in range(1, 11)]
+
+        self.lock = threading.Lock()
+        self.points_spent = 0.0
+        self.reset_at = time.monotonic() + reset_seconds
+        self.requests = 0
+        self.rate_limited = 0
+        self.reports = {}
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        """
+        The URL to use as api_url for WarcraftLogsClient.
+        """
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/api/v2/client"
+
+    def start(self):
+        """
+        Starts the server on a free port in a background thread.
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, headers, payload = server.handle(json.loads(body or b'{}').get('query', ''))
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def report(self, code: str) -> dict:
+        """
+        Gets the synthetic report for a code, it's only made once.
+
+        Args:
+            code (str): The report code.
+
+        Returns:
+            report (dict): The report from make_synthetic_report().
+        """
+        with self.lock:
+            if code not in self.reports:
+                self.reports[code] = make_synthetic_report(code, self.fights, self.actors)
+            return self.reports[code]
+
+    def answer(self, query: str) -> dict:
+        """
+        Makes the data for a query, from the recorded responses or a synthetic report.
+
+        Args:
+            query (str): The GraphQL query.
+
+        Returns:
+            response (dict): The JSON response without rateLimitData.
+        """
+        if self.replay is not None:
+            recorded = self.replay.get(query)
+            if recorded is not None:
+                return json.loads(json.dumps(recorded))
+
+        data = {}
+        if 'reports(' in query:
+            page = int(re.search(r'page:\s*(\d+)', query).group(1)) if 'page:' in query else 1
+            per_page = int(re.search(r'limit:\s*(\d+)', query).group(1)) if 'limit:' in query else 100
+            codes = self.report_codes[(page - 1) * per_page:page * per_page]
+            reports = []
+            for code in codes:
+                report = self.report(code)
+                reports.append({'code': code, 'title': report['title'], 'startTime': report['startTime'], 'endTime': report['endTime']})
+            data['reportData'] = {'reports': {'data': reports, 'has_more_pages': page * per_page < len(self.report_codes)}}
+        elif 'report(' in query:
+            report = self.report(re.search(r'code:\s*"(\w+)"', query).group(1))
+            result = {}
+            if 'masterData' in query or 'fights' in query:
+                result.update(report)
+            for alias, fight_id in re.findall(r'\b(damage|healing|deaths)_(\d+)\s*:', query):
+                result[f'{alias}_{fight_id}'] = {'data': {'entries': make_synthetic_entries(report, int(fight_id), alias)}}
+            data['reportData'] = {'report': result}
+        return {'data': data}
+
+    def handle(self, query: str) -> tuple:
+        """
+        Answers a query: waits for the latency, checks the rate limit and makes the response.
+
+        Args:
+            query (str): The GraphQL query.
+
+        Returns:
+            status (int): The HTTP status.
+            headers (dict): Extra headers.
+            payload (dict): The JSON response.
+        """
+        time.sleep((self.latency_ms + random.uniform(0, self.jitter_ms)) / 1000)
+        cost = 1 + len(re.findall(r'\b(?:damage|healing|deaths)_\d+\s*:', query))
+
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            if now >= self.reset_at:
+                self.points_spent = 0.0
+                self.reset_at = now + self.reset_seconds
+            if self.points_spent + cost > self.limit_per_hour:
+                self.rate_limited += 1
+                return 429, {'Retry-After': str(max(1, round(self.reset_at - now)))}, {'error': 'Too many requests'}
+            if self.error_rate and random.random() < self.error_rate:
+                return 503, {}, {'error': 'Service unavailable'}
+            self.points_spent += cost
+            rate_limit_data = {'limitPerHour': self.limit_per_hour, 'pointsSpentThisHour': self.points_spent,
+                               'pointsResetIn': round(self.reset_at - now)}
+
+        payload = self.answer(query)
+        if 'rateLimitData' in query:
+            payload['data']['rateLimitData'] = rate_limit_data
+        return 200, {}, payload
+
+# Functions for running the benchmarks.
+
+class Benchmark:
+    """
+    Times a function, works like the benchmark fixture in pytest-benchmark: benchmark(function, *args).
+
+    Args:
+        name (str): Name of the scenario.
+        rounds (int): Number of timed rounds.
+        warmup_rounds (int): Number of rounds before the timing starts.
+    """
+
+    def __init__(self, name: str, rounds: int = BENCHMARK_ROUNDS, warmup_rounds: int = 1):
+        self.name = name
+        self.rounds = rounds
+        self.warmup_rounds = warmup_rounds
+        self.timings = []
+        self.extra_info = {}
+
+    def __call__(self, function, *args, **kwargs):
+        for _ in range(self.warmup_rounds):
+            function(*args, **kwargs)
+        result = None
+        for _ in range(self.rounds):
+            started = time.perf_counter()
+            result = function(*args, **kwargs)
+            self.timings.append(time.perf_counter() - started)
+        return result
+
+    def pedantic(self, function, setup=None, rounds: int = None):
+        """
+        Times a function with a setup that is run (without timing) before every round.
+
+        Args:
+            function (callable): The function to time, gets the arguments from setup.
+            setup (callable): Returns (args, kwargs) for the function, or None.
+            rounds (int): Number of rounds, self.rounds if None.
+
+        Returns:
+            result: What the function returned in the last round.
+        """
+        result = None
+        for _ in range(rounds or self.rounds):
+            args, kwargs = setup() if setup is not None else ((), {})
+            started = time.perf_counter()
+            result = function(*args, **kwargs)
+            self.timings.append(time.perf_counter() - started)
+        return result
+
+    def stats(self) -> dict:
+        """
+        Gets the statistics for the timings.
+
+        Returns:
+            stats (dict): min, max, mean, median and stddev in seconds, number of rounds and extra_info.
+        """
+        return {'min': min(self.timings), 'max': max(self.timings), 'mean': statistics.mean(self.timings),
+                'median': statistics.median(self.timings),
+                'stddev': statistics.stdev(self.timings) if len(self.timings) > 1 else 0.0,
+                'rounds': len(self.timings), 'extra_info': dict(self.extra_info)}
+
+def bench_fetch(benchmark: Benchmark, options: argparse.Namespace):
+    """
+    Fetches reports from the mock server with several threads, like main() does.
+    The recorded reports are used if there are recordings, otherwise synthetic reports.
+    """
+    replay = ReplayStore(options.replay_cache, options.replay_file) if options.replay_cache or options.replay_file else None
+    codes = replay.codes if replay is not None and replay.codes else [f'SYN{i:04d}' for i in range(1, options.reports + 1)]
+    with MockWarcraftLogsServer(options.latency_ms, options.jitter_ms, options.limit_per_hour, options.reset_seconds, options.error_rate,
+                                replay=replay, fights=options.fights, actors=options.actors, report_codes=codes) as server:
+        client = wlog.WarcraftLogsClient(token='benchmark', pool_size=options.max_workers, api_url=server.url)
+
+        def fetch_all():
+            with ThreadPoolExecutor(max_workers=options.max_workers) as executor:
+                return list(executor.map(lambda code: wlog.fetch_report(client, code), codes))
+
+        results = benchmark(fetch_all)
+        client.close()
+
+    rounds = benchmark.rounds + benchmark.warmup_rounds
+    benchmark.extra_info.update(reports=len(codes),
+                                requests_per_round=server.requests / rounds, rate_limited=server.rate_limited,
+                                reports_per_second=len(codes) / statistics.median(benchmark.timings),
+                                fights_fetched=sum(len(fight_tables) for _, fight_tables in results))
+
+def bench_transform(benchmark: Benchmark, options: argparse.Namespace):
+    """
+    Transforms one big synthetic report to the rows for the dataset.
+    """
+    report = make_synthetic_report('TRANSFORM', options.fights, options.actors)
+    fight_tables = make_synthetic_fight_tables(report)
+    df = benchmark(wlog.transform_report, 'TRANSFORM', report, fight_tables)
+    benchmark.extra_info.update(fights=options.fights, rows=len(df), rows_per_second=len(df) / statistics.median(benchmark.timings))
+
+def bench_write(benchmark: Benchmark, options: argparse.Namespace):
+    """
+    Converts synthetic reports to Arrow and writes them to a new partitioned parquet dataset.
+    """
+    frames = []
+    for i in range(options.reports):
+        report = make_synthetic_report(f'WRITE{i:04d}', options.fights, options.actors)
+        frames.append(wlog.transform_report(f'WRITE{i:04d}', report, make_synthetic_fight_tables(report)))
+    rows = sum(len(frame) for frame in frames)
+    folder = tempfile.mkdtemp(prefix='wlog_benchmark_')
+
+    def setup():
+        shutil.rmtree(folder, ignore_errors=True)
+        return (), {}
+
+    def write_all():
+        dimensions = wlog.DimensionStore(':memory:')
+        writer = wlog.DatasetWriter(folder, dimensions=dimensions)
+        for frame in frames:
+            writer.write_table(wlog.weekly_data_to_table(frame))
+        file_paths = writer.close()
+        dimensions.close()
+        return file_paths
+
+    try:
+        files = benchmark.pedantic(write_all, setup=setup)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    benchmark.extra_info.update(rows=rows, files=len(files), rows_per_second=rows / statistics.median(benchmark.timings))
+
+def bench_lookup(benchmark: Benchmark, options: argparse.Namespace):
+    """
+    Writes a dataset with synthetic reports, then looks up all the runs for one player and everything in one report.
+    The players get the report code in their name, so every player is only in one report.
+    """
+    folder = tempfile.mkdtemp(prefix='wlog_benchmark_')
+    dimensions = wlog.DimensionStore(':memory:')
+    codes = [f'LOOKUP{i:04d}' for i in range(options.reports)]
+    writer = wlog.DatasetWriter(folder, dimensions=dimensions)
+    for code in codes:
+        report = make_synthetic_report(code, options.fights, options.actors)
+        frame = wlog.transform_report(code, report, make_synthetic_fight_tables(report))
+        frame['name'] = code + '-' + frame['name'].astype(str)
+        writer.write_table(wlog.weekly_data_to_table(frame))
+    writer.close()
+    rng = random.Random(0)
+
+    def setup():
+        code = rng.choice(codes)
+        return (code, f'{code}-Player1'), {}
+
+    def look_up(code, player):
+        runs = wlog.query_dataset(path=folder, dimensions=dimensions, players=[player], output='arrow')
+        report = wlog.query_dataset(path=folder, dimensions=dimensions, report_codes=[code], output='arrow')
+        return runs.num_rows + report.num_rows
+
+    try:
+        rows = benchmark.pedantic(look_up, setup=setup)
+    finally:
+        dimensions.close()
+        shutil.rmtree(folder, ignore_errors=True)
+    benchmark.extra_info.update(reports=len(codes), rows_found=rows)
+
+SCENARIOS = {'fetch': bench_fetch, 'transform': bench_transform, 'write': bench_write, 'lookup': bench_lookup}
+
+def compare_results(results: dict, baseline: dict, max_regression: float = MAX_REGRESSION) -> list:
+    """
+    Compares the median times with a saved baseline.
+
+    Args:
+        results (dict): scenario as key and the stats from Benchmark.stats() as value.
+        baseline (dict): The results from an earlier run.
+        max_regression (float): How much slower a scenario may get (0.25 = 25%).
+
+    Returns:
+        regressions (list): A message for every scenario that got too slow.
+    """
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['median']
+        change = stats['median'] / before - 1 if before > 0 else 0.0
+        print(f"{name:>10}: {before * 1000:10.2f} ms -> {stats['median'] * 1000:10.2f} ms ({change:+.1%})")
+        if change > max_regression:
+            regressions.append(f"{name} got {change:.1%} slower ({before * 1000:.2f} ms -> {stats['median'] * 1000:.2f} ms)")
+    return regressions
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """
+    Reads the command line arguments.
+
+    Args:
+        argv (list): The arguments, uses sys.argv if None.
+
+    Returns:
+        args (argparse.Namespace): The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks for warcraftlogs_get_data.py with a local mock API.")
+    parser.add_argument('--scenarios', nargs='*', default=list(SCENARIOS), choices=list(SCENARIOS),
+                        help="The scenarios to run (default all).")
+    parser.add_argument('--rounds', type=int, default=BENCHMARK_ROUNDS, help=f"Timed rounds per scenario (default {BENCHMARK_ROUNDS}).")
+    parser.add_argument('--reports', type=int, default=10, help="Number of reports for fetch and write (default 10).")
+    parser.add_argument('--fights', type=int, default=SYNTHETIC_FIGHTS, help=f"Fights per synthetic report (default {SYNTHETIC_FIGHTS}).")
+    parser.add_argument('--actors', type=int, default=SYNTHETIC_ACTORS, help=f"Characters per synthetic report (default {SYNTHETIC_ACTORS}).")
+    parser.add_argument('--max-workers', type=int, default=wlog.MAX_WORKERS, help=f"Threads for fetch (default {wlog.MAX_WORKERS}).")
+    parser.add_argument('--latency-ms', type=float, default=MOCK_LATENCY_MS, help="Latency of the mock API.")
+    parser.add_argument('--jitter-ms', type=float, default=MOCK_JITTER_MS, help="Random extra latency of the mock API.")
+    parser.add_argument('--limit-per-hour', type=int, default=MOCK_LIMIT_PER_HOUR, help="Rate limit points of the mock API.")
+    parser.add_argument('--reset-seconds', type=float, default=MOCK_RESET_SECONDS, help="Seconds between the resets of the mock rate limit.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Part of the queries that get a 503 answer.")
+    parser.add_argument('--replay-cache', help="A response_cache.sqlite with recorded responses to replay.")
+    parser.add_argument('--replay-file', help="A JSONL file with recorded {\"report_code\", \"query\", \"response\"} lines to replay.")
+    parser.add_argument('--output', help="Save the results as JSON.")
+    parser.add_argument('--compare', help="Compare with results saved by --output, exits with 1 if a scenario got too slow.")
+    parser.add_argument('--max-regression', type=float, default=MAX_REGRESSION,
+                        help=f"How much slower a scenario may get with --compare (default {MAX_REGRESSION}).")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    results = {}
+    for name in args.scenarios:
+        benchmark = Benchmark(name, rounds=args.rounds)
+        SCENARIOS[name](benchmark, args)
+        results[name] = benchmark.stats()
+        extra = ', '.join(f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}"
+                          for key, value in results[name]['extra_info'].items())
+        print(f"{name:>10}: median {results[name]['median'] * 1000:10.2f} ms, min {results[name]['min'] * 1000:10.2f} ms ({extra})")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created_at': datetime.now().astimezone().isoformat(), 'results': results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare_results(results, baseline, args.max_regression)
+        for message in regressions:
+            print(f"Regression: {message}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
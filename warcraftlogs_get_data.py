@@ -6,19 +6,109 @@ import requests
 import datetime
 from datetime import datetime
 import traceback
+import argparse
+import contextlib
+import collections
+import random
+import threading
+import time
+import sqlite3
+import zlib
+import hashlib
+import re
+import shutil
+import uuid
+import sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 import pyarrow as pa
 import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import pyarrow.compute as pc
 
 import numpy as np
 import pandas as pd
 
 from dotenv import load_dotenv, set_key
 
+# Only used to measure the peak memory, not available on Windows.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from warcraftlogs_schema import (DATASET_SCHEMA, FACT_SCHEMA, DIMENSION_COLUMNS, EVENT_SCHEMA, KEY_INDEX_SCHEMA,
+                                 KEY_INDEX_FILES_KEY, conform_table, read_dataset, read_dataset_file, open_dataset)
+
 # Set directories
-CACHE_FILE ='processed_codes.json'
+CACHE_FILE ='processed_codes.json'  # Only read once, when the codes are imported to STATE_DB
 RAW_DATA_DIR = 'weekly_raw_data'
 PROCESSED_DATA_DIR = 'all_reports_parquet_dataset'
+RESPONSE_CACHE_FILE = 'response_cache.sqlite'
+STATE_DB = 'pipeline_state.sqlite'
+
+# Max size of the response cache, the least recently used responses are removed when it gets bigger.
+RESPONSE_CACHE_MAX_MB = 2048
+
+# Max number of reports that are processed at the same time.
+MAX_WORKERS = 4
+
+# The users, guilds and zones to look for new reports from, and how many days back.
+DISCOVERY_CONFIG_FILE = 'discovery_config.json'
+DEFAULT_DISCOVERY_CONFIG = {'user_ids': [297125, 291792], 'guild_ids': [], 'zone_ids': [], 'days': 7}
+
+# Reports per page in the reports-query (max 100), and the max number of pages for every user or guild in the normal run.
+# A backfill fetches all the pages.
+REPORTS_PER_PAGE = 100
+MAX_REPORT_PAGES = 50
+
+# How the dataset is split into folders. The keys can be 'fightWeek' (ISO week of the fight, example: 2025-W38),
+# 'fightMonth' (example: 2025-09), 'dungeon' (name of the dungeon) or 'runDate' (the day the data was added).
+PARTITION_SCHEME = ('fightWeek',)
+PARTITION_KEYS = ('fightWeek', 'fightMonth', 'dungeon', 'runDate')
+
+# Backfill: number of reports fetched before they are appended to the dataset, and the part of the API budget it may use.
+BACKFILL_FLUSH_REPORTS = 25
+BACKFILL_BUDGET_SHARE = 0.8
+
+# Number of rows in each row group when the dataset is compacted.
+COMPACT_ROW_GROUP_ROWS = 128 * 1024
+
+# When new data is appended: number of rows in each row group, max rows in a file (a new file is started after that),
+# and the max number of row groups that are kept in memory at the same time (over all the partitions).
+INGEST_ROW_GROUP_ROWS = 64 * 1024
+INGEST_MAX_FILE_ROWS = 1024 * 1024
+INGEST_MAX_BUFFERED_ROW_GROUPS = 4
+
+# The dimension tables (players, dungeons and reports) are also saved as parquet files here.
+DIMENSIONS_DIR = 'dimensions'
+
+# The rows in every row group are sorted by player and start time. The player and report keys also get a bloom filter
+# in every row group (with this false positive rate), and an index with the row groups for every key is saved in
+# KEY_INDEX_DIR in the dataset folder (folders starting with '_' are not read as data).
+SORT_BY = ('playerKey', 'StartTime')
+KEY_INDEX_COLUMNS = ('playerKey', 'reportKey')
+KEY_INDEX_DIR = '_key_index'
+KEY_INDEX_ROW_GROUP_ROWS = 8 * 1024
+BLOOM_FILTER_FPP = 0.05
+
+# Summary tables for every player, dungeon and week, updated after every run.
+# They are grouped on the player and dungeon keys, the names are joined back when they are read.
+AGGREGATES_DIR = 'aggregates'
+AGGREGATE_KEYS = ('playerKey', 'dungeonKey', 'fightWeek')
+AGGREGATE_METRICS = ('Dps', 'Healing', 'DamagePerSecond', 'HealingPerSecond', 'deaths', 'ilvl')
+AGGREGATE_COLUMNS = ('playerKey', 'dungeonKey', 'StartTime') + AGGREGATE_METRICS
+
+# The quantiles in the summary tables are at most this much wrong (0.01 = 1%).
+SKETCH_RELATIVE_ERROR = 0.01
+
+# Event timelines: the dataset for the events, the types of events that are fetched and the events per API-call (max 10000).
+TIMELINE_DATA_DIR = 'fight_timelines_parquet_dataset'
+EVENT_DATA_TYPES = ('DamageDone', 'Healing', 'Deaths', 'Casts')
+EVENTS_PER_PAGE = 10000
+
+# The summary of every run (timings and API-calls) is saved here.
+RUN_SUMMARY_FILE = 'run_summary.json'
 
 # Setting up the API
 authURL = "https://www.warcraftlogs.com/oauth/authorize"
@@ -32,6 +122,257 @@ logging.basicConfig(level=logging.INFO,
 
 logger = logging.getLogger(__name__)
 
+# Functions for measuring where a run spends its time.
+# The time for every stage (discovery, fetching, transforming, writing) and the API-calls for every type of query
+# (number of calls, latency, bytes and points) are counted during the run, and saved in a summary at the end.
+# The summary is saved as JSON (RUN_SUMMARY_FILE) and can also be saved in the Prometheus textfile format.
+
+def query_type_of(query: str) -> str:
+    """
+    Finds what type of query a query-string is, used for counting the API-calls.
+
+    Args:
+        query (str): The GraphQL query string.
+
+    Returns:
+        query_type (str): 'fight_tables', 'report_metadata', 'report_codes', 'events', 'table', 'fights', 'rate_limit' or 'other'.
+    """
+    if re.search(r'\b(damage|healing|deaths)_\d+\s*:', query):
+        return 'fight_tables'
+    if 'masterData' in query and 'fights' in query:
+        return 'report_metadata'
+    if 'reports(' in query:
+        return 'report_codes'
+    if 'events(' in query:
+        return 'events'
+    if 'table(' in query:
+        return 'table'
+    if 'fights' in query or 'masterData' in query or 'startTime' in query:
+        return 'fights'
+    if 'rateLimitData' in query:
+        return 'rate_limit'
+    return 'other'
+
+class RunMetrics:
+    """
+    Collects timings and counters during a run. Safe to use from several threads at once.
+
+    The time for a stage is summed up over all the threads, so stages that run in several threads
+    (example: transform) can have more seconds than the whole run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, command: str = None):
+        """
+        Removes everything that was measured and starts a new run.
+
+        Args:
+            command (str): The command that is run (example: 'run' or 'backfill').
+        """
+        with self.lock:
+            self.command = command
+            self.started_at = datetime.now().astimezone()
+            self.started = time.perf_counter()
+            self.stages = {}
+            self.queries = {}
+            self.counters = {}
+            self.gauges = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Measures the time for a stage, use as 'with metrics.stage("transform"):'.
+
+        Args:
+            name (str): Name of the stage.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name: str, seconds: float):
+        """
+        Adds time to a stage.
+
+        Args:
+            name (str): Name of the stage.
+            seconds (float): The time.
+        """
+        with self.lock:
+            stage = self.stages.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stage['count'] += 1
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+
+    def record_query(self, query_type: str, seconds: float = 0.0, response_bytes: int = 0, points: float = 0.0,
+                     retries: int = 0, cached: bool = False, failed: bool = False):
+        """
+        Counts a query.
+
+        Args:
+            query_type (str): The type of query, from query_type_of().
+            seconds (float): Time from sending the query until the answer was read (the last attempt).
+            response_bytes (int): Size of the answers (all attempts).
+            points (float): Rate limit points the query cost.
+            retries (int): Number of times the query was sent again.
+            cached (bool): True if the answer was read from the response cache.
+            failed (bool): True if there was no answer.
+        """
+        with self.lock:
+            query = self.queries.setdefault(query_type, {'calls': 0, 'cache_hits': 0, 'errors': 0, 'retries': 0,
+                                                         'bytes': 0, 'points': 0.0, 'latencies': []})
+            if cached:
+                query['cache_hits'] += 1
+                return
+            query['calls'] += 1
+            query['errors'] += int(failed)
+            query['retries'] += retries
+            query['bytes'] += response_bytes
+            query['points'] += points
+            if not failed:
+                query['latencies'].append(seconds)
+
+    def count(self, name: str, value: int = 1):
+        """
+        Adds to a counter (example: reports_done).
+
+        Args:
+            name (str): Name of the counter.
+            value (int): The number to add.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge_max(self, name: str, value: float):
+        """
+        Saves a value if it's bigger than the last one (example: peak memory).
+
+        Args:
+            name (str): Name of the value.
+            value (float): The value.
+        """
+        with self.lock:
+            self.gauges[name] = max(self.gauges.get(name, value), value)
+
+    def summary(self) -> dict:
+        """
+        Makes the summary of the run.
+
+        Returns:
+            summary (dict): The stages, queries, counters and gauges, can be saved as JSON.
+        """
+        with self.lock:
+            queries = {}
+            for query_type, query in self.queries.items():
+                latencies = np.array(query['latencies']) if query['latencies'] else np.zeros(1)
+                queries[query_type] = {key: value for key, value in query.items() if key != 'latencies'}
+                queries[query_type]['latency_seconds'] = {
+                    'total': float(np.sum(latencies)), 'mean': float(np.mean(latencies)),
+                    'p50': float(np.percentile(latencies, 50)), 'p95': float(np.percentile(latencies, 95)),
+                    'max': float(np.max(latencies))}
+            return {'command': self.command,
+                    'started_at': self.started_at.isoformat(),
+                    'finished_at': datetime.now().astimezone().isoformat(),
+                    'duration_seconds': time.perf_counter() - self.started,
+                    'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                    'queries': queries,
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges)}
+
+    def write(self, json_path: str = RUN_SUMMARY_FILE, prometheus_path: str = None) -> dict:
+        """
+        Saves the summary as JSON, and in the Prometheus textfile format if prometheus_path is given.
+        The files are written under a temporary name and renamed when they're complete.
+
+        Args:
+            json_path (str): Path to the JSON file, nothing is saved if None.
+            prometheus_path (str): Path to the Prometheus file (should end with .prom), nothing is saved if None.
+
+        Returns:
+            summary (dict): The summary.
+        """
+        summary = self.summary()
+        if json_path:
+            with open(json_path + '.tmp', 'w') as f:
+                json.dump(summary, f, indent=2)
+            os.replace(json_path + '.tmp', json_path)
+        if prometheus_path:
+            with open(prometheus_path + '.tmp', 'w') as f:
+                f.write(prometheus_text(summary))
+            os.replace(prometheus_path + '.tmp', prometheus_path)
+        return summary
+
+def prometheus_text(summary: dict) -> str:
+    """
+    Converts a run summary to the Prometheus text format (for the node_exporter textfile collector).
+
+    Args:
+        summary (dict): The summary from RunMetrics.summary().
+
+    Returns:
+        text (str): The metrics.
+    """
+    command = summary['command'] or 'run'
+    lines = []
+
+    def add(name: str, kind: str, help_text: str, samples: list):
+        lines.append(f"# HELP wlog_{name} {help_text}")
+        lines.append(f"# TYPE wlog_{name} {kind}")
+        for labels, value in samples:
+            labels = dict(labels, command=command)
+            label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f"wlog_{name}{{{label_text}}} {value}")
+
+    add('run_duration_seconds', 'gauge', "Duration of the last run.", [({}, summary['duration_seconds'])])
+    add('run_finished_timestamp_seconds', 'gauge', "When the last run finished (UNIX).",
+        [({}, datetime.fromisoformat(summary['finished_at']).timestamp())])
+
+    stages = summary['stages']
+    add('stage_seconds', 'gauge', "Time spent in every stage, summed over the threads.",
+        [({'stage': name}, stage['seconds']) for name, stage in stages.items()])
+    add('stage_runs', 'gauge', "Number of times every stage was run.",
+        [({'stage': name}, stage['count']) for name, stage in stages.items()])
+
+    queries = summary['queries']
+    for key, help_text in (('calls', "API-calls"), ('cache_hits', "Answers read from the response cache"),
+                           ('errors', "API-calls without an answer"), ('retries', "API-calls that were sent again"),
+                           ('bytes', "Bytes in the answers"), ('points', "Rate limit points")):
+        add(f'api_{key}', 'gauge', f"{help_text} for every type of query.",
+            [({'query_type': name}, query[key]) for name, query in queries.items()])
+    add('api_latency_seconds', 'gauge', "Latency of the API-calls for every type of query.",
+        [({'query_type': name, 'quantile': quantile}, query['latency_seconds'][key])
+         for name, query in queries.items() for quantile, key in (('0.5', 'p50'), ('0.95', 'p95'), ('1', 'max'))])
+
+    add('counter', 'gauge', "Counters for the last run (example: reports_done).",
+        [({'name': name}, value) for name, value in summary['counters'].items()])
+    add('gauge', 'gauge', "Highest values in the last run (example: max_rss_mb).",
+        [({'name': name}, value) for name, value in summary.get('gauges', {}).items()])
+    return '\n'.join(lines) + '\n'
+
+# Collects the timings and counters for the current run.
+metrics = RunMetrics()
+
+def log_run_summary(summary: dict):
+    """
+    Logs the most important parts of a run summary.
+
+    Args:
+        summary (dict): The summary from RunMetrics.summary().
+    """
+    logger.info(f"Run took {summary['duration_seconds']:.1f} seconds")
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+        logger.info(f"  stage {name}: {stage['seconds']:.2f} seconds ({stage['count']} times)")
+    for name, query in summary['queries'].items():
+        logger.info(f"  query {name}: {query['calls']} calls, {query['cache_hits']} cache hits, {query['bytes'] / 1e6:.2f} MB, "
+                    f"{query['points']:.1f} points, p95 latency {query['latency_seconds']['p95']:.2f} seconds")
+    for name, value in summary.get('gauges', {}).items():
+        logger.info(f"  {name}: {value:.1f}")
+
 # Functions for handling the token needed for authorization. 
 
 def read_token(token_name='WARCRAFTLOGS_TOKEN'):
@@ -73,7 +414,7 @@ def store_token(token, token_name='WARCRAFTLOGS_TOKEN'):
     print(f"Successfully saved new token to the .env file under key '{token_name}'.")
     logger.info(f"Successfully saved new token to the .env file under key '{token_name}'.")
 
-def get_new_token(client_id, client_secret):
+def get_new_token(client_id, client_secret, session=None):
     """
     Gets a new access token from the Warcraft Logs API using the Client Credentials flow.
     If successful, it saves the new token to the .env file.
@@ -81,6 +422,7 @@ def get_new_token(client_id, client_secret):
     Args:
         client_id (str): The public client ID for your application.
         client_secret (str): The confidential client secret for your application.
+        session (requests.Session): Session to send the request with, a new connection is used if None.
 
     Returns:
         str or None: The new access token string if successful, otherwise None.
@@ -89,7 +431,8 @@ def get_new_token(client_id, client_secret):
     data = {'grant_type': 'client_credentials'}
 
     try:
-        response = requests.post(url, data=data, auth=(client_id, client_secret))
+        post = session.post if session is not None else requests.post
+        response = post(url, data=data, auth=(client_id, client_secret))
 
         token_data = response.json()
         access_token = token_data.get('access_token')
@@ -108,78 +451,540 @@ def get_new_token(client_id, client_secret):
         print(f"An error occurred while getting a new token: {e}")
         return None
     
-# Base function for making querys
-def make_query(token: str, query: str) -> dict:
+# Functions and class for staying inside the rate limit of the API.
+# Every query costs points and the API gives us a budget of points per hour.
+# The fields in RATE_LIMIT_FIELDS are added to every query so we always know how much of the budget is left.
+
+RATE_LIMIT_FIELDS = """rateLimitData{
+                                                pointsSpentThisHour
+                                                limitPerHour
+                                                pointsResetIn
+                                                }"""
+
+# Retry settings for when the API answers 429 (too many requests) or 5xx (server error).
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 120
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Share of the hourly budget that is never used, so other programs on the same account still get some points.
+RATE_LIMIT_MARGIN = 0.02
+
+# Calls are sent as fast as possible until less than this share of the hourly budget is left, then they are spread out.
+RATE_LIMIT_BURST = 0.25
+
+# The budget was reset if the reset time in a response is this many seconds later than the one we have. The answers
+# from the worker threads can come in a diffrent order than the calls, so the reset time and the points spent can
+# go back a little, but a reset moves the reset time a whole hour.
+RATE_LIMIT_RESET_TOLERANCE = 300
+
+class RateLimiter:
+    """
+    Spreads the API-calls over the hour so the budget of points lasts until it's reset.
+
+    After every call the points spent this hour are updated from the rateLimitData in the response.
+    While there are plenty of points left the calls are sent without waiting. When less than RATE_LIMIT_BURST
+    of the budget is left, the average cost of a call and the points left decides how long to wait between calls,
+    so the budget is used as fully as possible without running out before it's reset.
+    The points are also summed up per label (the report code) so we can see what every report costs.
+    Responses that come in late (with fewer points spent than one we already have) don't change the budget.
     """
-    Makes a GraphQL query to the Warcraft Logs API using the provided access token.
+
+    def __init__(self, margin: float = RATE_LIMIT_MARGIN, burst: float = RATE_LIMIT_BURST):
+        """
+        Args:
+            margin (float): Part of the budget that is never used.
+            burst (float): The calls are sent without waiting while more than this part of the budget is left.
+                           Use 1.0 to always spread the calls evenly over the hour.
+        """
+        self.margin = margin
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.points_spent = None
+        self.limit_per_hour = None
+        self.reset_at = None
+        self.average_cost = None
+        self.next_call_at = 0.0
+        self.points_total = 0
+        self.points_per_label = {}
+
+    def wait(self) -> float:
+        """
+        Waits until it's time for the next API-call. Safe to use from several threads at once.
+
+        Returns:
+            seconds (float): How long it waited.
+        """
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call_at)
+            self.next_call_at = call_at + self.interval(call_at)
+        if call_at > now:
+            time.sleep(call_at - now)
+        return call_at - now
+
+    def interval(self, now: float) -> float:
+        """
+        Calculates the time between API-calls that makes the points left last until the reset.
+
+        Args:
+            now (float): The current time (from time.monotonic()).
+
+        Returns:
+            interval (float): Seconds between calls.
+        """
+        if self.limit_per_hour is None or self.average_cost is None:
+            return 0.0
+
+        reset_in = max(self.reset_at - now, 0.0)
+        points_left = self.limit_per_hour * (1 - self.margin) - self.points_spent
+        if points_left <= self.average_cost:
+            # The budget is used up, wait for the reset.
+            return reset_in
+        if points_left > self.limit_per_hour * self.burst:
+            return 0.0
+        return self.average_cost * reset_in / points_left
+
+    def update(self, rate_limit_data: dict, label: str = None) -> float:
+        """
+        Updates the budget with the rateLimitData from a response.
+
+        Args:
+            rate_limit_data (dict): Dict with pointsSpentThisHour, limitPerHour and pointsResetIn.
+            label (str): What to count the points to (example: the report code).
+
+        Returns:
+            cost (float): The points the call cost, 0 for the first call and for responses that came in late.
+        """
+        with self.lock:
+            points_spent = rate_limit_data['pointsSpentThisHour']
+            reset_at = time.monotonic() + rate_limit_data['pointsResetIn']
+            self.limit_per_hour = rate_limit_data['limitPerHour']
+            if self.points_spent is None or reset_at > self.reset_at + RATE_LIMIT_RESET_TOLERANCE:
+                # The first call, or the budget was reset since the last call.
+                cost = points_spent if self.points_spent is not None else None
+                self.points_spent = points_spent
+                self.reset_at = reset_at
+            elif points_spent >= self.points_spent and reset_at > self.reset_at - RATE_LIMIT_RESET_TOLERANCE:
+                cost = points_spent - self.points_spent
+                self.points_spent = points_spent
+                self.reset_at = reset_at
+            else:
+                # A late response (from before a newer one, or from the hour before the reset), its cost is
+                # already in the points of the newer response.
+                return 0
+
+            if cost is not None:
+                self.average_cost = cost if self.average_cost is None else 0.8 * self.average_cost + 0.2 * cost
+                self.points_total += cost
+                if label is not None:
+                    self.points_per_label[label] = self.points_per_label.get(label, 0) + cost
+            return cost or 0
+
+    def pause(self, seconds: float):
+        """
+        Stops all API-calls for a while, used when the API says we're sending too many.
+
+        Args:
+            seconds (float): How long to pause.
+        """
+        with self.lock:
+            self.next_call_at = max(self.next_call_at, time.monotonic() + seconds)
+
+    def points_used(self, label: str) -> float:
+        """
+        Returns the points spent on a label (example: a report code).
+
+        Args:
+            label (str): The label the points were counted to.
+
+        Returns:
+            points (float): The points spent.
+        """
+        with self.lock:
+            return self.points_per_label.get(label, 0)
+
+def add_rate_limit_fields(query: str) -> str:
+    """
+    Adds the rateLimitData fields to a query-string, so the response tells us how many points are left.
 
     Args:
-        token (str): The access token to use for authorization.
         query (str): The GraphQL query string.
 
     Returns:
-        dict or None: The JSON response data if successful, otherwise None.
+        query (str): The query string with rateLimitData added.
     """
-    url = "https://www.warcraftlogs.com/api/v2/client"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-    data = {'query': query}
+    if 'rateLimitData' in query:
+        return query
+    last_bracket = query.rstrip().rfind('}')
+    return query[:last_bracket] + RATE_LIMIT_FIELDS + "\n                                            }"
 
-    try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred while making the GraphQL query: {e}")
+def retry_delay(attempt: int, response: requests.Response = None) -> float:
+    """
+    Calculates how long to wait before trying again. Uses the Retry-After header if the API sent one,
+    otherwise an exponential backoff with jitter so the threads don't all retry at the same time.
+
+    Args:
+        attempt (int): The number of the attempt that failed (starting at 0).
+        response (requests.Response): The failed response, if there was one.
+
+    Returns:
+        delay (float): Seconds to wait.
+    """
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        return float(response.headers['Retry-After'])
+    delay = min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+    return delay * random.uniform(0.5, 1.5)
+
+# Cache for the API responses.
+# The data in a report doesn't change after it's uploaded, so every response for a report is saved
+# in a SQLite file (compressed with zlib) and reused the next time the same query is made.
+
+class ResponseCache:
+    """
+    On-disk cache for API responses, keyed by the report code and a hash of the query.
+
+    The responses are stored as zlib-compressed JSON in a SQLite file. When the cache gets bigger
+    than max_mb the least recently used responses are removed. Safe to use from several threads at once.
+    Reading a response only notes the time it was used in memory, the times are saved together on the next
+    put(), evict() or close(), so a rerun from the cache doesn't write to the file for every response.
+
+    Args:
+        path (str): Path to the SQLite file.
+        max_mb (float): Max size of the stored responses in megabytes.
+        refresh (bool): If True the cache is never read, but new responses are still saved.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE_FILE, max_mb: float = RESPONSE_CACHE_MAX_MB, refresh: bool = False):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.last_used = {}
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                       report_code TEXT NOT NULL,
+                                       query_hash TEXT NOT NULL,
+                                       data BLOB NOT NULL,
+                                       size INTEGER NOT NULL,
+                                       created_at REAL NOT NULL,
+                                       last_used REAL NOT NULL,
+                                       PRIMARY KEY (report_code, query_hash))""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def query_hash(query: str) -> str:
+        """
+        Makes a hash of the query, whitespace is ignored so the indentation of the query-string doesn't matter.
+
+        Args:
+            query (str): The GraphQL query string.
+
+        Returns:
+            hash (str): The sha256 hash as a hex string.
+        """
+        return hashlib.sha256(' '.join(query.split()).encode()).hexdigest()
+
+    def get(self, report_code: str, query: str) -> dict:
+        """
+        Gets a response from the cache.
+
+        Args:
+            report_code (str): The report the query is for.
+            query (str): The GraphQL query string.
+
+        Returns:
+            response (dict or None): The response, or None if it isn't in the cache.
+        """
+        if self.refresh:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        key = (report_code, self.query_hash(query))
+        with self.lock:
+            row = self.connection.execute("SELECT data FROM responses WHERE report_code = ? AND query_hash = ?", key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.last_used[key] = time.time()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, report_code: str, query: str, response: dict):
+        """
+        Saves a response in the cache and removes old responses if the cache is too big.
+        The rateLimitData is not saved since it's only correct at the time of the API-call.
+
+        Args:
+            report_code (str): The report the query is for.
+            query (str): The GraphQL query string.
+            response (dict): The response to save.
+        """
+        response = {**response, 'data': {key: value for key, value in response['data'].items() if key != 'rateLimitData'}}
+        data = zlib.compress(json.dumps(response, separators=(',', ':')).encode(), 6)
+        now = time.time()
+        key = (report_code, self.query_hash(query))
+        with self.lock:
+            self.last_used.pop(key, None)
+            self.flush_last_used()
+            old = self.connection.execute("SELECT size FROM responses WHERE report_code = ? AND query_hash = ?", key).fetchone()
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)", (*key, data, len(data), now, now))
+            self.total_bytes += len(data) - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.connection.commit()
+
+    def flush_last_used(self):
+        """
+        Saves the times the responses were read since the last flush. Called with the lock held, the caller commits.
+        """
+        if not self.last_used:
+            return
+        self.connection.executemany("UPDATE responses SET last_used = ? WHERE report_code = ? AND query_hash = ?",
+                                    [(used, *key) for key, used in self.last_used.items()])
+        self.last_used = {}
+
+    def evict(self):
+        """
+        Removes the least recently used responses until the cache is 90% of the max size. Called with the lock held.
+        """
+        self.flush_last_used()
+        target = self.max_bytes * 0.9
+        rows = self.connection.execute("SELECT report_code, query_hash, size FROM responses ORDER BY last_used").fetchall()
+        removed = 0
+        for report_code, query_hash, size in rows:
+            if self.total_bytes <= target:
+                break
+            self.connection.execute("DELETE FROM responses WHERE report_code = ? AND query_hash = ?", (report_code, query_hash))
+            self.total_bytes -= size
+            removed += 1
+        logger.info(f"Removed {removed} old responses from the response cache")
+
+    def close(self):
+        """
+        Closes the SQLite file.
+        """
+        with self.lock:
+            self.flush_last_used()
+            self.connection.commit()
+            self.connection.close()
+
+# The client that talks to the API.
+# It keeps one session for all the API-calls, so the connection to warcraftlogs.com is reused
+# instead of making a new connection (TCP + TLS handshake) for every query.
+
+API_URL = "https://www.warcraftlogs.com/api/v2/client"
+
+class WarcraftLogsClient:
+    """
+    Client for the Warcraft Logs API.
+
+    Owns a pooled keep-alive requests.Session, the token and the rate limiter. If the API answers
+    401 (unauthorized) a new token is fetched with the client ID and secret and the query is sent again.
+    The responses are sent gzip-compressed. If the client has a ResponseCache, the responses for
+    report queries are read from and saved to it.
+
+    Args:
+        token (str): The access token to use for authorization, a new one is fetched if None.
+        client_id (str): The public client ID, used for getting a new token.
+        client_secret (str): The client secret, used for getting a new token.
+        pool_size (int): Max number of connections kept open, should be at least the number of worker threads.
+        cache (ResponseCache): Cache for the responses, nothing is cached if None.
+        api_url (str): URL of the GraphQL API, can be changed to a local server for testing (see warcraftlogs_benchmark.py).
+    """
+
+    def __init__(self, token: str = None, client_id: str = None, client_secret: str = None, pool_size: int = MAX_WORKERS,
+                 cache: ResponseCache = None, api_url: str = API_URL):
+        self.token = token
+        self.cache = cache
+        self.api_url = api_url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_lock = threading.Lock()
+        self.rate_limiter = RateLimiter()
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json",
+                                     "Accept-Encoding": "gzip, deflate"})
+
+        if self.token is None:
+            self.refresh_token()
+
+    @classmethod
+    def from_env(cls, pool_size: int = MAX_WORKERS, cache: ResponseCache = None):
+        """
+        Creates a client with the token, client ID and client secret from the .env file.
+
+        Args:
+            pool_size (int): Max number of connections kept open.
+            cache (ResponseCache): Cache for the responses, nothing is cached if None.
+
+        Returns:
+            client (WarcraftLogsClient): The client.
+        """
+        token = read_token()
+        client_id = os.getenv('CLIENT_ID') or os.getenv('client_ID')
+        client_secret = os.getenv('CLIENT_SECRET') or os.getenv('client_secret')
+        return cls(token, client_id, client_secret, pool_size, cache)
+
+    def refresh_token(self, old_token: str = None) -> str:
+        """
+        Gets a new token. If another thread already replaced old_token the new one is used instead.
+
+        Args:
+            old_token (str): The token that didn't work.
+
+        Returns:
+            token (str or None): The new token.
+        """
+        with self.token_lock:
+            if old_token is not None and self.token != old_token:
+                return self.token
+            if not self.client_id or not self.client_secret:
+                print("Error: Can't get a new token without client ID and client secret.")
+                logger.info("Error: Can't get a new token without client ID and client secret.")
+                return self.token
+            print("Fetching a new token...")
+            self.token = get_new_token(self.client_id, self.client_secret, self.session)
+            return self.token
+
+    def query(self, query: str, report_code: str = None, refresh: bool = False) -> dict:
+        """
+        Makes a GraphQL query to the Warcraft Logs API.
+
+        If the query is for a report (report_code is given) and the response is in the cache, no API-call is made.
+        Otherwise it waits for the rate limiter before sending the query and retries with backoff
+        if the API answers 429 (too many requests) or 5xx (server error).
+
+        Args:
+            query (str): The GraphQL query string.
+            report_code (str): The report the query is for. Used as key in the cache and for counting the points spent.
+            refresh (bool): If True the cache isn't read (the report has changed), but the new response is saved.
+
+        Returns:
+            dict or None: The JSON response data if successful, otherwise None.
+        """
+        query_type = query_type_of(query)
+        if self.cache is not None and report_code is not None and not refresh:
+            response_json = self.cache.get(report_code, query)
+            if response_json is not None:
+                metrics.record_query(query_type, cached=True)
+                return response_json
+
+        data = {'query': add_rate_limit_fields(query)}
+        token_refreshed = False
+        response_bytes = 0
+
+        for attempt in range(MAX_RETRIES + 1):
+            metrics.add_time('rate_limit_wait', self.rate_limiter.wait())
+            response = None
+            token = self.token
+            try:
+                started = time.perf_counter()
+                response = self.session.post(self.api_url, headers={"Authorization": f"Bearer {token}"}, json=data)
+                response_bytes += len(response.content)
+                if response.status_code == 401 and not token_refreshed:
+                    # The token has expired, get a new one and try again.
+                    token_refreshed = True
+                    if self.refresh_token(token):
+                        continue
+                if response.status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES:
+                    delay = retry_delay(attempt, response)
+                    logger.info(f"The API answered {response.status_code}, trying again in {delay:.1f} seconds")
+                    if response.status_code == 429:
+                        self.rate_limiter.pause(delay)
+                    else:
+                        time.sleep(delay)
+                    continue
+                response.raise_for_status()
+                response_json = response.json()
+            except requests.exceptions.RequestException as e:
+                if response is None and attempt < MAX_RETRIES:
+                    # No answer at all (example: the connection was lost), try again.
+                    delay = retry_delay(attempt)
+                    logger.info(f"An error occurred while making the GraphQL query: {e}, trying again in {delay:.1f} seconds")
+                    time.sleep(delay)
+                    continue
+                print(f"An error occurred while making the GraphQL query: {e}")
+                metrics.record_query(query_type, response_bytes=response_bytes, retries=attempt, failed=True)
+                return None
+            latency = time.perf_counter() - started
+
+            points = 0
+            rate_limit_data = (response_json.get('data') or {}).get('rateLimitData')
+            if rate_limit_data:
+                points = self.rate_limiter.update(rate_limit_data, report_code)
+            metrics.record_query(query_type, latency, response_bytes, points, retries=attempt)
+
+            if self.cache is not None and report_code is not None and not response_json.get('errors'):
+                self.cache.put(report_code, query, response_json)
+            return response_json
+
+        metrics.record_query(query_type, response_bytes=response_bytes, retries=MAX_RETRIES, failed=True)
         return None
 
-# Functions for getting fightIDs. 
-# One report can contain multiple fights (one fight = one whole dungeon-run)
+    def close(self):
+        """
+        Closes the connections in the session.
+        """
+        self.session.close()
 
-def make_fightID_query(report_code: str) -> str:
+# Base function for making querys
+def make_query(client: WarcraftLogsClient, query: str, report_code: str = None, refresh: bool = False) -> dict:
     """
-    Creates a query-string for getting information about the fights in the report.
+    Makes a GraphQL query to the Warcraft Logs API using the provided client.
 
     Args:
-        report_code (str): Uniqe code for the report used in the query.
+        client (WarcraftLogsClient): The client to send the query with.
+        query (str): The GraphQL query string.
+        report_code (str): The report the query is for, the response is cached if this is given.
+        refresh (bool): If True the response cache isn't read.
+
+    Returns:
+        dict or None: The JSON response data if successful, otherwise None.
+    """
+    return client.query(query, report_code, refresh)
+
+def make_rate_limit_query() -> str:
+    """
+    Creates a query-string for getting information about the rate limit.
 
     Returns:
         query (str): Query string to be used in a api call.
     """
     query = f"""query PlayerDungeonMetrics{{
-                                            reportData{{
-                                                report(code: "{report_code}"){{
-                                                        title
-                                                        fights(translate: true, difficulty: 10) {{
-                                                            id
-                                                            friendlyPlayers
-                                                            gameZone{{
-                                                                name
-                                                                }}
-                                                            difficulty
-                                                            keystoneLevel
-                                                        }}
-                                                    }}
-                                                }}
-                                            }}""" 
+                                            {RATE_LIMIT_FIELDS}
+                                            }}"""
     return query
 
-def get_fightID(token: str, report_code: str) -> pd.DataFrame:
-    """ 
-    Makes the API-call with the query to get data about the fights in the report.
+def get_rate_limit(client: WarcraftLogsClient) -> dict:
+    """
+    Makes the API-call to get how many points are spent this hour, the limit and when it's reset.
+    The rate limiter is also updated with the answer.
 
     Args:
-        token (str): The access token to use for authorization.
-        report_code (str): The reportcode for a report on warcraftlogs.
+        client (WarcraftLogsClient): The client for making the API call.
 
     Returns:
-        df (pd.DataFrame): A dataframe with the ID of the diffrent fights in the report.
+        rate_limit_data (dict or None): Dict with pointsSpentThisHour, limitPerHour and pointsResetIn.
     """
-    test_query = make_query(token, make_fightID_query(report_code))
-    df = pd.json_normalize(test_query, record_path=['data', 'reportData', 'report', 'fights'])
-    return df
+    response = make_query(client, make_rate_limit_query())
+    if not response or not response.get('data'):
+        return None
+    return response['data']['rateLimitData']
+
+# Functions for filtering the fights.
+# One report can contain multiple fights (one fight = one whole dungeon-run)
 
 def clean_fightID_df(dataframe):
     """ 
@@ -199,11 +1004,21 @@ def clean_fightID_df(dataframe):
     df_filtered = df[mask]
     return df_filtered
 
-#Functions for adding gameID data (name, report ID, game ID) for the report.
+# Functions for getting all the data for a report in as few querys as possible.
+# GraphQL lets us ask for the same field several times in one query if every copy gets an alias,
+# so the damage, healing and deaths tables for many fights can be fetched in a single API-call.
+
+# Max number of fights per query, every fight adds three tables to the query.
+MAX_FIGHTS_PER_QUERY = 10
 
-def make_gameID_query(report_code: str) -> str:
+# Alias prefix and dataType for the tables we get for each fight.
+FIGHT_TABLES = {'damage': 'DamageDone',
+                'healing': 'Healing',
+                'deaths': 'Deaths'}
+
+def make_report_metadata_query(report_code: str) -> str:
     """
-    Creates a query-string for getting information about the character ID's in the report.
+    Creates a query-string for getting the start time, the characters and the fights in the report.
 
     Args:
         report_code (str): Uniqe code for the report used in the query.
@@ -213,7 +1028,10 @@ def make_gameID_query(report_code: str) -> str:
     """
     query = f"""query PlayerDungeonMetrics{{
                                             reportData{{
-                                                report(code: "{report_code}"){{                        
+                                                report(code: "{report_code}"){{
+                                                    title
+                                                    startTime
+                                                    endTime
                                                     masterData{{
                                                         actors(type: "Player"){{
                                                             name
@@ -221,618 +1039,3430 @@ def make_gameID_query(report_code: str) -> str:
                                                             id
                                                             }}
                                                         }}
+                                                    fights(translate: true, difficulty: 10) {{
+                                                        id
+                                                        startTime
+                                                        endTime
+                                                        friendlyPlayers
+                                                        gameZone{{
+                                                            id
+                                                            name
+                                                            }}
+                                                        difficulty
+                                                        keystoneLevel
+                                                        }}
                                                     }}
                                                 }}
-                                            }}""" 
+                                            }}"""
     return query
 
-def get_gameID(token: str, report_code: str) -> pd.DataFrame:
-    """ 
-    Makes the API-call with the query to get data about the character ID's.
+def get_report_metadata(client: WarcraftLogsClient, report_code: str, refresh: bool = False) -> dict:
+    """
+    Makes the API-call for the start time, characters and fights of a report in one query.
 
     Args:
-        token (str): The access token to use for authorization.
+        client (WarcraftLogsClient): The client for making the API call.
         report_code (str): The reportcode for a report on warcraftlogs.
+        refresh (bool): If True the response cache isn't read, used when the report has changed since it was cached.
 
     Returns:
-        df_gameID (pd.DataFrame): A dataframe with the characters name, gameID and report id.
+        report (dict): The report part of the response, with the keys title, startTime, endTime, masterData and fights.
     """
-    gameID_query = make_query(token, make_gameID_query(report_code))
-    df_gameID = pd.json_normalize(gameID_query, record_path=['data', 'reportData', 'report', 'masterData', 'actors'])
-    return df_gameID
+    response = make_query(client, make_report_metadata_query(report_code), report_code=report_code, refresh=refresh)
+    if not response or response.get('errors') or not response['data']['reportData']['report']:
+        raise ValueError(f"Could not get the metadata for report '{report_code}': {response}")
+    return response['data']['reportData']['report']
 
-# Functions for damage and healing in a fight.
-
-def make_damage_query(report_code: str, fight_id: str) -> str:
+def clean_fight_metadata(report_metadata: dict) -> pd.DataFrame:
     """
-    Creates a query-string for getting information about the damage in the report.
+    Makes a dataframe with the start time, end time and duration of every dungeon-run in the report.
+
+    The fights startTime and endTime are in milliseconds from the start of the report, so the times
+    are calculated for the whole column at once instead of one fight at a time.
 
     Args:
-        report_code (str): Uniqe code for the report used in the query.
+        report_metadata (dict): The start time, characters and fights of the report.
 
     Returns:
-        query (str): Query string to be used in a api call.
+        df_fights (pd.DataFrame): dataframe with id, friendlyPlayers, DungeonName, zoneID, keystoneLevel,
+                                  StartTime, EndTime (in UTC) and Duration (in seconds) for every fight.
     """
-    query = f"""query PlayerDungeonMetrics{{
-                                            reportData{{
-                                                report(code: "{report_code}"){{                        
-                                                    table(fightIDs: [{fight_id}], dataType: DamageDone, hostilityType: Friendlies)
-                                                    }}
-                                                }}
-                                            }}""" 
-    return query
-
-def make_healing_query(report_code: str, fight_id: int) -> str:
+    df_fights = pd.json_normalize(report_metadata['fights'])
+    if df_fights.empty:
+        return pd.DataFrame(columns=['id', 'friendlyPlayers', 'DungeonName', 'zoneID', 'keystoneLevel', 'StartTime', 'EndTime', 'Duration'])
+    df_fights = clean_fightID_df(df_fights)
+
+    report_start = report_metadata['startTime']
+    df_fights = df_fights.assign(
+        DungeonName=df_fights['gameZone.name'].fillna("No name found") if 'gameZone.name' in df_fights else "No name found",
+        StartTime=pd.to_datetime(report_start + df_fights['startTime'], unit='ms', utc=True),
+        EndTime=pd.to_datetime(report_start + df_fights['endTime'], unit='ms', utc=True),
+        Duration=(df_fights['endTime'] - df_fights['startTime']) / 1000,
+    )
+    if 'keystoneLevel' not in df_fights:
+        df_fights['keystoneLevel'] = None
+    # Responses from before the zone id was in the query don't have it.
+    df_fights['zoneID'] = df_fights['gameZone.id'] if 'gameZone.id' in df_fights else None
+    return df_fights[['id', 'friendlyPlayers', 'DungeonName', 'zoneID', 'keystoneLevel', 'StartTime', 'EndTime', 'Duration']]
+
+def make_fight_tables_query(report_code: str, fight_ids: list) -> str:
     """
-    Creates a query-string for getting information about the healing in the report.
+    Creates a query-string for getting the damage, healing and deaths tables for several fights at once.
+    Every table gets an alias made of the datatype and the fight ID (example: damage_5).
 
     Args:
         report_code (str): Uniqe code for the report used in the query.
+        fight_ids (list): The fights we want the tables for.
 
     Returns:
         query (str): Query string to be used in a api call.
     """
+    tables = []
+    for fight_id in fight_ids:
+        for alias, data_type in FIGHT_TABLES.items():
+            tables.append(f"{alias}_{fight_id}: table(fightIDs: [{fight_id}], dataType: {data_type}, hostilityType: Friendlies)")
+    tables_string = "\n                                                    ".join(tables)
+
     query = f"""query PlayerDungeonMetrics{{
                                             reportData{{
-                                                report(code: "{report_code}"){{                        
-                                                    table(fightIDs: [{fight_id}], dataType: Healing, hostilityType: Friendlies)
+                                                report(code: "{report_code}"){{
+                                                    {tables_string}
                                                     }}
                                                 }}
-                                            }}""" 
+                                            }}"""
     return query
 
-def get_damage_and_healing(token: str, report_code: str, fight_ID: int) -> pd.DataFrame:
+def get_fight_tables(client: WarcraftLogsClient, report_code: str, fight_ids: list, max_fights_per_query: int = MAX_FIGHTS_PER_QUERY,
+                     on_fights_done=None) -> dict:
     """
-    Uses a token,reportcode and the fight ID for warcraftlogs to get data for damage and healing.
+    Gets the damage, healing and deaths tables for all the given fights with as few API-calls as possible.
+
+    The fights are split into chunks of max_fights_per_query. If the API can't answer a chunk
+    (the response is too big or the query is too complex) the chunk is split in half and tried again.
+    A fight that fails on its own doesn't stop the other fights, but an error is raised in the end.
 
     Args:
-        token (str): The access token to use for authorization.
+        client (WarcraftLogsClient): The client for making the API call.
         report_code (str): The reportcode for a report on warcraftlogs.
-        fight_ID (int): A number indicating what fight in the report that was used.
+        fight_ids (list): The fights we want the tables for.
+        max_fights_per_query (int): The max number of fights in a single query.
+        on_fights_done (callable): Called with the tables of every chunk as soon as it's done (used for checkpoints).
+
     Returns:
-        DataFrame with data for damage and healing.
+        fight_tables (dict): fight ID as key and a dict with the entries for damage, healing and deaths as value.
     """
-    #Damage part
-    damage_query = make_query(token, make_damage_query(report_code, fight_ID))
-    df_dmg_temp = pd.json_normalize(damage_query, record_path=['data', 'reportData', 'report', 'table', 'data', 'entries'])
-    dmg_columns = ['name', 'type', 'itemLevel', 'total']
-    df_damage = df_dmg_temp[dmg_columns]
-    df_damage.columns = ['name', 'class', 'ilvl', 'Dps']
-            
-    #healing part
-    healing_query = make_query(token, make_healing_query(report_code, fight_ID))
-    df_heal_temp = pd.json_normalize(healing_query, record_path=['data', 'reportData', 'report', 'table', 'data', 'entries'])
-    heal_columns = ['name', 'total']
-    df_heal = df_heal_temp[heal_columns]
-    df_heal.columns = ['name', 'Healing']
-            
-    #Merge them
-    merged_df = pd.merge(df_heal, df_damage, on='name')
-    #Reorder columns
-    healing_column = merged_df.pop('Healing')
-    merged_df.insert(4, 'Healing', healing_column)
-
-    return(merged_df)
-
-# Functions for getting the starting time of the report.
+    fight_ids = list(fight_ids)
+    fight_tables = {}
+    failed_fights = []
+    chunks = [fight_ids[i:i + max_fights_per_query] for i in range(0, len(fight_ids), max_fights_per_query)]
+
+    while chunks:
+        chunk = chunks.pop(0)
+        response = make_query(client, make_fight_tables_query(report_code, chunk), report_code=report_code)
+
+        if not response or response.get('errors'):
+            if len(chunk) == 1:
+                logger.info(f"Could not get the tables for fight {chunk[0]} in report '{report_code}': {response}")
+                failed_fights.append(chunk[0])
+                continue
+            # Split the chunk in half and put both halves first in line.
+            middle = len(chunk) // 2
+            chunks[:0] = [chunk[:middle], chunk[middle:]]
+            logger.info(f"Query for {len(chunk)} fights failed, splitting it into {middle} and {len(chunk) - middle} fights")
+            continue
+
+        report = response['data']['reportData']['report']
+        chunk_tables = {}
+        for fight_id in chunk:
+            chunk_tables[fight_id] = {alias: report[f"{alias}_{fight_id}"]['data']['entries'] for alias in FIGHT_TABLES}
+        fight_tables.update(chunk_tables)
+        if on_fights_done is not None:
+            on_fights_done(chunk_tables)
+
+    if failed_fights:
+        raise ValueError(f"Could not get the tables for fights {failed_fights} in report '{report_code}'")
+
+    return fight_tables
 
+# Functions for managing report codes
+# The reports are found with the warcraftlogs reports-query. Which users, guilds and zones to look at is set in
+# DISCOVERY_CONFIG_FILE, and only reports in the time window are asked for. Every user and guild is asked at the
+# same time, and all the pages of reports are fetched.
 
-def make_report_start_query(report_code: str) -> str:
+def load_discovery_config(path: str = DISCOVERY_CONFIG_FILE) -> dict:
     """
-    Creates a query-string for getting information about the start time in the report.
+    Reads the users, guilds and zones to look for reports from.
+
+    The file is JSON, example: {"user_ids": [297125], "guild_ids": [], "zone_ids": [], "days": 7}.
+    Keys that are missing get the value from DEFAULT_DISCOVERY_CONFIG.
 
     Args:
-        report_code (str): Uniqe code for the report used in the query.
+        path (str): Path to the config file.
 
     Returns:
-        query (str): Query string to be used in a api call.
+        config (dict): The config.
     """
-    query = f"""query PlayerDungeonMetrics{{
-                                            reportData{{
-                                                report(code: "{report_code}"){{                        
-                                                    startTime
-                                                    }}
-                                                }}
-                                            }}""" 
-    return query
+    config = dict(DEFAULT_DISCOVERY_CONFIG)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            config.update(json.load(f))
+    else:
+        logger.info(f"No discovery config at '{path}', using the default users")
+    return config
 
-def get_report_start(token: str, report_code: str) -> int:
+def make_report_codes_query(user_id: int = None, guild_id: int = None, zone_id: int = None,
+                            start_time: float = None, end_time: float = None, page: int = 1) -> str:
     """ 
-    Get the starting time of the report.
+    Makes the API call to get the codes for the reports of a user or a guild.
 
     Args:
-        token(str): The token for making the API call
-        report_code(str): The report code for the report we're looking at.
+        user_id (int): The user whom uploaded the reports.
+        guild_id (int): The guild the reports belong to.
+        zone_id (int): Only reports for this zone.
+        start_time (float): Only reports that end after this time (UNIX in milliseconds).
+        end_time (float): Only reports that start before this time (UNIX in milliseconds).
+        page (int): The page of reports, starting at 1.
 
     Returns:
-        start_time(int): The startingtime as an int (in UNIX-format)
-    """
-    date_query = make_query(token, make_report_start_query(report_code))
-    start_time = int(round((date_query['data']['reportData']['report']['startTime'] / 1000)))
-    return start_time
-
-# Functions for getting the starting time for a fight. 
-# Also uses UNIX, but with 0 as the reports starting time.
-
-def make_fight_start_query(report_code: str, id: int) -> str:
+        query (str): String with the query
+    
     """
-    Creates a query-string for getting information about the starttime for a fight in the report.
+    arguments = [f"limit: {REPORTS_PER_PAGE}", f"page: {page}"]
+    for name, value in (('userID', user_id), ('guildID', guild_id), ('zoneID', zone_id)):
+        if value is not None:
+            arguments.append(f"{name}: {int(value)}")
+    for name, value in (('startTime', start_time), ('endTime', end_time)):
+        if value is not None:
+            arguments.append(f"{name}: {float(value)}")
 
-    Args:
-        report_code (str): Uniqe code for the report used in the query.
-        id (int): Tells the program what fight in the report we're looking at. 
-    Returns:
-        query (str): Query string to be used in a api call.
-    """
     query = f"""query PlayerDungeonMetrics{{
                                             reportData{{
-                                                report(code: "{report_code}"){{                        
-                                                    fights(fightIDs: {id}){{
-                                                        id
+                                                reports({', '.join(arguments)}){{                        
+                                                    data{{
+                                                        code
+                                                        title
                                                         startTime
+                                                        endTime
                                                         }}
+                                                    has_more_pages
                                                     }}
                                                 }}
                                             }}""" 
     return query
 
-def get_fight_start(token: str, report_code: str, id: int, unix_report_start: int) -> float:
-    """ 
-    Makes the API call to get the starting time for a fight. 
-    The starting time will be in UNIX format, in relation to the starttime of the report.
-    Removes the millisecond part from UNIX.
-
-    Args: 
-        token (str): token for making the API call
-        report_code (str): the code for the report we're looking at.
-        id (int): Tells the program what fight in the report we're looking at.
-        unix_report_start (int): The startingtime for the report.
-    """
-    date_query = make_query(token, make_fight_start_query(report_code, id))
-    unix_fight = (date_query['data']['reportData']['report']['fights'][0]['startTime'])/1000
-    
-    # Adds the starttime of the fight to the starttime of the report so we get a correct conversion later.
-    unix_fight_start = unix_report_start + unix_fight
-    return unix_fight_start
-
-# Converts UNIX to datetime
-def convert_time(time_unix: float) -> datetime:
-    """ 
-    Converts the time from UNIX to a datetime object.
+def get_source_reports(client: WarcraftLogsClient, source: dict, start_time: float, end_time: float,
+                       max_pages: int = MAX_REPORT_PAGES) -> list:
+    """
+    Fetches all the pages of reports for one user or guild.
 
-    Args: 
-        time_unix (float): A number representing the time
+    Args:
+        client (WarcraftLogsClient): The client for making the API call.
+        source (dict): user_id or guild_id, and zone_id (can be None).
+        start_time (float): Start of the time window (UNIX in milliseconds).
+        end_time (float): End of the time window (UNIX in milliseconds).
+        max_pages (int): Max number of pages, all the pages if None.
 
     Returns:
-        time (datetime): The date and time as a datetime object. 
+        reports (list): A dict with code, title, startTime and endTime for every report.
     """
-    time = datetime.fromtimestamp(time_unix)
-    return time
-
-# Get's the name of the dungeon
-def get_dungeon_name(fightID: int, df: pd.DataFrame) -> str:
-    """ 
-    Get the name of the dungeon for the corresponding fight.
+    reports = []
+    page = 0
+    while max_pages is None or page < max_pages:
+        page += 1
+        response = make_query(client, make_report_codes_query(start_time=start_time, end_time=end_time, page=page, **source))
+        if not response or not response.get('data') or not response['data'].get('reportData'):
+            raise ValueError(f"Could not get page {page} of the reports for {source}")
+
+        pagination = response['data']['reportData']['reports']
+        reports.extend(pagination['data'])
+        if not pagination.get('has_more_pages'):
+            return reports
+
+    print(f"Stopped after {max_pages} pages of reports for {source}, the older reports are not fetched.")
+    logger.warning(f"Stopped after {max_pages} pages of reports for {source}, the older reports are not fetched")
+    return reports
+
+def discover_reports(client: WarcraftLogsClient, config: dict = None, start=None, end=None, max_workers: int = MAX_WORKERS,
+                     max_pages: int = MAX_REPORT_PAGES, skip_failed: bool = True) -> dict:
+    """
+    Fetches the reports for all the users and guilds in the config, with max_workers users at the same time.
 
     Args:
-        fightID (int): Identifies what fight we want the name for.
-        df (dataFrame): dataFrame with the data we need.
+        client (WarcraftLogsClient): The client for making the API call.
+        config (dict): The config from load_discovery_config(), read from DISCOVERY_CONFIG_FILE if None.
+        start (str or datetime): Start of the time window, config['days'] days ago if None.
+        end (str or datetime): End of the time window, now if None.
+        max_workers (int): Max number of users and guilds fetched at the same time.
+        max_pages (int): Max number of pages for every user and guild, all the pages if None.
+        skip_failed (bool): Skip the users and guilds where the query fails. If False a ValueError is raised
+                            instead, so a report list with missing users is never used.
 
     Returns:
-        dungeon_name (str): The name of the dungeon.
-
+        reports (dict): code as key and a dict with code, title, startTime and endTime as value.
     """
-    mask = df['id'] == fightID
-    dungeon_name = df.loc[mask, 'gameZone.name'].squeeze()
-    if pd.isna(dungeon_name):
-        return ("No name found")
-    else:
-        return dungeon_name
-    
-# Functions for deaths in a fight. 
-
-def make_deaths_query(report_code: str, fight_id: int) -> str:
+    if config is None:
+        config = load_discovery_config()
+
+    end = pd.Timestamp.now(tz='UTC') if end is None else pd.Timestamp(end)
+    start = end - pd.Timedelta(days=config['days']) if start is None else pd.Timestamp(start)
+    start_time = start.timestamp() * 1000
+    end_time = end.timestamp() * 1000
+
+    # One source for every user and guild, for every zone if there are zones in the config.
+    zone_ids = config.get('zone_ids') or [None]
+    sources = [{'user_id': user_id, 'zone_id': zone_id} for user_id in config.get('user_ids', []) for zone_id in zone_ids]
+    sources += [{'guild_id': guild_id, 'zone_id': zone_id} for guild_id in config.get('guild_ids', []) for zone_id in zone_ids]
+
+    reports = {}
+    failed_sources = []
+    with metrics.stage('discovery'), ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(sources)))) as executor:
+        futures = {executor.submit(get_source_reports, client, source, start_time, end_time, max_pages): source for source in sources}
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                source_reports = future.result()
+            except Exception as e:
+                print(f"Could not get the reports for {source}.")
+                logger.warning(f"Could not get the reports for {source}: {e}")
+                failed_sources.append(source)
+                continue
+            for report in source_reports:
+                reports[report['code']] = report
+            logger.info(f"Found {len(source_reports)} reports for {source}")
+    metrics.count('reports_discovered', len(reports))
+    if failed_sources and not skip_failed:
+        raise ValueError(f"Could not get the reports for {failed_sources}")
+    return reports
+
+def check_codes(new_codes: list, old_codes) -> list:
     """
-    Creates a query-string for getting information about the deaths in the report.
+    Compares preivous codes with the new list to check for duplicates.
 
     Args:
-        report_code (str): Uniqe code for the report used in the query.
-
+        new_codes (list): List with all the new codes as strings.
+        old_codes (ProcessedReportsStore or set): The old codes, anything that supports 'in'.
     Returns:
-        query (str): Query string to be used in a api call.
+        new_codes (list): The list with new codes but with duplicates removed.
     """
-    query = f"""query PlayerDungeonMetrics{{
-                                            reportData{{
-                                                report(code: "{report_code}"){{                        
-                                                    table(fightIDs: [{fight_id}], dataType: Deaths, hostilityType: Friendlies)
-                                                    }}
-                                                }}
-                                            }}""" 
-    return query
+    return [code for code in new_codes if code not in old_codes]
 
+class ProcessedReportsStore:
+    """
+    Store for the reports that are processed, saved in a SQLite file.
 
-def get_deaths(token: str, report_code: str, fight_id: int) -> pd.DataFrame:
-    """ 
-    Makes the API call for getting information about the deaths during the fight. 
-    If there are no deaths returns a empty dataframe.
+    Every time a report is processed a row is appended with the time, the number of fights,
+    the status and a hash of the data. Old rows are never changed, so the history is kept,
+    and a crash can't corrupt the rows that are already saved. The codes with status 'done'
+    are kept in a set so checking if a code is processed is O(1).
 
-    Args:
-        token (str): token for making the API call
-        report_code (str): the code for the report we're looking at.
-        id (int): Tells the program what fight in the report we're looking at.
+    The first time the store is used, the codes in the old processed_codes.json file are imported.
 
-    Returns: 
-        df_deaths (pd.DataFrame): A dataframe with information about the deaths during the fight.
-    """
-    deaths_query = make_query(token, make_deaths_query(report_code, fight_id))
-    df_deaths_temp = pd.json_normalize(deaths_query, record_path=['data', 'reportData', 'report', 'table', 'data', 'entries'])
-    if 'name' in df_deaths_temp.columns:
-        deaths_columns = ['name']
-        df_deaths = df_deaths_temp[deaths_columns]
-        return df_deaths
-    else:
-        return pd.DataFrame(columns=['name'])
+    Args:
+        path (str): Path to the SQLite file.
+        json_path (str): Path to the old JSON cache file that is imported.
+    """
 
+    def __init__(self, path: str = STATE_DB, json_path: str = CACHE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS processed_reports (
+                                       id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                       report_code TEXT NOT NULL,
+                                       fetched_at REAL,
+                                       fight_count INTEGER,
+                                       status TEXT NOT NULL,
+                                       content_hash TEXT)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS processed_reports_code ON processed_reports (report_code)")
+        self.connection.commit()
+
+        if self.connection.execute("SELECT COUNT(*) FROM processed_reports").fetchone()[0] == 0:
+            self.import_json(json_path)
+
+        rows = self.connection.execute("SELECT DISTINCT report_code FROM processed_reports WHERE status = 'done'").fetchall()
+        self.done_codes = {row[0] for row in rows}
+
+    def import_json(self, json_path: str):
+        """
+        Imports the codes from the old JSON cache file.
+
+        Args:
+            json_path (str): Path to the JSON file with a list of codes.
+        """
+        if not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, 'r') as f:
+                codes = list(json.load(f))
+        except (IOError, json.JSONDecodeError) as e:
+            print(f"Error loading cache file: {e}")
+            return
+
+        self.connection.executemany("INSERT INTO processed_reports (report_code, status) VALUES (?, 'done')", [(code,) for code in codes])
+        self.connection.commit()
+        logger.info(f"Imported {len(codes)} codes from '{json_path}'")
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.done_codes
+
+    def __len__(self) -> int:
+        return len(self.done_codes)
+
+    def add(self, code: str, status: str = 'done', fight_count: int = None, content_hash: str = None):
+        """
+        Appends a row for a processed report.
+
+        Args:
+            code (str): The report code.
+            status (str): 'done' if the data is saved, otherwise 'failed'.
+            fight_count (int): Number of fights in the report.
+            content_hash (str): Hash of the data for the report.
+        """
+        with self.lock:
+            self.connection.execute("""INSERT INTO processed_reports (report_code, fetched_at, fight_count, status, content_hash)
+                                       VALUES (?, ?, ?, ?, ?)""", (code, time.time(), fight_count, status, content_hash))
+            self.connection.commit()
+            if status == 'done':
+                self.done_codes.add(code)
+
+    def history(self, code: str) -> pd.DataFrame:
+        """
+        Gets all the rows for a report code.
+
+        Args:
+            code (str): The report code.
+
+        Returns:
+            df (pd.DataFrame): dataframe with the rows, oldest first.
+        """
+        with self.lock:
+            return pd.read_sql_query("SELECT * FROM processed_reports WHERE report_code = ? ORDER BY id", self.connection, params=(code,))
+
+    def close(self):
+        """
+        Closes the SQLite file.
+        """
+        with self.lock:
+            self.connection.close()
+
+# Reports that are uploaded with live logging keep growing after they are fetched, so a report that is processed
+# isn't always complete. The end time and the fights of every report are saved when it's fetched, and the discovery
+# (which already gives the end time of every report, so it costs no extra API-calls) shows which reports got longer
+# since then. Only the new fights in those reports are fetched, so no rows are added twice.
+
+class ReportSnapshotStore:
+    """
+    Store for the end time and the fight IDs of every report the last time it was fetched, saved in a SQLite file.
+    The fights that were saved to the dataset (not skipped as duplicates) are also kept, for reprocess_dataset().
 
-def make_name_id_death_df(deaths_dataframe: pd.DataFrame, name_id_dataframe: pd.DataFrame) -> pd.DataFrame:
-    """ 
-    Creates a new dataframe where the deaths for each character is summarized and the ID of each character is shown.
+    Reports that were processed before the store was added have no snapshot and are never fetched again.
 
     Args:
-        deaths_dataframe(pd.DataFrame): dataframe with the deaths
-        name_id_dataframe(pd.DataFrame): dataframe with information about the characters name and ID.
-    
-    Returns:
-        df_name_id_deaths(pd.DataFrame): dataframe with the name of the character, it's report ID and number deaths.
+        path (str): Path to the SQLite file.
     """
-    # Counts the deaths in the dataframe
-    death_counts = deaths_dataframe.value_counts()
 
-    # Merges the dataframes
-    df_name_id_deaths = name_id_dataframe.merge(death_counts, how='outer', on='name')
+    def __init__(self, path: str = STATE_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS report_snapshots (
+                                       report_code TEXT PRIMARY KEY,
+                                       end_time INTEGER,
+                                       fight_ids TEXT NOT NULL,
+                                       updated_at REAL NOT NULL)""")
+        # Older versions didn't save the fights that were saved to the dataset, they are NULL (not known).
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(report_snapshots)")]
+        if 'saved_fight_ids' not in columns:
+            self.connection.execute("ALTER TABLE report_snapshots ADD COLUMN saved_fight_ids TEXT")
+        self.connection.commit()
+        rows = self.connection.execute("SELECT report_code, end_time FROM report_snapshots").fetchall()
+        self.end_times = {code: end_time for code, end_time in rows}
+
+    def fight_ids(self, code: str) -> set:
+        """
+        Gets the fights that were in a report the last time it was fetched.
+
+        Args:
+            code (str): The report code.
+
+        Returns:
+            fight_ids (set or None): The fight IDs, None if the report has no snapshot.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT fight_ids FROM report_snapshots WHERE report_code = ?", (code,)).fetchone()
+        return set(json.loads(row[0])) if row is not None else None
+
+    def saved_fight_ids(self, code: str) -> set:
+        """
+        Gets the fights of a report that are in the dataset.
+
+        Args:
+            code (str): The report code.
+
+        Returns:
+            fight_ids (set or None): The fight IDs, None if the report has no snapshot or it's from an older version.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT saved_fight_ids FROM report_snapshots WHERE report_code = ?", (code,)).fetchone()
+        return set(json.loads(row[0])) if row is not None and row[0] is not None else None
+
+    def save(self, code: str, end_time: int, fight_ids: set, saved_fight_ids: set = None):
+        """
+        Saves the end time and the fights of a report after it's fetched.
+
+        Args:
+            code (str): The report code.
+            end_time (int): The end time of the report (UNIX in milliseconds).
+            fight_ids (set): All the fights in the report, also the ones that were skipped as duplicates.
+            saved_fight_ids (set): The fights that are saved to the dataset, None if it isn't known.
+        """
+        saved = json.dumps(sorted(int(fight_id) for fight_id in saved_fight_ids)) if saved_fight_ids is not None else None
+        with self.lock:
+            self.connection.execute("""INSERT OR REPLACE INTO report_snapshots (report_code, end_time, fight_ids, updated_at, saved_fight_ids)
+                                       VALUES (?, ?, ?, ?, ?)""",
+                                    (code, end_time, json.dumps(sorted(int(fight_id) for fight_id in fight_ids)), time.time(), saved))
+            self.connection.commit()
+            self.end_times[code] = end_time
+
+    def changed_reports(self, reports: dict, old_codes) -> list:
+        """
+        Finds the processed reports that got longer since they were fetched.
+
+        Args:
+            reports (dict): code as key and a dict with the endTime as value, from discover_reports().
+            old_codes (ProcessedReportsStore or set): The processed reports.
+
+        Returns:
+            codes (list): The report codes.
+        """
+        changed = []
+        for code, report in reports.items():
+            end_time = self.end_times.get(code)
+            if code in old_codes and end_time is not None and report.get('endTime') is not None and report['endTime'] > end_time:
+                changed.append(code)
+        return sorted(changed)
+
+    def close(self):
+        """
+        Closes the SQLite file.
+        """
+        with self.lock:
+            self.connection.close()
 
-    # Changes NaN to 0
-    df_name_id_deaths = df_name_id_deaths.fillna(0)
+# Functions for managing the data
 
-    # Renames the columns
-    df_name_id_deaths = df_name_id_deaths.rename(columns={'count':'deaths'})
+def weekly_data_to_table(input_data: pd.DataFrame) -> pa.Table:
+    """
+    Converts the dataframe for a report to a PyArrow Table with DATASET_SCHEMA.
+    The data is converted as soon as a report is done, so the rows are never converted to JSON on the way to the dataset.
 
-    # Makes sure the death's columns are ints. 
-    df_name_id_deaths['deaths'] = df_name_id_deaths['deaths'].astype(int)
-    
-    return df_name_id_deaths
+    Args:
+        input_data (dataFrame): dataframe with the data for the report
 
-# Functions for managing report codes
+    Returns:
+        table (pa.Table): The data with the columns and types in DATASET_SCHEMA.
+    """
+    table = pa.Table.from_pandas(input_data, preserve_index=False).combine_chunks()
+    return conform_table(table)
 
-def make_report_codes_query(user_id: int) -> str:
-    """ 
-    Makes the API call to get new codes for the week. 
+def staging_path(code: str) -> str:
+    """
+    Gets the path of the temporary file for a report.
 
     Args:
-        user_id (int): Int for representing the user whom uploaded the reports.
+        code (str): code for a single report as a string
 
     Returns:
-        query (str): String with the query
-    
+        file_path (str): Path to the Arrow IPC file in the raw data folder.
     """
-    query = f"""query PlayerDungeonMetrics{{
-                                            reportData{{
-                                                reports(userID: {user_id}, limit: 100){{                        
-                                                    data{{
-                                                        code
-                                                        title
-                                                        startTime
-                                                        }}
-                                                    }}
-                                                }}
-                                            }}""" 
-    return query
+    return os.path.join(RAW_DATA_DIR, f"{code}.arrow")
+
+# Saves the weekly reports as Arrow IPC files in the raw data folder
 
-def get_report_codes(token: str) -> set:
+def save_weekly_data(code: str, input_data: pd.DataFrame):
     """ 
-    Fetches new codes for the week.
+    Saves data from a report to an Arrow IPC file used for temporary storage.
 
-    Args: 
-        token (str): token for making the api call.
-    
-    Returns:
-        codes (set): a set with report codes.
-    
-    """
-    codes = []
-    user_ids = ['297125', '291792']
+    The file is written under a temporary name and renamed when it's complete,
+    so a crash never leaves a half written file.
+
+    Args:
+        code (str): code for a single report as a string
+        input_data (dataFrame): dataframe with the data for the report
 
-    date = datetime.now()
-    date_UNIX = date.timestamp()
-    date_UNIX_past = date_UNIX - (60*60*24*7)
+    """
+    # Create folder for temporary storage
+    os.makedirs(RAW_DATA_DIR, exist_ok=True)
 
-    for id in user_ids:
+    file_path = staging_path(code)
 
-        report_codes = make_query(token, make_report_codes_query(id))
-        df = pd.json_normalize(report_codes, record_path=['data', 'reportData', 'reports', 'data'])
-        df['startTime'] = df['startTime'] / 1000
-        mask = df['startTime'] > date_UNIX_past
-        filtered_df = df[mask]
-        new_codes = filtered_df['code'].tolist()
-        codes.extend(new_codes)
-    codes = set(codes)    
-    return codes
+    if os.path.exists(file_path):
+        print(f"Arrow file for '{code}' already exists. Overwriting it.")
 
+    table = weekly_data_to_table(input_data)
+    temp_path = file_path + '.tmp'
+    with pa.OSFile(temp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, DATASET_SCHEMA) as writer:
+            writer.write_table(table)
+    os.replace(temp_path, file_path)
 
-def check_codes(new_codes: list, old_codes: set) -> list:
+def read_staged_batches(file_path: str):
     """
-    Compares preivous codes with the new list to check for duplicates.
+    Reads the record batches in a temporary file one at a time.
+    Also reads JSON files from older versions of the program.
 
     Args:
-        new_codes (list): Set with all the new codes as strings.
-        old_codes (list): Set with all the old codes as strings.
-    Returns:
-        new_codes (list): The list with new codes but with duplicates removed.
+        file_path (str): Path to a file in the raw data folder.
+
+    Yields:
+        batch (pa.RecordBatch): The data with DATASET_SCHEMA.
     """
-    set1 = set(new_codes)
-    set2 = set(old_codes)
-    
-    common_codes = set1.intersection(set2)
-    for code in common_codes:
-        if code in new_codes:
-            new_codes.remove(code)
+    if file_path.endswith('.json'):
+        with open(file_path, 'r') as f:
+            data = json.load(f)
+        table = weekly_data_to_table(pd.json_normalize(data['Data']))
+        yield from table.to_batches()
+        return
 
-    return new_codes
+    with pa.memory_map(file_path, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i)
 
-def load_cache_codes() -> set:
+# Dimension tables for the players, dungeons and reports.
+# The files in the dataset only have an int32 key for the player, the dungeon and the report of every row, and the
+# names are saved once in STATE_DB. A player is found by the gameID, a dungeon by the zone id and a report by the code.
+# Rows from older versions without a gameID or zone id are matched on the name instead. When the dataset is read
+# the names are joined back from the keys, so the rows look the same as before.
+
+# The dimension column in DATASET_SCHEMA and the key column in FACT_SCHEMA for every filter in make_dataset_filter().
+KEY_COLUMNS = {column: key for key, columns in DIMENSION_COLUMNS.items() for column in columns}
+
+class DimensionStore:
     """
-    Loads used codes from a cache file.
+    The players, dungeons and reports with their keys, saved in a SQLite file and kept in memory.
+    The name and class of a player and the name of a dungeon are updated to the newest ones that are written.
+    Safe to use from several threads at once.
 
-    Returns:
-        set (set): a set with the old codes.
+    Args:
+        path (str): Path to the SQLite file.
     """
-    if os.path.exists(CACHE_FILE):
-        try:
-            with open(CACHE_FILE, 'r') as f:
-                return list(json.load(f))
-        except (IOError, json.JSONDecodeError) as e:
-            print(f"Error loading cache file: {e}")
-            # Start with an empty cache if there's an error
-            return list()
-    return list()
 
-def save_cache_codes(codes: set):
+    def __init__(self, path: str = STATE_DB):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS dim_players (
+                                       player_key INTEGER PRIMARY KEY AUTOINCREMENT,
+                                       game_id INTEGER UNIQUE,
+                                       name TEXT,
+                                       class TEXT,
+                                       updated_at REAL NOT NULL)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS dim_dungeons (
+                                       dungeon_key INTEGER PRIMARY KEY AUTOINCREMENT,
+                                       zone_id INTEGER UNIQUE,
+                                       name TEXT,
+                                       updated_at REAL NOT NULL)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS dim_reports (
+                                       report_key INTEGER PRIMARY KEY AUTOINCREMENT,
+                                       report_code TEXT UNIQUE NOT NULL,
+                                       added_at REAL NOT NULL)""")
+        self.connection.commit()
+
+        # key -> row, and the lookups from the natural keys to the keys.
+        self.players = {row[0]: row[1:] for row in self.connection.execute("SELECT player_key, game_id, name, class FROM dim_players")}
+        self.dungeons = {row[0]: row[1:] for row in self.connection.execute("SELECT dungeon_key, zone_id, name FROM dim_dungeons")}
+        self.reports = {row[0]: row[1] for row in self.connection.execute("SELECT report_key, report_code FROM dim_reports")}
+        self.player_by_game_id = {game_id: key for key, (game_id, _, _) in self.players.items() if game_id is not None}
+        self.player_by_name = {name: key for key, (game_id, name, _) in self.players.items() if game_id is None}
+        self.dungeon_by_zone_id = {zone_id: key for key, (zone_id, _) in self.dungeons.items() if zone_id is not None}
+        self.dungeon_by_name = {name: key for key, (_, name) in self.dungeons.items()}
+        self.report_by_code = {code: key for key, code in self.reports.items()}
+        self.arrays = None
+
+    def player_key(self, game_id, name, player_class) -> int:
+        """
+        Gets the key for a player, a new key is made if the player is new. Called with the lock held.
+
+        Args:
+            game_id (int): The gameID, 0 or None if it isn't known.
+            name (str): Name of the character.
+            player_class (str): Class of the character.
+
+        Returns:
+            key (int): The key.
+        """
+        game_id = int(game_id) if game_id is not None and game_id > 0 else None
+        key = self.player_by_game_id.get(game_id) if game_id is not None else self.player_by_name.get(name)
+        if key is None:
+            cursor = self.connection.execute("INSERT INTO dim_players (game_id, name, class, updated_at) VALUES (?, ?, ?, ?)",
+                                             (game_id, name, player_class, time.time()))
+            key = cursor.lastrowid
+            self.players[key] = (game_id, name, player_class)
+            if game_id is not None:
+                self.player_by_game_id[game_id] = key
+            else:
+                self.player_by_name[name] = key
+            self.arrays = None
+            return key
+
+        _, old_name, old_class = self.players[key]
+        new_name = name if name is not None else old_name
+        new_class = player_class if player_class is not None else old_class
+        if (new_name, new_class) != (old_name, old_class):
+            self.connection.execute("UPDATE dim_players SET name = ?, class = ?, updated_at = ? WHERE player_key = ?",
+                                    (new_name, new_class, time.time(), key))
+            self.players[key] = (game_id, new_name, new_class)
+            self.arrays = None
+        return key
+
+    def dungeon_key(self, zone_id, name) -> int:
+        """
+        Gets the key for a dungeon, a new key is made if the dungeon is new. Called with the lock held.
+
+        Args:
+            zone_id (int): The zone id, None if it isn't known.
+            name (str): Name of the dungeon.
+
+        Returns:
+            key (int): The key.
+        """
+        zone_id = int(zone_id) if zone_id is not None else None
+        key = self.dungeon_by_zone_id.get(zone_id) if zone_id is not None else None
+        if key is None:
+            key = self.dungeon_by_name.get(name)
+            # A dungeon that is saved with another zone id is a diffrent dungeon with the same name.
+            if key is not None and zone_id is not None and self.dungeons[key][0] is not None:
+                key = None
+        if key is None:
+            cursor = self.connection.execute("INSERT INTO dim_dungeons (zone_id, name, updated_at) VALUES (?, ?, ?)",
+                                             (zone_id, name, time.time()))
+            key = cursor.lastrowid
+            self.dungeons[key] = (zone_id, name)
+            if zone_id is not None:
+                self.dungeon_by_zone_id[zone_id] = key
+            self.dungeon_by_name[name] = key
+            self.arrays = None
+            return key
+
+        # A dungeon from an older version (without a zone id) gets the zone id the first time it's known.
+        old_zone_id, old_name = self.dungeons[key]
+        new_zone_id = zone_id if zone_id is not None else old_zone_id
+        new_name = name if name is not None else old_name
+        if (new_zone_id, new_name) != (old_zone_id, old_name):
+            self.connection.execute("UPDATE dim_dungeons SET zone_id = ?, name = ?, updated_at = ? WHERE dungeon_key = ?",
+                                    (new_zone_id, new_name, time.time(), key))
+            self.dungeons[key] = (new_zone_id, new_name)
+            if new_zone_id is not None:
+                self.dungeon_by_zone_id[new_zone_id] = key
+            self.dungeon_by_name[new_name] = key
+            self.arrays = None
+        return key
+
+    def report_key(self, code: str) -> int:
+        """
+        Gets the key for a report, a new key is made if the report is new. Called with the lock held.
+
+        Args:
+            code (str): The report code.
+
+        Returns:
+            key (int): The key.
+        """
+        key = self.report_by_code.get(code)
+        if key is None:
+            key = self.connection.execute("INSERT INTO dim_reports (report_code, added_at) VALUES (?, ?)", (code, time.time())).lastrowid
+            self.reports[key] = code
+            self.report_by_code[code] = key
+            self.arrays = None
+        return key
+
+    def encode(self, table: pa.Table) -> pa.Table:
+        """
+        Replaces the players, dungeons and reports in a table with their keys.
+        Every diffrent player, dungeon and report in the table is only looked up once.
+
+        Args:
+            table (pa.Table): Data with DATASET_SCHEMA (other columns are removed).
+
+        Returns:
+            table (pa.Table): The data with FACT_SCHEMA.
+        """
+        table = conform_table(table)
+        names = [name for columns in DIMENSION_COLUMNS.values() for name in columns]
+        df = table.select(names).to_pandas().astype(object)
+        df = df.where(df.notna(), None)
+
+        # Number the diffrent players, dungeons and reports in the order they are first seen, then every row
+        # gets the key of its group.
+        dimensions = {'playerKey': ['gameID', 'name', 'class'], 'dungeonKey': ['zoneID', 'DungeonName'], 'reportKey': ['reportCode']}
+        groups = {key: df.groupby(columns, dropna=False, sort=False) for key, columns in dimensions.items()}
+        first_rows = {key: group.head(1)[dimensions[key]].itertuples(index=False) for key, group in groups.items()}
+        with self.lock:
+            keys = {'playerKey': [self.player_key(*row) for row in first_rows['playerKey']],
+                    'dungeonKey': [self.dungeon_key(*row) for row in first_rows['dungeonKey']],
+                    'reportKey': [self.report_key(*row) for row in first_rows['reportKey']]}
+            self.connection.commit()
+
+        columns = {name: np.asarray(keys[name], dtype=np.int32)[group.ngroup().to_numpy()] for name, group in groups.items()}
+        arrays = []
+        for field in FACT_SCHEMA:
+            if field.name in columns:
+                arrays.append(pa.array(columns[field.name], type=field.type))
+            else:
+                arrays.append(table.column(field.name))
+        return pa.Table.from_arrays(arrays, schema=FACT_SCHEMA)
+
+    def lookup_arrays(self) -> dict:
+        """
+        Gets the columns of the dimension tables as arrays where the position is the key, used for joining the names back.
+
+        Returns:
+            arrays (dict): Column name in DATASET_SCHEMA -> the array.
+        """
+        with self.lock:
+            if self.arrays is None:
+                players = [(None, None, None)] * (max(self.players, default=0) + 1)
+                for key, row in self.players.items():
+                    players[key] = row
+                dungeons = [(None, None)] * (max(self.dungeons, default=0) + 1)
+                for key, row in self.dungeons.items():
+                    dungeons[key] = row
+                reports = [None] * (max(self.reports, default=0) + 1)
+                for key, code in self.reports.items():
+                    reports[key] = code
+                self.arrays = {'gameID': pa.array([row[0] or 0 for row in players], type=pa.int64()),
+                               'name': pa.array([row[1] for row in players], type=pa.string()),
+                               'class': pa.array([row[2] for row in players], type=pa.string()),
+                               'zoneID': pa.array([row[0] for row in dungeons], type=pa.int32()),
+                               'DungeonName': pa.array([row[1] for row in dungeons], type=pa.string()),
+                               'reportCode': pa.array(reports, type=pa.string())}
+            return self.arrays
+
+    def decode(self, table: pa.Table, columns: list = None) -> pa.Table:
+        """
+        Joins the players, dungeons and reports back to a table with keys.
+
+        Args:
+            table (pa.Table): Data with (some of) the columns in FACT_SCHEMA, and maybe partition columns.
+            columns (list): The columns to give back, all the columns in DATASET_SCHEMA and the partition columns if None.
+
+        Returns:
+            table (pa.Table): The data with the columns in DATASET_SCHEMA (in the same order) and then the partition columns.
+        """
+        if isinstance(table, pa.RecordBatch):
+            table = pa.Table.from_batches([table])
+        arrays = self.lookup_arrays()
+        partition_names = [name for name in table.column_names if name not in FACT_SCHEMA.names]
+        if columns is None:
+            columns = [name for name in DATASET_SCHEMA.names if name in table.column_names or KEY_COLUMNS.get(name) in table.column_names]
+            columns += partition_names
+
+        result = []
+        for name in columns:
+            if name in KEY_COLUMNS:
+                column = pc.take(arrays[name], table.column(KEY_COLUMNS[name]))
+                field = DATASET_SCHEMA.field(name)
+                column = pc.dictionary_encode(column).cast(field.type) if pa.types.is_dictionary(field.type) else column.cast(field.type)
+            else:
+                column = table.column(name)
+            result.append(column)
+        return pa.Table.from_arrays(result, names=columns)
+
+    def find_keys(self, column: str, values: list) -> list:
+        """
+        Gets the keys of the rows in a dimension table where a column has one of the values.
+
+        Args:
+            column (str): A column in DIMENSION_COLUMNS (example: 'name').
+            values (list): The values.
+
+        Returns:
+            keys (list): The keys.
+        """
+        if column == 'reportCode':
+            with self.lock:
+                return [self.report_by_code[code] for code in set(values) if code in self.report_by_code]
+        # The lookup arrays have the key as position, so the positions of the matching values are the keys.
+        # Position 0 and the keys that were never used are empty rows.
+        array = self.lookup_arrays()[column]
+        keys = pc.indices_nonzero(pc.is_in(array, value_set=pa.array(list(set(values)), type=array.type))).to_pylist()
+        rows = self.players if KEY_COLUMNS[column] == 'playerKey' else self.dungeons
+        return [key for key in keys if key in rows]
+
+    def export(self, path: str = DIMENSIONS_DIR):
+        """
+        Saves the dimension tables as parquet files (players.parquet, dungeons.parquet and reports.parquet),
+        so they can be joined with the dataset in other programs.
+
+        Args:
+            path (str): Path to the folder.
+        """
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            tables = {
+                'players': pa.table({'playerKey': pa.array(list(self.players), type=pa.int32()),
+                                     'gameID': pa.array([row[0] for row in self.players.values()], type=pa.int64()),
+                                     'name': pa.array([row[1] for row in self.players.values()], type=pa.string()),
+                                     'class': pa.array([row[2] for row in self.players.values()], type=pa.string())}),
+                'dungeons': pa.table({'dungeonKey': pa.array(list(self.dungeons), type=pa.int32()),
+                                      'zoneID': pa.array([row[0] for row in self.dungeons.values()], type=pa.int32()),
+                                      'DungeonName': pa.array([row[1] for row in self.dungeons.values()], type=pa.string())}),
+                'reports': pa.table({'reportKey': pa.array(list(self.reports), type=pa.int32()),
+                                     'reportCode': pa.array(list(self.reports.values()), type=pa.string())})}
+        for name, table in tables.items():
+            file_path = os.path.join(path, f"{name}.parquet")
+            pq.write_table(table, file_path + '.tmp')
+            os.replace(file_path + '.tmp', file_path)
+
+    def close(self):
+        """
+        Closes the connection to the SQLite file.
+        """
+        with self.lock:
+            self.connection.close()
+
+@contextlib.contextmanager
+def open_dimensions(dimensions: DimensionStore = None):
     """
-    Saves used codes to a cache file.
+    Gives the dimension tables, use as 'with open_dimensions(dimensions) as dimensions:'.
 
     Args:
-        codes (list): a list with all codes.
+        dimensions (DimensionStore): The dimension tables, they are opened from STATE_DB (and closed after) if None.
     """
-    codes_as_list = list(codes)
+    if dimensions is not None:
+        yield dimensions
+        return
+    dimensions = DimensionStore(STATE_DB)
     try:
-        with open(CACHE_FILE, 'w') as f:
-            json.dump(codes_as_list, f, indent=4)
-    except IOError as e:
-        print(f"Error saving cache file: {e}")
+        yield dimensions
+    finally:
+        dimensions.close()
 
-# Functions for managing the data
+# Functions for splitting the dataset into folders (partitions).
+# The folders are named after the fight and not the day the program was run, so a query for a time period
+# or a dungeon only has to open the folders for that period or dungeon.
 
-# Saves the weekly reports as JSON in the raw data folder
+def dungeon_slug(dungeon_name: str) -> str:
+    """
+    Makes a folder name from the name of a dungeon (example: 'Ara-Kara, City of Echoes' -> 'ara-kara-city-of-echoes').
 
-def save_weekly_data(code: str, input_data: pd.DataFrame):
-    """ 
-    Saves data from a report to a JSON file used for temporary storage.
+    Args:
+        dungeon_name (str): Name of the dungeon.
+
+    Returns:
+        slug (str): The name in lower case with only letters, numbers and '-'.
+    """
+    if dungeon_name is None:
+        return 'unknown'
+    slug = re.sub(r'[^a-z0-9]+', '-', dungeon_name.lower()).strip('-')
+    return slug or 'unknown'
+
+def partition_values(table: pa.Table, key: str) -> pa.Array:
+    """
+    Gets the partition value for every row in a table.
 
     Args:
-        code (str): code for a single report as a string
-        input_data (dataFrame): dataframe with the data for the report
+        table (pa.Table): Data with DATASET_SCHEMA (and runDate if the data is already in the dataset).
+        key (str): One of PARTITION_KEYS.
 
+    Returns:
+        values (pa.Array): The folder name for every row, 'unknown' if the row doesn't have the value.
     """
-    # Create folder for temporary storage
-    if not os.path.exists(RAW_DATA_DIR):
-        os.makedirs(RAW_DATA_DIR)
+    if key == 'fightWeek':
+        values = pc.strftime(table.column('StartTime'), format='%G-W%V')
+    elif key == 'fightMonth':
+        values = pc.strftime(table.column('StartTime'), format='%Y-%m')
+    elif key == 'dungeon':
+        # Every dungeon name is only converted once.
+        names = pc.dictionary_encode(table.column('DungeonName').cast(pa.string())).combine_chunks()
+        slugs = pa.array([dungeon_slug(name) for name in names.dictionary.to_pylist()], type=pa.string())
+        values = pc.take(slugs, names.indices)
+    elif key == 'runDate':
+        # Data that is already in the dataset keeps the day it was added.
+        today = datetime.now().strftime('%Y-%m-%d')
+        if 'runDate' in table.column_names:
+            values = table.column('runDate').cast(pa.string())
+        else:
+            values = pa.nulls(table.num_rows, type=pa.string())
+        values = pc.fill_null(values, today)
+    else:
+        raise ValueError(f"Unknown partition key '{key}', use one of {PARTITION_KEYS}")
 
-    file_path = os.path.join(RAW_DATA_DIR, f"{code}.json")
+    if isinstance(values, pa.ChunkedArray):
+        values = values.combine_chunks()
+    return pc.fill_null(values, 'unknown')
 
-    if os.path.exists(file_path):
-        print(f"JSON file for '{code}' already exists. Skipping API call.")    
+def split_by_partition(table: pa.Table, partition_by: tuple) -> dict:
+    """
+    Splits a table into one table for every partition folder.
 
-    # Converts the data to a list for JSON storage. Since the dataframe contains datetime data
-    # we use json_string to conserve it. 
-    json_string = input_data.to_json(orient='records', date_format='iso')
-    data_list = json.loads(json_string)
+    Args:
+        table (pa.Table): Data with DATASET_SCHEMA.
+        partition_by (tuple): The partition keys, example: ('fightWeek', 'dungeon').
 
-    data = {"report_code": code, "Data": data_list}
-    with open(file_path, 'w') as f:
-        json.dump(data, f)
+    Returns:
+        partitions (dict): Folder (example: 'fightWeek=2025-W38/dungeon=the-stonevault') -> the rows in that folder.
+    """
+    if not partition_by:
+        return {'': table}
+
+    folders = None
+    for key in partition_by:
+        folder = pc.binary_join_element_wise(key, partition_values(table, key), '=')
+        folders = folder if folders is None else pc.binary_join_element_wise(folders, folder, '/')
+
+    partitions = {}
+    for folder in pc.unique(folders).to_pylist():
+        partitions[folder] = table.filter(pc.equal(folders, folder))
+    return partitions
+
+# Key index for looking up players and reports.
+# "All runs for a player" and "everything in a report" are the most common queries. For every file that is written
+# the keys in KEY_INDEX_COLUMNS are saved with the row groups they are in, so these queries only open those row groups.
+# Every run saves its own index file in KEY_INDEX_DIR, and compacting the dataset replaces them with one file.
+# Files that are not in the index (written by older versions) are still read with the filter.
+
+def bloom_filter_options(row_group_rows: int) -> dict:
+    """
+    Gets the bloom filter settings for the parquet writer. pyarrow doesn't use the bloom filters when reading,
+    but other programs (like DuckDB or Spark) use them to skip the row groups that don't have a key.
 
+    Args:
+        row_group_rows (int): Number of rows in each row group, used as the number of diffrent values.
 
-def append_weekly_data_to_dataset():
-    """ 
-    Takes the JSON-files in the temporary folder and appends to a parquet dataset.
+    Returns:
+        options (dict): Column -> settings, for bloom_filter_options in pq.ParquetWriter.
     """
-    #Empty list to which we append data
-    all_data = []
+    return {column: {'ndv': row_group_rows, 'fpp': BLOOM_FILTER_FPP} for column in KEY_INDEX_COLUMNS}
 
-    # Check so there is data
-    if not os.path.exists(RAW_DATA_DIR):
-        print("Weekly raw data directory does not exist. No new data to append.")
-        return
-    
-    for filename in os.listdir(RAW_DATA_DIR):
-        if filename.endswith('.json'):
-            file_path = os.path.join(RAW_DATA_DIR, filename)
-            with open(file_path, 'r') as f:
-                all_data.append(json.load(f))
+def key_index_rows(table: pa.Table, file_name: str, row_group: int) -> pa.Table:
+    """
+    Makes the index rows for one row group.
 
-    if not all_data:
-        print("No new data to append")
-        return
-    
-    # Cleaning the data so it's easer to handle when opening it in the future.
-    df_new = pd.DataFrame(all_data)
-    df_exploded = df_new.explode('Data')
-    df_final = pd.json_normalize(df_exploded['Data'])
+    Args:
+        table (pa.Table): The rows in the row group, with FACT_SCHEMA.
+        file_name (str): Path of the file from the dataset folder (example: 'fightWeek=2025-W38/part-0.parquet').
+        row_group (int): Number of the row group in the file.
+
+    Returns:
+        rows (pa.Table): The index rows, with KEY_INDEX_SCHEMA.
+    """
+    tables = []
+    for column in KEY_INDEX_COLUMNS:
+        keys = pc.unique(table.column(column)).drop_null()
+        tables.append(pa.table({'column': pa.array([column] * len(keys), type=pa.string()),
+                                'key': keys,
+                                'file': pa.array([file_name] * len(keys), type=pa.string()),
+                                'rowGroup': pa.array([row_group] * len(keys), type=pa.int32())}))
+    return conform_table(pa.concat_tables(tables), KEY_INDEX_SCHEMA)
+
+def write_key_index(path: str, name: str, rows: list, file_names: list):
+    """
+    Saves the index for some files in the dataset.
+
+    Args:
+        path (str): Path to the dataset folder.
+        name (str): Name of the index file, the name of the run that wrote the files.
+        rows (list): Tables from key_index_rows().
+        file_names (list): The files the index is for, from the dataset folder.
+    """
+    table = pa.concat_tables(rows) if rows else KEY_INDEX_SCHEMA.empty_table()
+    # Sorted by key, so the statistics of the row groups in the index can be used to find a key.
+    table = sort_table(table, ['column', 'key'])
+    table = table.replace_schema_metadata({KEY_INDEX_FILES_KEY: json.dumps(file_names).encode()})
+
+    folder = os.path.join(path, KEY_INDEX_DIR)
+    os.makedirs(folder, exist_ok=True)
+    temp_path = os.path.join(folder, f".{name}.parquet.tmp")
+    pq.write_table(table, temp_path, row_group_size=KEY_INDEX_ROW_GROUP_ROWS)
+    os.replace(temp_path, os.path.join(folder, f"{name}.parquet"))
+
+def read_key_index(path: str, keys: dict) -> tuple:
+    """
+    Finds the row groups that have the keys.
+
+    Args:
+        path (str): Path to the dataset folder.
+        keys (dict): Column in KEY_INDEX_COLUMNS -> the keys to look for. With more than one column, a row group
+                     must have one of the keys for every column.
+
+    Returns:
+        indexed_files (set): The files in the index, from the dataset folder. Other files have to be read with the filter.
+        row_groups (dict): File -> the row groups with the keys, files without the keys are left out.
+    """
+    folder = os.path.join(path, KEY_INDEX_DIR)
+    if not os.path.isdir(folder):
+        return set(), {}
+    index_paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith('.parquet')]
+    if not index_paths:
+        return set(), {}
+
+    indexed_files = set()
+    for index_path in index_paths:
+        indexed_files.update(json.loads(pq.read_schema(index_path).metadata[KEY_INDEX_FILES_KEY]))
+
+    index = ds.dataset(index_paths, schema=KEY_INDEX_SCHEMA, format='parquet')
+    matches = None
+    for column, column_keys in keys.items():
+        condition = (ds.field('column') == column) & ds.field('key').isin(pa.array(list(column_keys), type=pa.int32()))
+        rows = index.to_table(columns=['file', 'rowGroup'], filter=condition)
+        found = set(zip(rows.column('file').to_pylist(), rows.column('rowGroup').to_pylist()))
+        matches = found if matches is None else matches & found
+
+    row_groups = {}
+    for file_name, row_group in sorted(matches or ()):
+        row_groups.setdefault(file_name, []).append(row_group)
+    return indexed_files, row_groups
+
+def select_row_groups(dataset: ds.Dataset, path: str, indexed_files: set, row_groups: dict) -> ds.Dataset:
+    """
+    Keeps only the row groups that were found in the key index. Files that are not in the index are kept whole.
+
+    Args:
+        dataset (ds.Dataset): The dataset from open_dataset().
+        path (str): Path to the dataset folder.
+        indexed_files (set): The files in the index, from read_key_index().
+        row_groups (dict): File -> the row groups to keep, from read_key_index().
 
-    # Add a column to the data for indicating when it was added to the dataset. 
-    current_date = datetime.now().strftime('%Y-%m-%d')
-    df_final['runDate'] = current_date
-    print(f"Loaded {len(df_new)} new reports into a DataFrame.")
+    Returns:
+        dataset (ds.Dataset): The dataset with only those row groups.
+    """
+    fragments = []
+    for fragment in dataset.get_fragments():
+        file_name = os.path.relpath(fragment.path, path).replace(os.sep, '/')
+        if file_name not in indexed_files:
+            fragments.append(fragment)
+        elif file_name in row_groups:
+            fragments.append(fragment.subset(row_group_ids=row_groups[file_name]))
+    return ds.FileSystemDataset(fragments, dataset.schema, dataset.format, dataset.filesystem)
+
+class DatasetWriter:
+    """
+    Writes record batches to the parquet dataset, split into the partition folders.
+
+    Every run writes new files with a unique name (part-<time>-<random>.parquet), so running the program twice
+    on the same day never overwrites the data from the first run. The rows for every partition are collected until
+    there are row_group_rows of them and are then written as one row group, and a new file is started when a file
+    has max_file_rows rows. At most a few row groups are kept in memory, no matter how much data is written.
+    The files are written under a temporary name and renamed when close() is called.
+
+    The rows are given with DATASET_SCHEMA and saved with FACT_SCHEMA, the players, dungeons and reports are
+    replaced by their keys in the dimension tables. Other data (EVENT_SCHEMA) is saved as it is.
+    With FACT_SCHEMA every row group is sorted by SORT_BY and has bloom filters for the player and report keys,
+    and the key index for the new files is saved when close() is called.
+    """
 
-    # Convert the pandas DataFrame to a PyArrow Table
-    table_new = pa.Table.from_pandas(df_final)
+    def __init__(self, path: str = PROCESSED_DATA_DIR, partition_by: tuple = PARTITION_SCHEME,
+                 row_group_rows: int = INGEST_ROW_GROUP_ROWS, max_file_rows: int = INGEST_MAX_FILE_ROWS,
+                 schema: pa.Schema = FACT_SCHEMA, dimensions: DimensionStore = None):
+        """
+        Args:
+            path (str): Path to the dataset folder.
+            partition_by (tuple): The partition keys, see PARTITION_KEYS.
+            row_group_rows (int): Number of rows in each row group.
+            max_file_rows (int): Max number of rows in a file.
+            schema (pa.Schema): The schema of the files, FACT_SCHEMA or EVENT_SCHEMA.
+            dimensions (DimensionStore): The dimension tables, needed for FACT_SCHEMA.
+        """
+        if schema is FACT_SCHEMA and dimensions is None:
+            raise ValueError("The dimension tables are needed for writing the dataset")
+        self.path = path
+        self.schema = schema
+        self.dimensions = dimensions
+        self.partition_by = tuple(partition_by)
+        self.row_group_rows = row_group_rows
+        self.max_file_rows = max_file_rows
+        self.run_name = f"part-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.writers = {}
+        self.buffers = {}
+        self.buffered_rows = {}
+        self.file_numbers = {}
+        self.finished_files = []
+        self.index_rows = []
+        self.number_of_rows = 0
+        self.number_of_row_groups = 0
+
+    def write_table(self, table: pa.Table):
+        """
+        Writes a table, every partition in the table goes to the file in its folder.
+
+        Args:
+            table (pa.Table): Data with DATASET_SCHEMA, or EVENT_SCHEMA if that's the schema of the writer.
+        """
+        for folder, rows in split_by_partition(table, self.partition_by).items():
+            if self.schema is FACT_SCHEMA:
+                rows = self.dimensions.encode(rows)
+            self.buffers.setdefault(folder, []).append(rows)
+            self.buffered_rows[folder] = self.buffered_rows.get(folder, 0) + rows.num_rows
+            self.number_of_rows += rows.num_rows
+            if self.buffered_rows[folder] >= self.row_group_rows:
+                self.flush(folder)
+
+        # When the rows are spread over many partitions, the biggest buffers are written early to keep the memory bounded.
+        while sum(self.buffered_rows.values()) > self.row_group_rows * INGEST_MAX_BUFFERED_ROW_GROUPS:
+            self.flush(max(self.buffered_rows, key=self.buffered_rows.get))
+
+    def write_batch(self, batch: pa.RecordBatch):
+        """
+        Writes a record batch, see write_table().
+
+        Args:
+            batch (pa.RecordBatch): Data with DATASET_SCHEMA, or EVENT_SCHEMA if that's the schema of the writer.
+        """
+        self.write_table(pa.Table.from_batches([batch]))
+
+    def flush(self, folder: str):
+        """
+        Writes the collected rows for a partition as a row group.
+
+        Args:
+            folder (str): The partition folder.
+        """
+        if not self.buffered_rows.get(folder):
+            return
+        table = pa.concat_tables(self.buffers.pop(folder))
+        del self.buffered_rows[folder]
+
+        if folder not in self.writers:
+            folder_path = os.path.join(self.path, folder)
+            os.makedirs(folder_path, exist_ok=True)
+            number = self.file_numbers.get(folder, 0)
+            self.file_numbers[folder] = number + 1
+            file_name = f"{self.run_name}.parquet" if number == 0 else f"{self.run_name}-{number}.parquet"
+            # Files starting with '.' are not read by pyarrow, so a crash never leaves a broken file in the dataset.
+            temp_path = os.path.join(folder_path, f".{file_name}.tmp")
+            options = {'bloom_filter_options': bloom_filter_options(self.row_group_rows)} if self.schema is FACT_SCHEMA else {}
+            self.writers[folder] = [pq.ParquetWriter(temp_path, self.schema, **options), temp_path,
+                                    os.path.join(folder_path, file_name), 0, 0]
+
+        writer = self.writers[folder]
+        if self.schema is FACT_SCHEMA:
+            table = sort_table(table, list(SORT_BY))
+        file_name = os.path.relpath(writer[2], self.path).replace(os.sep, '/')
+        # One row group at a time, so the index knows the number of the row group every key is in.
+        for offset in range(0, table.num_rows, self.row_group_rows):
+            rows = table.slice(offset, self.row_group_rows)
+            writer[0].write_table(rows, row_group_size=self.row_group_rows)
+            if self.schema is FACT_SCHEMA:
+                self.index_rows.append(key_index_rows(rows, file_name, writer[4]))
+            writer[4] += 1
+            self.number_of_row_groups += 1
+        writer[3] += table.num_rows
+        if writer[3] >= self.max_file_rows:
+            self.finish_file(folder)
+
+    def finish_file(self, folder: str):
+        """
+        Closes the file for a partition, the next rows for the partition go to a new file.
+
+        Args:
+            folder (str): The partition folder.
+        """
+        writer, temp_path, file_path, _, _ = self.writers.pop(folder)
+        writer.close()
+        self.finished_files.append((temp_path, file_path))
+
+    def close(self) -> list:
+        """
+        Writes the rows that are left, closes the files and gives them their real names.
+
+        Returns:
+            file_paths (list): The files that were written.
+        """
+        for folder in list(self.buffers):
+            self.flush(folder)
+        for folder in list(self.writers):
+            self.finish_file(folder)
+
+        # The files are renamed last, so a crash before this never leaves part of the data in the dataset.
+        file_paths = []
+        for temp_path, file_path in self.finished_files:
+            os.replace(temp_path, file_path)
+            file_paths.append(file_path)
+        self.finished_files = []
+
+        # A crash before the index is saved only means the new files are read without it.
+        if self.schema is FACT_SCHEMA and file_paths:
+            file_names = [os.path.relpath(file_path, self.path).replace(os.sep, '/') for file_path in file_paths]
+            write_key_index(self.path, self.run_name, self.index_rows, file_names)
+        self.index_rows = []
+
+        # The summary file from the last compaction doesn't know about the new files.
+        if file_paths and os.path.exists(os.path.join(self.path, '_metadata')):
+            os.remove(os.path.join(self.path, '_metadata'))
+        return file_paths
+
+    def abort(self):
+        """
+        Closes the files and removes them without adding anything to the dataset, used when the writing fails.
+        """
+        for folder in list(self.writers):
+            self.finish_file(folder)
+        for temp_path, _ in self.finished_files:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.finished_files = []
+        self.buffers = {}
+        self.buffered_rows = {}
+        self.index_rows = []
+
+def peak_memory() -> dict:
+    """
+    Gets the most memory the program has used so far.
+
+    Returns:
+        memory (dict): max_rss_mb (the whole process, None if it can't be measured on this system)
+                       and arrow_peak_mb (the memory used by pyarrow).
+    """
+    max_rss_mb = None
+    if resource is not None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux gives kilobytes and macOS gives bytes.
+        max_rss_mb = max_rss / 1e6 if sys.platform == 'darwin' else max_rss / 1e3
+    return {'max_rss_mb': max_rss_mb, 'arrow_peak_mb': pa.default_memory_pool().max_memory() / 1e6}
+
+def append_weekly_data_to_dataset(partition_by: tuple = PARTITION_SCHEME, row_group_rows: int = INGEST_ROW_GROUP_ROWS,
+                                   max_file_rows: int = INGEST_MAX_FILE_ROWS, dimensions: DimensionStore = None):
+    """ 
+    Takes the files in the temporary folder and appends them to the parquet dataset.
+
+    The files are streamed one batch at a time into the partition folders, and at most
+    INGEST_MAX_BUFFERED_ROW_GROUPS row groups are kept in memory, so the memory doesn't grow with
+    the number of reports. The peak memory is printed and saved in the run summary.
+
+    Args:
+        partition_by (tuple): The partition keys, see PARTITION_KEYS.
+        row_group_rows (int): Number of rows in each row group.
+        max_file_rows (int): Max number of rows in a file, a new file is started after that.
+        dimensions (DimensionStore): The dimension tables, opened from STATE_DB if None.
+
+    Returns:
+        file_paths (list): The new parquet files, empty if there was no new data.
+    """
+    # Check so there is data
+    if not os.path.exists(RAW_DATA_DIR):
+        print("Weekly raw data directory does not exist. No new data to append.")
+        return []
+
+    file_names = sorted(filename for filename in os.listdir(RAW_DATA_DIR) if filename.endswith(('.arrow', '.json')))
+    if not file_names:
+        print("No new data to append")
+        return []
 
     # Append the new data to the Parquet dataset
     print(f"Appending new data to the '{PROCESSED_DATA_DIR}' dataset...")
-    pq.write_to_dataset(table_new, PROCESSED_DATA_DIR,
-                        partition_cols=['runDate'],
-                        basename_template='part-{i}.parquet')
-    
+    with metrics.stage('parquet_write'), open_dimensions(dimensions) as dimensions:
+        writer = DatasetWriter(PROCESSED_DATA_DIR, partition_by, row_group_rows, max_file_rows, dimensions=dimensions)
+        for filename in file_names:
+            for batch in read_staged_batches(os.path.join(RAW_DATA_DIR, filename)):
+                writer.write_batch(batch)
+        file_paths = writer.close()
+        dimensions.export(DIMENSIONS_DIR)
+    metrics.count('rows_appended', writer.number_of_rows)
+    metrics.count('row_groups_appended', writer.number_of_row_groups)
+
+    memory = peak_memory()
+    for name, value in memory.items():
+        if value is not None:
+            metrics.gauge_max(name, value)
+
+    print(f"Appended {writer.number_of_rows} rows from {len(file_names)} new reports "
+          f"({writer.number_of_row_groups} row groups in {len(file_paths)} files).")
+    max_rss = f"{memory['max_rss_mb']:.0f} MB" if memory['max_rss_mb'] is not None else "unknown"
+    print(f"Peak memory: {max_rss} for the process, {memory['arrow_peak_mb']:.0f} MB used by pyarrow.")
+    logger.info(f"Appended {writer.number_of_rows} rows in {writer.number_of_row_groups} row groups, peak memory {max_rss}")
     print("New data successfully appended to the Parquet dataset.")
 
-    # Clean up the weekly JSON files
+    # Clean up the weekly files
     for filename in os.listdir(RAW_DATA_DIR):
         os.remove(os.path.join(RAW_DATA_DIR, filename))
     os.rmdir(RAW_DATA_DIR)
     print("Cleaned up weekly raw data directory.")
+    return file_paths
+
+def sort_table(table: pa.Table, sort_by: list) -> pa.Table:
+    """
+    Sorts a table. Dictionary-encoded columns are sorted by their strings.
+
+    Args:
+        table (pa.Table): The table to sort.
+        sort_by (list): The columns to sort by, in order.
 
+    Returns:
+        table (pa.Table): The sorted table.
+    """
+    # pyarrow can't sort dictionary columns directly, so the sort order is found with the decoded strings.
+    keys = {}
+    for column in sort_by:
+        values = table.column(column)
+        if pa.types.is_dictionary(values.type):
+            values = values.cast(values.type.value_type)
+        keys[column] = values
+    indices = pc.sort_indices(pa.table(keys), sort_keys=[(column, 'ascending') for column in sort_by])
+    return table.take(indices)
+
+def recover_dataset(path: str = PROCESSED_DATA_DIR) -> None:
+    """
+    Finishes or undoes a swap of the dataset folder that was stopped by a crash, see swap_dataset().
+
+    A complete new dataset waits in '<path>.new' and the old one is moved to '<path>.old' before it's removed.
+    If the new dataset is there the swap is finished. If only the old dataset is left, it's put back.
+    A '<path>.old' next to a complete dataset is removed.
 
-def look_at_dataset():
+    Args:
+        path (str): Path to the dataset folder.
+    """
+    ready_path = path + '.new'
+    old_path = path + '.old'
+    if os.path.exists(ready_path):
+        if os.path.exists(path):
+            if os.path.exists(old_path):
+                shutil.rmtree(old_path)
+            os.replace(path, old_path)
+        os.replace(ready_path, path)
+        logger.info(f"Moved the new dataset to '{path}'")
+    if os.path.exists(old_path):
+        if os.path.exists(path):
+            shutil.rmtree(old_path)
+        else:
+            os.replace(old_path, path)
+            logger.info(f"Restored the old dataset to '{path}' after a stopped swap")
+
+def swap_dataset(path: str, new_path: str) -> None:
+    """
+    Replaces the dataset at path with the complete dataset at new_path.
+
+    Every step is a single rename, so a crash in the middle always leaves a complete dataset in '<path>',
+    '<path>.new' or '<path>.old'. recover_dataset() finishes the swap the next time the program starts.
+
+    Args:
+        path (str): Path to the dataset folder.
+        new_path (str): Path to the new dataset folder.
+    """
+    recover_dataset(path)
+    os.replace(new_path, path + '.new')
+    recover_dataset(path)
+
+def compact_dataset(path: str = PROCESSED_DATA_DIR, partition_by: tuple = PARTITION_SCHEME,
+                    row_group_rows: int = COMPACT_ROW_GROUP_ROWS, dimensions: DimensionStore = None) -> int:
+    """
+    Merges the small files in the dataset into one file per partition folder.
+
+    Every weekly run adds new small files. Compacting the dataset rewrites it with the partition keys in partition_by,
+    sorted by player key and start time, with row groups of row_group_rows rows. The sorting makes the statistics of
+    each row group small, so a query for a player only reads a few row groups. A _metadata file with the
+    statistics for all the files is also written, and the key index files from every run are replaced by one file.
+
+    The new dataset is built in a separate folder and only replaces the old one when it's complete.
+    Files from older versions of the program are converted to FACT_SCHEMA.
+
+    Args:
+        path (str): Path to the dataset folder.
+        partition_by (tuple): The partition keys, see PARTITION_KEYS.
+        row_group_rows (int): Number of rows in each row group.
+        dimensions (DimensionStore): The dimension tables, opened from STATE_DB if None.
+
+    Returns:
+        number_of_files (int): Number of files in the compacted dataset.
+    """
+    recover_dataset(path)
+    if not os.path.exists(path):
+        print(f"There is no dataset at '{path}'")
+        return 0
+
+    new_path = path + '.compacting'
+    staging_dir = path + '.staging'
+    for folder in (new_path, staging_dir):
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+    os.makedirs(staging_dir)
+
+    with open_dimensions(dimensions) as dimensions:
+        # Pass 1: the old files are read one batch at a time and the rows are sorted into an Arrow file for every new partition.
+        # The names are joined back first, since the partition folders can depend on them (example: dungeon).
+        dataset, legacy_fragments = open_dataset(path)
+        tables = (read_dataset_file(fragment) for fragment in legacy_fragments)
+        if dataset is not None:
+            tables = (table for source in (tables, (dimensions.decode(batch) for batch in dataset.to_batches()))
+                      for table in source)
+
+        staging_files = {}
+        number_of_old_files = len(legacy_fragments) + (len(dataset.files) if dataset is not None else 0)
+        try:
+            for table in tables:
+                for folder, rows in split_by_partition(table, partition_by).items():
+                    if folder not in staging_files:
+                        sink = pa.OSFile(os.path.join(staging_dir, f"{len(staging_files)}.arrows"), 'wb')
+                        staging_files[folder] = (sink, pa.ipc.new_stream(sink, FACT_SCHEMA))
+                    staging_files[folder][1].write_table(dimensions.encode(rows))
+        finally:
+            for sink, writer in staging_files.values():
+                writer.close()
+                sink.close()
+        dimensions.export(DIMENSIONS_DIR)
+
+    # Pass 2: one partition at a time is sorted and written as a single file.
+    metadata_collector = []
+    index_rows = []
+    file_names = []
+    for i, folder in enumerate(staging_files):
+        staging_file = os.path.join(staging_dir, f"{i}.arrows")
+        with pa.memory_map(staging_file, 'r') as source:
+            table = pa.ipc.open_stream(source).read_all()
+        table = sort_table(table, list(SORT_BY))
+
+        folder_path = os.path.join(new_path, folder)
+        os.makedirs(folder_path, exist_ok=True)
+        file_name = os.path.join(folder, 'part-0.parquet').replace(os.sep, '/').lstrip('/')
+        file_metadata = []
+        pq.write_table(table, os.path.join(folder_path, 'part-0.parquet'), row_group_size=row_group_rows,
+                       bloom_filter_options=bloom_filter_options(row_group_rows), metadata_collector=file_metadata)
+        file_metadata[0].set_file_path(file_name)
+        metadata_collector.extend(file_metadata)
+        file_names.append(file_name)
+        for row_group, offset in enumerate(range(0, table.num_rows, row_group_rows)):
+            index_rows.append(key_index_rows(table.slice(offset, row_group_rows), file_name, row_group))
+        os.remove(staging_file)
+    shutil.rmtree(staging_dir)
+
+    # Summary files with the schema and the statistics of every row group in the dataset.
+    os.makedirs(new_path, exist_ok=True)
+    pq.write_metadata(FACT_SCHEMA, os.path.join(new_path, '_common_metadata'))
+    pq.write_metadata(FACT_SCHEMA, os.path.join(new_path, '_metadata'), metadata_collector=metadata_collector)
+    write_key_index(new_path, 'compacted', index_rows, file_names)
+
+    # Swap the folders, the old dataset is only removed when the new one is in place.
+    swap_dataset(path, new_path)
+
+    logger.info(f"Compacted '{path}' from {number_of_old_files} to {len(metadata_collector)} files")
+    print(f"Compacted '{path}' from {number_of_old_files} to {len(metadata_collector)} files.")
+    return len(metadata_collector)
+
+
+def look_at_dataset(**filters):
     """ 
     Use to load the dataset (used when making the script in jupyter notebook)
+    Files written with older versions of the program are converted to DATASET_SCHEMA when they are read,
+    and the names of the players, dungeons and reports are joined back from the dimension tables.
+    With filters (example: players=['Castory'] or report_codes=['aBcD1234']) only the matching rows are read,
+    and the key index is used to only open the row groups with those players or reports.
+
+    Args:
+        **filters: The filters for query_dataset(), the whole dataset is read if there are none.
 
     Returns:
         df (dataframe): dataframe with all the data. 
     """
     file_path = 'all_reports_parquet_dataset/'
 
-    df = pd.read_parquet(file_path)
+    with open_dimensions() as dimensions:
+        if filters:
+            return query_dataset(path=file_path, dimensions=dimensions, **filters)
+        df = read_dataset(file_path, decode=dimensions.decode).to_pandas()
     return df
 
+# Lazy queries on the dataset.
+# Instead of loading the whole dataset, the filters are pushed down to pyarrow so only the folders
+# and row groups that can contain matching rows are read.
+
+def make_dataset_filter(players: list = None, classes: list = None, dungeons: list = None, report_codes: list = None,
+                        start=None, end=None, min_keystone: int = None, max_keystone: int = None,
+                        dimensions: DimensionStore = None) -> ds.Expression:
+    """
+    Makes a filter expression for query_dataset().
+    With dimensions the players, classes, dungeons and reports are looked up first, and the filter is on
+    the int keys in FACT_SCHEMA. Without dimensions the filter is on the names in DATASET_SCHEMA.
+
+    Args:
+        players (list): Names of the characters.
+        classes (list): Classes (example: 'Rogue').
+        dungeons (list): Names of the dungeons.
+        report_codes (list): Report codes.
+        start (str or datetime): Only fights that started at or after this time (UTC if no timezone is given).
+        end (str or datetime): Only fights that started before this time (UTC if no timezone is given).
+        min_keystone (int): Lowest keystone level.
+        max_keystone (int): Highest keystone level.
+        dimensions (DimensionStore): The dimension tables.
+
+    Returns:
+        expression (ds.Expression or None): The filter, None if there are no conditions.
+    """
+    conditions = []
+    for column, values in (('name', players), ('class', classes), ('DungeonName', dungeons), ('reportCode', report_codes)):
+        if values is None:
+            continue
+        if dimensions is None:
+            conditions.append(ds.field(column).isin(list(values)))
+        else:
+            conditions.append(ds.field(KEY_COLUMNS[column]).isin(pa.array(dimensions.find_keys(column, values), type=pa.int32())))
+
+    if start is not None:
+        start = pd.Timestamp(start)
+        start = start.tz_localize('UTC') if start.tzinfo is None else start.tz_convert('UTC')
+        conditions.append(ds.field('StartTime') >= start)
+    if end is not None:
+        end = pd.Timestamp(end)
+        end = end.tz_localize('UTC') if end.tzinfo is None else end.tz_convert('UTC')
+        conditions.append(ds.field('StartTime') < end)
+    if min_keystone is not None:
+        conditions.append(ds.field('keystoneLevel') >= min_keystone)
+    if max_keystone is not None:
+        conditions.append(ds.field('keystoneLevel') <= max_keystone)
+
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+def make_partition_filter(partition_fields: list, dungeons: list = None, start=None, end=None, **filters) -> ds.Expression:
+    """
+    Makes a filter on the partition folders, so the folders that can't contain matching rows are skipped without being opened.
+    Only the partition keys in partition_fields are used. Folders without the key (example: files written with another
+    PARTITION_SCHEME) are always read.
+
+    Args:
+        partition_fields (list): The partition keys in the dataset.
+        dungeons (list): Names of the dungeons.
+        start (str or datetime): Only fights that started at or after this time (UTC if no timezone is given).
+        end (str or datetime): Only fights that started before this time (UTC if no timezone is given).
+        **filters: The other filters for make_dataset_filter(), not used for the folders.
+
+    Returns:
+        expression (ds.Expression or None): The filter, None if there are no conditions.
+    """
+    conditions = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        start = start.tz_localize('UTC') if start.tzinfo is None else start.tz_convert('UTC')
+    if end is not None:
+        end = pd.Timestamp(end)
+        end = end.tz_localize('UTC') if end.tzinfo is None else end.tz_convert('UTC')
+
+    # The folder names sort in the same order as the time, so they can be compared as strings.
+    # A fight can't be added to the dataset before it happened, so runDate folders before the start are also skipped.
+    time_formats = {'fightWeek': '%G-W%V', 'fightMonth': '%Y-%m', 'runDate': '%Y-%m-%d'}
+    for key, time_format in time_formats.items():
+        if key not in partition_fields:
+            continue
+        if start is not None:
+            conditions.append(ds.field(key).is_null() | (ds.field(key) >= start.strftime(time_format)))
+        if end is not None and key != 'runDate':
+            conditions.append(ds.field(key).is_null() | (ds.field(key) <= end.strftime(time_format)))
+
+    if dungeons is not None and 'dungeon' in partition_fields:
+        conditions.append(ds.field('dungeon').is_null() | ds.field('dungeon').isin([dungeon_slug(d) for d in dungeons]))
+
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+def scan_dataset(columns: list = None, filter: ds.Expression = None, path: str = PROCESSED_DATA_DIR, batch_size: int = 65536,
+                 filters: dict = None, dimensions: DimensionStore = None):
+    """
+    Reads the rows that match the filter, one record batch at a time.
+
+    The files only have the keys for the players, dungeons and reports, so the names are joined back to every
+    batch after it's read. If filters is given the filter is made on the keys and pushed down to pyarrow,
+    otherwise filter is used on the batches after the names are joined back. With filters on players or
+    report codes, the key index is used to only open the row groups that have them.
+
+    Args:
+        columns (list): The columns to read, all if None.
+        filter (ds.Expression): The filter on the columns in DATASET_SCHEMA, from make_dataset_filter().
+        path (str): Path to the dataset folder.
+        batch_size (int): Max number of rows per batch.
+        filters (dict): The arguments used for make_dataset_filter(), used for the filter on the keys and for skipping partition folders.
+        dimensions (DimensionStore): The dimension tables, opened from STATE_DB if None.
+
+    Yields:
+        batch (pa.RecordBatch): The matching rows.
+    """
+    with open_dimensions(dimensions) as dimensions:
+        index_keys = {}
+        for column, name in (('name', 'players'), ('reportCode', 'report_codes')):
+            if filters is not None and filters.get(name) is not None:
+                index_keys[KEY_COLUMNS[column]] = dimensions.find_keys(column, filters[name])
+        indexed_files, row_groups = read_key_index(path, index_keys) if index_keys else (set(), {})
+
+        dataset, legacy_fragments = open_dataset(path, indexed_files)
+        partition_schema = pa.schema([field for field in dataset.schema if field.name not in FACT_SCHEMA.names]) if dataset is not None else None
+
+        # Files from before version 3 are converted in memory first (compact the dataset to avoid this).
+        # The partition keys that are missing in a folder are read as nulls, so all batches get the same columns.
+        for fragment in legacy_fragments:
+            table = read_dataset_file(fragment)
+            if filter is not None:
+                table = table.filter(filter)
+            if partition_schema is not None:
+                for field in partition_schema:
+                    if field.name not in table.column_names:
+                        table = table.append_column(field.name, pa.nulls(table.num_rows, type=field.type))
+                table = table.select(columns or DATASET_SCHEMA.names + partition_schema.names)
+            elif columns is not None:
+                table = table.select(columns)
+            yield from table.to_batches(max_chunksize=batch_size)
+
+        if dataset is None:
+            return
+        if indexed_files:
+            dataset = select_row_groups(dataset, path, indexed_files, row_groups)
+
+        key_filter = None
+        if filters is not None:
+            key_filter = make_dataset_filter(**filters, dimensions=dimensions)
+            partition_filter = make_partition_filter(partition_schema.names, **filters)
+            if partition_filter is not None:
+                key_filter = partition_filter if key_filter is None else key_filter & partition_filter
+
+        # Only the key columns are read for the names, and all the columns if the filter is used after the names are joined back.
+        file_columns = None
+        if columns is not None and (filters is not None or filter is None):
+            file_columns = list(dict.fromkeys(KEY_COLUMNS.get(name, name) for name in columns))
+
+        scanner = dataset.scanner(columns=file_columns, filter=key_filter, batch_size=batch_size)
+        for batch in scanner.to_batches():
+            if filters is None and filter is not None:
+                table = dimensions.decode(batch).filter(filter)
+                yield from table.select(columns or table.column_names).to_batches()
+            else:
+                yield from dimensions.decode(batch, columns).to_batches()
+
+def query_dataset(columns: list = None, output: str = 'pandas', path: str = PROCESSED_DATA_DIR, dimensions: DimensionStore = None,
+                  **filters):
+    """
+    Reads only the rows and columns you ask for from the dataset.
+
+    The filters are pushed down to pyarrow: folders and row groups that can't contain matching rows
+    (according to the folder names and the column statistics) are never read. The players, dungeons
+    and reports in the filters are looked up in the dimension tables, so the files are filtered on int keys,
+    and the names are joined back to the rows that match.
+
+    Example:
+        query_dataset(columns=['name', 'Dps', 'StartTime'], players=['Castory'], start='2025-09-01')
+
+    Args:
+        columns (list): The columns to read, all if None.
+        output (str): 'pandas' for a DataFrame, 'arrow' for a pa.Table or 'batches' for an iterator of record batches.
+        path (str): Path to the dataset folder.
+        dimensions (DimensionStore): The dimension tables, opened from STATE_DB if None.
+        **filters: players, classes, dungeons, report_codes, start, end, min_keystone and max_keystone,
+                   see make_dataset_filter().
+
+    Returns:
+        result (pd.DataFrame, pa.Table or iterator): The matching rows.
+    """
+    batches = scan_dataset(columns, make_dataset_filter(**filters), path, filters=filters, dimensions=dimensions)
+    if output == 'batches':
+        return batches
+
+    batches = list(batches)
+    if batches:
+        table = pa.Table.from_batches(batches).unify_dictionaries()
+    else:
+        table = DATASET_SCHEMA.empty_table() if columns is None else DATASET_SCHEMA.empty_table().select([c for c in columns if c in DATASET_SCHEMA.names])
+    if output == 'arrow':
+        return table
+    return table.to_pandas()
+
+# Summary tables (aggregates) for every player, dungeon and week.
+# The count, sum, sum of squares, min and max of every metric are saved, so the mean and standard deviation can
+# be calculated and two summaries can be merged by adding them together. The quantiles use a sketch: the values are
+# counted in bins that grow by SKETCH_RELATIVE_ERROR, so two sketches are merged by adding the counts of the bins.
+# After every run only the new files are summarized and merged with the saved summary.
+
+# Bin for zero (and negative values), the other bins are numbered from the logarithm of the value.
+SKETCH_ZERO_BIN = -2 ** 31
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ERROR) / (1 - SKETCH_RELATIVE_ERROR)
+
+def aggregates_path(path: str = AGGREGATES_DIR) -> str:
+    """
+    Gets the path of the file with the player, dungeon and week summary.
+
+    Args:
+        path (str): Path to the aggregates folder.
+
+    Returns:
+        file_path (str): Path to the parquet file.
+    """
+    return os.path.join(path, 'player_dungeon_week.parquet')
+
+def sketch_bins(values: pd.Series) -> pd.Series:
+    """
+    Gets the sketch bin for every value.
+
+    Args:
+        values (pd.Series): The values, missing values are skipped.
+
+    Returns:
+        bins (pd.Series): The bin for every value that isn't missing.
+    """
+    values = values.dropna().astype(float)
+    positive = values > 0
+    bins = pd.Series(SKETCH_ZERO_BIN, index=values.index, dtype='int64')
+    bins[positive] = np.ceil(np.log(values[positive]) / np.log(SKETCH_GAMMA)).astype('int64')
+    return bins
+
+def sketch_value(sketch_bin: int) -> float:
+    """
+    Gets the value in the middle of a sketch bin.
+
+    Args:
+        sketch_bin (int): The bin.
+
+    Returns:
+        value (float): The value that represents the bin.
+    """
+    if sketch_bin == SKETCH_ZERO_BIN:
+        return 0.0
+    return 2 * SKETCH_GAMMA ** sketch_bin / (SKETCH_GAMMA + 1)
+
+def merge_sketches(sketches) -> dict:
+    """
+    Merges sketches by adding the counts of the bins.
+
+    Args:
+        sketches (iterable): The sketches, dicts with bin -> count.
+
+    Returns:
+        sketch (dict): The merged sketch.
+    """
+    merged = {}
+    for sketch in sketches:
+        for sketch_bin, count in sketch.items():
+            merged[sketch_bin] = merged.get(sketch_bin, 0) + count
+    return merged
+
+def sketch_quantile(sketch: dict, q: float) -> float:
+    """
+    Gets an approximate quantile from a sketch.
+
+    Args:
+        sketch (dict): The sketch, bin -> count.
+        q (float): The quantile, between 0 and 1 (0.5 is the median).
+
+    Returns:
+        value (float): The value at the quantile, at most SKETCH_RELATIVE_ERROR wrong. NaN if the sketch is empty.
+    """
+    total = sum(sketch.values())
+    if total == 0:
+        return np.nan
+    rank = q * (total - 1)
+    seen = 0
+    for sketch_bin in sorted(sketch):
+        seen += sketch[sketch_bin]
+        if seen > rank:
+            return sketch_value(sketch_bin)
+    return sketch_value(max(sketch))
+
+def aggregate_data(df: pd.DataFrame, keys: list = AGGREGATE_KEYS) -> pd.DataFrame:
+    """
+    Summarizes the rows for every group.
+
+    Args:
+        df (pd.DataFrame): Rows with FACT_SCHEMA.
+        keys (list): The columns to group by, fightWeek is made from StartTime.
+
+    Returns:
+        aggregates (pd.DataFrame): One row for every group with fights and count, sum, sumsq, min, max and sketch for every metric.
+    """
+    keys = list(keys)
+    df = df.copy()
+    if 'fightWeek' in keys:
+        df['fightWeek'] = partition_values(pa.table({'StartTime': pa.array(df['StartTime'], type=pa.timestamp('ms', tz='UTC'))}), 'fightWeek').to_pandas()
+        df['fightWeek'] = df['fightWeek'].astype(object).fillna('unknown').astype(str)
+
+    grouped = df.groupby(keys, sort=False)
+    aggregates = grouped.size().rename('fights').to_frame()
+    for metric in AGGREGATE_METRICS:
+        values = df[metric].astype(float)
+        aggregates[f'{metric}_count'] = grouped[metric].count()
+        aggregates[f'{metric}_sum'] = values.groupby([df[key] for key in keys], sort=False).sum()
+        aggregates[f'{metric}_sumsq'] = (values ** 2).groupby([df[key] for key in keys], sort=False).sum()
+        aggregates[f'{metric}_min'] = values.groupby([df[key] for key in keys], sort=False).min()
+        aggregates[f'{metric}_max'] = values.groupby([df[key] for key in keys], sort=False).max()
+
+        bins = sketch_bins(values)
+        bin_counts = df.loc[bins.index, keys].assign(sketch_bin=bins).groupby(keys + ['sketch_bin']).size()
+        sketches = {}
+        for index, count in bin_counts.items():
+            sketches.setdefault(index[:-1], {})[index[-1]] = int(count)
+        aggregates[f'{metric}_sketch'] = [sketches.get(index if isinstance(index, tuple) else (index,), {}) for index in aggregates.index]
+    return aggregates.reset_index()
+
+def merge_aggregates(aggregates: pd.DataFrame, keys: list = AGGREGATE_KEYS) -> pd.DataFrame:
+    """
+    Merges the summaries that have the same keys.
+
+    Args:
+        aggregates (pd.DataFrame): Summaries from aggregate_data() (several rows can have the same keys).
+        keys (list): The columns to group by, the other key columns are merged.
+
+    Returns:
+        aggregates (pd.DataFrame): One row for every group.
+    """
+    functions = {'fights': 'sum'}
+    for metric in AGGREGATE_METRICS:
+        functions.update({f'{metric}_count': 'sum', f'{metric}_sum': 'sum', f'{metric}_sumsq': 'sum',
+                          f'{metric}_min': 'min', f'{metric}_max': 'max', f'{metric}_sketch': merge_sketches})
+    return aggregates.groupby(list(keys), sort=True).agg(functions).reset_index()
+
+def aggregates_schema(keys: list = AGGREGATE_KEYS) -> pa.Schema:
+    """
+    Gets the schema for the aggregates file.
+
+    Args:
+        keys (list): The key columns.
+
+    Returns:
+        schema (pa.Schema): The schema.
+    """
+    fields = [FACT_SCHEMA.field(key) if key in FACT_SCHEMA.names else pa.field(key, pa.string()) for key in keys]
+    fields.append(pa.field('fights', pa.int64()))
+    for metric in AGGREGATE_METRICS:
+        fields += [pa.field(f'{metric}_count', pa.int64()), pa.field(f'{metric}_sum', pa.float64()),
+                   pa.field(f'{metric}_sumsq', pa.float64()), pa.field(f'{metric}_min', pa.float64()),
+                   pa.field(f'{metric}_max', pa.float64()), pa.field(f'{metric}_sketch', pa.map_(pa.int64(), pa.int64()))]
+    return pa.schema(fields)
+
+def write_aggregates(aggregates: pd.DataFrame, path: str = AGGREGATES_DIR):
+    """
+    Saves the summary, the file is written under a temporary name and renamed when it's complete.
+
+    Args:
+        aggregates (pd.DataFrame): The summary from merge_aggregates().
+        path (str): Path to the aggregates folder.
+    """
+    os.makedirs(path, exist_ok=True)
+    aggregates = aggregates.copy()
+    for metric in AGGREGATE_METRICS:
+        aggregates[f'{metric}_sketch'] = [list(sketch.items()) for sketch in aggregates[f'{metric}_sketch']]
+    table = pa.Table.from_pandas(aggregates, schema=aggregates_schema(), preserve_index=False)
+
+    file_path = aggregates_path(path)
+    pq.write_table(table, file_path + '.tmp')
+    os.replace(file_path + '.tmp', file_path)
+
+def load_aggregates(path: str = AGGREGATES_DIR, filters: list = None) -> pd.DataFrame:
+    """
+    Reads the saved summary with the sketches as dicts.
+
+    Args:
+        path (str): Path to the aggregates folder.
+        filters (list): Filters for pq.read_table(), example: [('playerKey', 'in', [1, 2])].
+
+    Returns:
+        aggregates (pd.DataFrame or None): The summary, None if there is no summary yet or it's from an older version.
+    """
+    file_path = aggregates_path(path)
+    if not os.path.exists(file_path):
+        return None
+    # Summaries from before the keys were used are grouped on the names, they have to be made again.
+    if not set(AGGREGATE_KEYS) <= set(pq.read_schema(file_path).names):
+        logger.info(f"The aggregates in '{path}' are grouped on the names, they need to be made again")
+        return None
+    aggregates = pq.read_table(file_path, filters=filters).to_pandas()
+    for metric in AGGREGATE_METRICS:
+        aggregates[f'{metric}_sketch'] = [dict(sketch) if sketch is not None else {} for sketch in aggregates[f'{metric}_sketch']]
+    return aggregates
+
+def update_aggregates(file_paths: list, path: str = AGGREGATES_DIR, dataset_path: str = PROCESSED_DATA_DIR):
+    """
+    Adds the data in the new files to the saved summary. Only the new files are read.
+    If there is no saved summary, it is made from the whole dataset instead.
+
+    Args:
+        file_paths (list): The new parquet files, from append_weekly_data_to_dataset().
+        path (str): Path to the aggregates folder.
+        dataset_path (str): Path to the dataset folder.
+    """
+    aggregates = load_aggregates(path)
+    if aggregates is None:
+        rebuild_aggregates(path, dataset_path)
+        return
+
+    with metrics.stage('aggregates'):
+        new_aggregates = [aggregate_data(pq.read_table(file_path, columns=list(AGGREGATE_COLUMNS)).to_pandas()) for file_path in file_paths]
+        aggregates = merge_aggregates(pd.concat([aggregates] + new_aggregates, ignore_index=True))
+        write_aggregates(aggregates, path)
+    logger.info(f"Updated the aggregates with {len(file_paths)} new files ({len(aggregates)} player, dungeon and week rows)")
+
+def rebuild_aggregates(path: str = AGGREGATES_DIR, dataset_path: str = PROCESSED_DATA_DIR):
+    """
+    Makes the summary from the whole dataset, one batch at a time.
+    Files from before version 3 get their keys from the dimension tables first.
+
+    Args:
+        path (str): Path to the aggregates folder.
+        dataset_path (str): Path to the dataset folder.
+    """
+    with metrics.stage('aggregates'):
+        aggregates = []
+        if os.path.exists(dataset_path):
+            with open_dimensions() as dimensions:
+                dataset, legacy_fragments = open_dataset(dataset_path)
+                tables = (dimensions.encode(read_dataset_file(fragment)) for fragment in legacy_fragments)
+                if dataset is not None:
+                    tables = (table for source in (tables, dataset.to_batches(columns=list(AGGREGATE_COLUMNS))) for table in source)
+                for table in tables:
+                    aggregates.append(merge_aggregates(aggregate_data(table.select(list(AGGREGATE_COLUMNS)).to_pandas())))
+        if aggregates:
+            aggregates = merge_aggregates(pd.concat(aggregates, ignore_index=True))
+        else:
+            aggregates = pd.DataFrame(columns=aggregates_schema().names)
+        write_aggregates(aggregates, path)
+    logger.info(f"Rebuilt the aggregates from '{dataset_path}' ({len(aggregates)} player, dungeon and week rows)")
+
+def read_aggregates(by: list = AGGREGATE_KEYS, quantiles: list = (0.5, 0.9), players: list = None, dungeons: list = None,
+                    weeks: list = None, path: str = AGGREGATES_DIR, dimensions: DimensionStore = None) -> pd.DataFrame:
+    """
+    Reads the summary, without reading the dataset.
+    The summary is grouped on the player and dungeon keys, the names are joined back from the dimension tables.
+    Two characters with the same name (from diffrent realms) are kept apart by their playerKey.
+
+    Example:
+        read_aggregates(by=['name'], players=['Castory'])  # Dps, Healing, deaths and ilvl for all weeks and dungeons
+
+    Args:
+        by (list): The columns to group by, any of AGGREGATE_KEYS, or name and DungeonName for their keys. The other keys are merged.
+        quantiles (list): The quantiles to calculate for every metric (example: 0.5 gives Dps_p50).
+        players (list): Only these characters.
+        dungeons (list): Only these dungeons.
+        weeks (list): Only these weeks (example: '2025-W38').
+        path (str): Path to the aggregates folder.
+        dimensions (DimensionStore): The dimension tables, opened from STATE_DB if None.
+
+    Returns:
+        summary (pd.DataFrame): The keys (with the names next to them), fights and the count, mean, std, min, max
+                                and quantiles for every metric.
+    """
+    keys = list(dict.fromkeys(KEY_COLUMNS.get(column, column) for column in by))
+    with open_dimensions(dimensions) as dimensions:
+        filters = [(KEY_COLUMNS[column], 'in', dimensions.find_keys(column, values))
+                   for column, values in (('name', players), ('DungeonName', dungeons)) if values is not None]
+        if weeks is not None:
+            filters.append(('fightWeek', 'in', list(weeks)))
+        aggregates = load_aggregates(path, filters or None)
+        if aggregates is None:
+            raise ValueError(f"There are no aggregates in '{path}' (or they are from an older version), "
+                             f"run 'python warcraftlogs_get_data.py aggregate' first")
+        if keys != list(AGGREGATE_KEYS):
+            aggregates = merge_aggregates(aggregates, keys)
+
+        summary = aggregates[keys + ['fights']].copy()
+        arrays = dimensions.lookup_arrays()
+        for column in ('name', 'DungeonName'):
+            key = KEY_COLUMNS[column]
+            if key in keys:
+                names = pc.take(arrays[column], pa.array(summary[key], type=pa.int32())).to_pandas()
+                summary.insert(summary.columns.get_loc(key) + 1, column, names)
+    for metric in AGGREGATE_METRICS:
+        count = aggregates[f'{metric}_count']
+        mean = aggregates[f'{metric}_sum'] / count.where(count > 0)
+        variance = (aggregates[f'{metric}_sumsq'] - count * mean ** 2) / (count - 1).where(count > 1)
+        summary[f'{metric}_count'] = count
+        summary[f'{metric}_mean'] = mean
+        summary[f'{metric}_std'] = np.sqrt(variance.clip(lower=0))
+        summary[f'{metric}_min'] = aggregates[f'{metric}_min']
+        summary[f'{metric}_max'] = aggregates[f'{metric}_max']
+        # The value of a bin can be a little outside the real values, so the quantiles are kept between min and max.
+        for q in quantiles:
+            values = pd.Series([sketch_quantile(sketch, q) for sketch in aggregates[f'{metric}_sketch']], index=aggregates.index)
+            summary[f'{metric}_p{round(q * 100):g}'] = values.clip(lower=summary[f'{metric}_min'], upper=summary[f'{metric}_max'])
+    return summary
+
+# Checkpoints for the reports and fights.
+# Every fight is saved in the journal as soon as its tables are fetched, so if the program crashes
+# a new run can continue where it stopped and only fetch the fights (and reports) that are missing.
+
+class CheckpointJournal:
+    """
+    Journal with the progress for every report and fight, saved in a SQLite file.
+
+    A report is 'in_progress' until all its fights are fetched and its data is saved, then it's 'done'.
+    If something goes wrong it's 'failed' and will be tried again in the next run. The raw tables
+    for every finished fight are kept (zlib-compressed) until the report is done, so they don't
+    have to be fetched again. Safe to use from several threads at once.
+
+    Args:
+        path (str): Path to the SQLite file.
+    """
+
+    def __init__(self, path: str = STATE_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS report_checkpoints (
+                                       report_code TEXT PRIMARY KEY,
+                                       status TEXT NOT NULL,
+                                       attempts INTEGER NOT NULL DEFAULT 0,
+                                       error TEXT,
+                                       updated_at REAL NOT NULL)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS fight_checkpoints (
+                                       report_code TEXT NOT NULL,
+                                       fight_id INTEGER NOT NULL,
+                                       status TEXT NOT NULL,
+                                       tables BLOB,
+                                       updated_at REAL NOT NULL,
+                                       PRIMARY KEY (report_code, fight_id))""")
+        self.connection.commit()
+
+    def start_report(self, report_code: str):
+        """
+        Marks a report as in progress.
+
+        Args:
+            report_code (str): The report code.
+        """
+        with self.lock:
+            self.connection.execute("""INSERT INTO report_checkpoints (report_code, status, attempts, updated_at) VALUES (?, 'in_progress', 1, ?)
+                                       ON CONFLICT (report_code) DO UPDATE SET status = 'in_progress', attempts = attempts + 1,
+                                       error = NULL, updated_at = excluded.updated_at""", (report_code, time.time()))
+            self.connection.commit()
+
+    def save_fights(self, report_code: str, fight_tables: dict):
+        """
+        Saves the tables for finished fights.
+
+        Args:
+            report_code (str): The report code.
+            fight_tables (dict): fight ID as key and the tables for the fight as value.
+        """
+        now = time.time()
+        rows = [(report_code, int(fight_id), zlib.compress(json.dumps(tables).encode()), now) for fight_id, tables in fight_tables.items()]
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO fight_checkpoints VALUES (?, ?, 'done', ?, ?)", rows)
+            self.connection.commit()
+
+    def finished_fights(self, report_code: str) -> dict:
+        """
+        Gets the tables for the fights that are already fetched.
+
+        Args:
+            report_code (str): The report code.
+
+        Returns:
+            fight_tables (dict): fight ID as key and the tables for the fight as value.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT fight_id, tables FROM fight_checkpoints WHERE report_code = ? AND status = 'done'",
+                                           (report_code,)).fetchall()
+        return {fight_id: json.loads(zlib.decompress(tables)) for fight_id, tables in rows}
+
+    def finish_report(self, report_code: str):
+        """
+        Marks a report as done and removes the saved tables for its fights, since the data is saved now.
+
+        Args:
+            report_code (str): The report code.
+        """
+        with self.lock:
+            self.connection.execute("UPDATE report_checkpoints SET status = 'done', error = NULL, updated_at = ? WHERE report_code = ?",
+                                    (time.time(), report_code))
+            self.connection.execute("DELETE FROM fight_checkpoints WHERE report_code = ?", (report_code,))
+            self.connection.commit()
+
+    def fail_report(self, report_code: str, error: str):
+        """
+        Marks a report as failed, the fights that are done are kept.
+
+        Args:
+            report_code (str): The report code.
+            error (str): What went wrong.
+        """
+        with self.lock:
+            self.connection.execute("UPDATE report_checkpoints SET status = 'failed', error = ?, updated_at = ? WHERE report_code = ?",
+                                    (error, time.time(), report_code))
+            self.connection.commit()
+
+    def unfinished_reports(self) -> list:
+        """
+        Gets the reports that were started but never finished (failed or stopped by a crash).
+
+        Returns:
+            codes (list): The report codes.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT report_code FROM report_checkpoints WHERE status != 'done' ORDER BY updated_at").fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        """
+        Closes the SQLite file.
+        """
+        with self.lock:
+            self.connection.close()
+
+# Finding the same fight in diffrent reports.
+# When several users upload the same dungeon-run it's in several reports. Every fight gets a fingerprint made of
+# the dungeon, the keystone level, the players and the start time, and the fingerprints are saved between runs.
+# A fight with a fingerprint that is already saved is a duplicate, and its tables are never fetched.
+
+# Fights that start within this many seconds of each other (with the same dungeon, level and players) are the same fight.
+DEDUP_TOLERANCE_SECONDS = 120
+
+def fight_fingerprint(dungeon_name: str, keystone_level: int, player_game_ids: list, start_time: float, time_bucket_offset: int = 0) -> str:
+    """
+    Makes the fingerprint for a fight. The start time is rounded to DEDUP_TOLERANCE_SECONDS.
+
+    Args:
+        dungeon_name (str): The name of the dungeon.
+        keystone_level (int): The keystone level.
+        player_game_ids (list): The gameIDs of the players in the fight.
+        start_time (float): The start time of the fight (UNIX, in seconds).
+        time_bucket_offset (int): Added to the rounded start time, used for checking the neighbouring times.
+
+    Returns:
+        fingerprint (str): The fingerprint as a hex string.
+    """
+    time_bucket = int(round(start_time / DEDUP_TOLERANCE_SECONDS)) + time_bucket_offset
+    players = ','.join(str(game_id) for game_id in sorted(player_game_ids))
+    key = f"{dungeon_name}|{keystone_level}|{players}|{time_bucket}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+class FightFingerprintIndex:
+    """
+    Index with the fingerprint of every fight that is processed, saved in a SQLite file.
+
+    The fight that claims a fingerprint first owns it, the same fight in other reports is then a duplicate.
+    A fight that starts close to the rounding border could get the neighbouring rounded time in another report,
+    so the neighbouring fingerprints are checked too. Safe to use from several threads at once.
+
+    A claim is provisional until confirm() is called when the data for the report is saved. If the report fails
+    its claims are removed with release(). A provisional claim from a report that isn't being fetched by this
+    program (example: it crashed in an earlier run) is not trusted, the fight is claimed by the next report instead.
+
+    Args:
+        path (str): Path to the SQLite file.
+    """
+
+    def __init__(self, path: str = STATE_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS fight_fingerprints (
+                                       fingerprint TEXT PRIMARY KEY,
+                                       report_code TEXT NOT NULL,
+                                       fight_id INTEGER NOT NULL,
+                                       created_at REAL NOT NULL)""")
+        # Older versions didn't have provisional claims, their fingerprints are all confirmed.
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(fight_fingerprints)")]
+        if 'confirmed' not in columns:
+            self.connection.execute("ALTER TABLE fight_fingerprints ADD COLUMN confirmed INTEGER NOT NULL DEFAULT 1")
+        self.connection.commit()
+        # The reports that are being fetched right now, their provisional claims are trusted.
+        self.active_reports = set()
+
+    def claim(self, report_code: str, fight_id: int, fingerprints: list) -> tuple:
+        """
+        Claims a fight if none of its fingerprints are owned by another fight.
+        The claim is provisional until confirm() is called for the report.
+
+        Args:
+            report_code (str): The report code.
+            fight_id (int): The fight ID in the report.
+            fingerprints (list): The fingerprint of the fight first, then the fingerprints for the neighbouring times.
+
+        Returns:
+            owner (tuple or None): (report_code, fight_id) of the fight that already owns it, or None if the fight is new.
+        """
+        with self.lock:
+            self.active_reports.add(report_code)
+            placeholders = ','.join('?' * len(fingerprints))
+            rows = self.connection.execute(f"""SELECT fingerprint, report_code, fight_id, confirmed FROM fight_fingerprints
+                                               WHERE fingerprint IN ({placeholders})""", fingerprints).fetchall()
+            owned = False
+            for fingerprint, owner_code, owner_fight_id, confirmed in rows:
+                if (owner_code, owner_fight_id) == (report_code, fight_id):
+                    owned = True
+                elif confirmed or owner_code in self.active_reports:
+                    return owner_code, owner_fight_id
+                else:
+                    # Left by a report that failed or crashed, so the fight never reached the dataset.
+                    self.connection.execute("DELETE FROM fight_fingerprints WHERE fingerprint = ?", (fingerprint,))
+            if not owned:
+                self.connection.execute("INSERT OR REPLACE INTO fight_fingerprints VALUES (?, ?, ?, ?, 0)",
+                                        (fingerprints[0], report_code, fight_id, time.time()))
+            self.connection.commit()
+            return None
+
+    def confirm(self, report_code: str):
+        """
+        Confirms the claims of a report, called when its data is saved.
+
+        Args:
+            report_code (str): The report code.
+        """
+        with self.lock:
+            self.connection.execute("UPDATE fight_fingerprints SET confirmed = 1 WHERE report_code = ?", (report_code,))
+            self.connection.commit()
+            self.active_reports.discard(report_code)
+
+    def owned_fights(self) -> dict:
+        """
+        Gets the fights every report owns, the fights that were saved and not skipped as duplicates.
+
+        Returns:
+            fights (dict): report code as key and a set with the fight IDs as value.
+        """
+        fights = {}
+        with self.lock:
+            for report_code, fight_id in self.connection.execute("SELECT report_code, fight_id FROM fight_fingerprints WHERE confirmed = 1"):
+                fights.setdefault(report_code, set()).add(fight_id)
+        return fights
+
+    def release(self, report_code: str):
+        """
+        Removes the provisional claims of a report that failed, so the same fights in other reports are kept.
+
+        Args:
+            report_code (str): The report code.
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM fight_fingerprints WHERE report_code = ? AND confirmed = 0", (report_code,))
+            self.connection.commit()
+            self.active_reports.discard(report_code)
+
+    def close(self):
+        """
+        Closes the SQLite file.
+        """
+        with self.lock:
+            self.connection.close()
+
+def find_duplicate_fights(fingerprints: FightFingerprintIndex, code: str, report_metadata: dict, fight_ids: list) -> dict:
+    """
+    Claims the fights in a report and finds the ones that already are in another report.
+
+    Args:
+        fingerprints (FightFingerprintIndex): The index with the fingerprints.
+        code (str): The reportcode for a report on warcraftlogs.
+        report_metadata (dict): The start time, characters and fights of the report.
+        fight_ids (list): The fights to check.
+
+    Returns:
+        duplicates (dict): fight ID as key and (report_code, fight_id) of the fight it's a duplicate of as value.
+    """
+    game_ids = {actor['id']: actor['gameID'] for actor in report_metadata['masterData']['actors']}
+    fights = {fight['id']: fight for fight in report_metadata['fights']}
+    duplicates = {}
+
+    for fight_id in fight_ids:
+        fight = fights[fight_id]
+        dungeon_name = (fight.get('gameZone') or {}).get('name')
+        player_game_ids = [game_ids.get(actor_id, actor_id) for actor_id in fight['friendlyPlayers']]
+        start_time = (report_metadata['startTime'] + fight['startTime']) / 1000
+        fight_fingerprints = [fight_fingerprint(dungeon_name, fight.get('keystoneLevel'), player_game_ids, start_time, offset) for offset in (0, -1, 1)]
+
+        owner = fingerprints.claim(code, int(fight_id), fight_fingerprints)
+        if owner is not None:
+            duplicates[fight_id] = owner
+    return duplicates
+
+# Functions for processing the reports
+
+def fetch_report(client: WarcraftLogsClient, code: str, journal: CheckpointJournal = None, fingerprints: FightFingerprintIndex = None,
+                 known_fights: set = None) -> tuple:
+    """
+    Gets the metadata and the tables for all the fights in a report.
+    If a journal is given, fights that are already in it are not fetched again and new fights are saved to it.
+    If a fingerprint index is given, fights that are duplicates of fights in other reports are skipped.
+    If known_fights is given the report was fetched before, while it was still being logged. The metadata is then
+    asked from the API instead of the response cache, and only the fights that are not in known_fights are fetched.
+
+    Args:
+        client (WarcraftLogsClient): The client for making the API call.
+        code (str): The reportcode for a report on warcraftlogs.
+        journal (CheckpointJournal): Journal with the fights that are already fetched.
+        fingerprints (FightFingerprintIndex): Index with the fingerprints of the fights in other reports.
+        known_fights (set): The fights that are already in the dataset, from ReportSnapshotStore.
+
+    Returns:
+        report_metadata (dict): The start time, characters and fights of the report.
+        fight_tables (dict): fight ID as key and a dict with the entries for damage, healing and deaths as value.
+                             Duplicate fights and known fights are not included.
+    """
+    # Get the start time, the characters and the fights of the report in one API-call.
+    report_metadata = get_report_metadata(client, code, refresh=known_fights is not None)
+    df_fights = clean_fight_metadata(report_metadata)
+    fight_ids = list(df_fights['id'])
+    if known_fights is not None:
+        fight_ids = [fight_id for fight_id in fight_ids if fight_id not in known_fights]
+        logger.info(f"'{code}' got longer since it was fetched, {len(fight_ids)} new fights")
+
+    # Remove the fights that already are in another report before any tables are fetched.
+    if fingerprints is not None:
+        duplicates = find_duplicate_fights(fingerprints, code, report_metadata, fight_ids)
+        for fight_id, (owner_code, owner_fight_id) in duplicates.items():
+            logger.info(f"Fight {fight_id} in '{code}' is the same as fight {owner_fight_id} in '{owner_code}', skipping it")
+        fight_ids = [fight_id for fight_id in fight_ids if fight_id not in duplicates]
+
+    fight_tables = {}
+    on_fights_done = None
+    if journal is not None:
+        # A fight from an earlier try can be a duplicate now (another report claimed it since), so only the fights
+        # that are still wanted are taken from the journal.
+        fight_tables = {fight_id: tables for fight_id, tables in journal.finished_fights(code).items() if fight_id in fight_ids}
+        if fight_tables:
+            logger.info(f"Found {len(fight_tables)} finished fights for '{code}' in the journal")
+        on_fights_done = lambda chunk_tables: journal.save_fights(code, chunk_tables)
+
+    # Get damage, healing and deaths for the missing fights with as few API-calls as possible.
+    missing_fights = [fight_id for fight_id in fight_ids if fight_id not in fight_tables]
+    if missing_fights:
+        fight_tables.update(get_fight_tables(client, code, missing_fights, on_fights_done=on_fights_done))
+
+    return report_metadata, fight_tables
+
+def table_entries_to_df(fight_tables: dict, table_name: str, columns: dict) -> pd.DataFrame:
+    """
+    Puts the entries of one table type for all the fights in a report in one dataframe.
+
+    Args:
+        fight_tables (dict): fight ID as key and a dict with the entries for damage, healing and deaths as value.
+        table_name (str): 'damage', 'healing' or 'deaths'.
+        columns (dict): The fields to keep in the entries and the new names of the columns.
+
+    Returns:
+        df_entries (pd.DataFrame): One row per entry with fightID and the columns.
+    """
+    rows = [(fight_id,) + tuple(entry.get(field) for field in columns)
+            for fight_id, tables in fight_tables.items() for entry in tables[table_name]]
+    return pd.DataFrame.from_records(rows, columns=['fightID'] + list(columns.values()))
+
+def transform_report(code: str, report_metadata: dict, fight_tables: dict) -> pd.DataFrame:
+    """
+    Puts the data for a report in one dataframe with one row per character and fight.
+
+    The entries for all the fights are put in one dataframe per table type first, and the tables are joined on
+    the fight and the actor id of the character. Joining on the id instead of the name means that two characters
+    with the same name (from diffrent realms) are never mixed up.
+
+    Args:
+        code (str): The reportcode for a report on warcraftlogs.
+        report_metadata (dict): The start time, characters and fights of the report.
+        fight_tables (dict): fight ID as key and a dict with the entries for damage, healing and deaths as value.
+
+    Returns:
+        df_weekly (pd.DataFrame): dataframe with the data for the report.
+    """
+    # Get the dungeon, keystone level, start time and duration for every run in the report.
+    df_fights = clean_fight_metadata(report_metadata)
+    df_fights = df_fights[df_fights['id'].isin(fight_tables.keys())]
+    if df_fights.empty:
+        return pd.DataFrame({'reportCode': pd.Series(dtype=str)})
+    df_fights = df_fights.rename(columns={'id': 'fightID'})
+
+    # The characters in every run (reminder: a fight equals a whole dungeon-run), with the name and gameID from the report.
+    actors = pd.DataFrame.from_records(report_metadata['masterData']['actors'], columns=['name', 'gameID', 'id'])
+    roster = df_fights[['fightID', 'friendlyPlayers']].explode('friendlyPlayers').dropna()
+    roster = roster.rename(columns={'friendlyPlayers': 'id'}).astype({'id': 'int64'})
+    roster = roster.merge(actors.astype({'id': 'int64'}), how='left', on='id')
+
+    # Count the deaths for every character in every run.
+    df_deaths = table_entries_to_df(fight_tables, 'deaths', {'id': 'id', 'name': 'deathName', 'guid': 'deathGameID'})
+    death_counts = df_deaths.groupby(['fightID', 'id'], sort=False).agg(
+        deaths=('id', 'size'), deathName=('deathName', 'first'), deathGameID=('deathGameID', 'first')).reset_index()
+
+    # Damage and healing, only characters that are in both tables are kept.
+    df_damage = table_entries_to_df(fight_tables, 'damage', {'id': 'id', 'name': 'damageName', 'guid': 'damageGameID', 'type': 'class',
+                                                             'itemLevel': 'ilvl', 'total': 'Dps'})
+    df_healing = table_entries_to_df(fight_tables, 'healing', {'id': 'id', 'total': 'Healing'})
+    df_dmg_healing = df_damage.merge(df_healing, how='inner', on=['fightID', 'id'])
+
+    df_weekly = (roster.merge(death_counts, how='outer', on=['fightID', 'id'])
+                       .merge(df_dmg_healing, how='outer', on=['fightID', 'id']))
+
+    # Characters that are missing in masterData get the name and gameID from the table entries.
+    df_weekly['name'] = df_weekly['name'].fillna(df_weekly['damageName']).fillna(df_weekly['deathName'])
+    df_weekly['gameID'] = df_weekly['gameID'].fillna(df_weekly['damageGameID']).fillna(df_weekly['deathGameID']).fillna(0).astype('int64')
+    df_weekly['deaths'] = df_weekly['deaths'].fillna(0).astype(int)
+
+    # Add the dungon name, keystone level, starttime and duration to the dataframe
+    df_weekly = df_weekly.merge(df_fights[['fightID', 'DungeonName', 'zoneID', 'keystoneLevel', 'StartTime', 'Duration']], how='left', on='fightID')
+    df_weekly['reportCode'] = code
+
+    # Dps and Healing are the totals for the whole run, divide by the duration to get them per second.
+    duration = df_weekly['Duration'].where(df_weekly['Duration'] > 0)
+    df_weekly['DamagePerSecond'] = df_weekly['Dps'] / duration
+    df_weekly['HealingPerSecond'] = df_weekly['Healing'] / duration
+    return df_weekly[['name', 'gameID', 'id', 'deaths', 'class', 'ilvl', 'Dps', 'Healing', 'DungeonName', 'keystoneLevel',
+                      'StartTime', 'Duration', 'reportCode', 'DamagePerSecond', 'HealingPerSecond', 'zoneID']]
+
+def fetch_and_save_report(client: WarcraftLogsClient, code: str, journal: CheckpointJournal = None, fingerprints: FightFingerprintIndex = None,
+                          snapshots: ReportSnapshotStore = None) -> tuple:
+    """
+    Processes a report and saves it in the temporary folder. Used as the task for the worker threads.
+    The report is marked as done in the journal when it's saved, or as failed if something goes wrong.
+    If the report has a snapshot it was fetched before, and only the fights that are new since then are saved.
+
+    Args:
+        client (WarcraftLogsClient): The client for making the API call.
+        code (str): The reportcode for a report on warcraftlogs.
+        journal (CheckpointJournal): Journal for saving the progress, no checkpoints are made if None.
+        fingerprints (FightFingerprintIndex): Index for finding duplicate fights, no fights are skipped if None.
+        snapshots (ReportSnapshotStore): The end time and fights of the reports that are fetched, nothing is saved if None.
+
+    Returns:
+        fight_count (int): Number of fights in the report.
+        content_hash (str): Hash of the data for the report.
+    """
+    known_fights = snapshots.fight_ids(code) if snapshots is not None else None
+    if journal is not None:
+        journal.start_report(code)
+    try:
+        with metrics.stage('fetch'):
+            report_metadata, fight_tables = fetch_report(client, code, journal, fingerprints, known_fights)
+        with metrics.stage('transform'):
+            df_weekly = transform_report(code, report_metadata, fight_tables)
+        with metrics.stage('serialise'):
+            save_weekly_data(code, df_weekly)
+    except Exception as e:
+        if journal is not None:
+            journal.fail_report(code, str(e))
+        raise
+    if journal is not None:
+        journal.finish_report(code)
+    # Saved after the data, so a report that fails is checked again in the next run.
+    if snapshots is not None:
+        fight_ids = set(clean_fight_metadata(report_metadata)['id']) | (known_fights or set())
+        saved_fight_ids = snapshots.saved_fight_ids(code) if known_fights is not None else set()
+        if saved_fight_ids is not None:
+            saved_fight_ids |= set(fight_tables)
+        snapshots.save(code, report_metadata.get('endTime'), fight_ids, saved_fight_ids)
+    if known_fights is not None:
+        metrics.count('reports_refreshed')
+
+    fight_count = len(fight_tables)
+    metrics.count('fights_fetched', fight_count)
+    metrics.count('rows_transformed', len(df_weekly))
+    content_hash = hashlib.sha256(pd.util.hash_pandas_object(df_weekly, index=False).values.tobytes()).hexdigest()
+    return fight_count, content_hash
+
+def fetch_reports(client: WarcraftLogsClient, codes: list, journal: CheckpointJournal, fingerprints: FightFingerprintIndex,
+                  old_codes: ProcessedReportsStore, max_workers: int = MAX_WORKERS, snapshots: ReportSnapshotStore = None) -> list:
+    """
+    Fetches the reports with max_workers reports at the same time, every report is saved to its own Arrow file
+    in the short storage folder. Reports that fail are logged and skipped.
+
+    Args:
+        client (WarcraftLogsClient): The client for making the API calls.
+        codes (list): The report codes to fetch.
+        journal (CheckpointJournal): The journal with the progress for every report and fight.
+        fingerprints (FightFingerprintIndex): The fingerprints for finding duplicate fights, None to keep duplicates.
+        old_codes (ProcessedReportsStore): The store where the processed reports are saved.
+        max_workers (int): Max number of reports fetched at the same time.
+        snapshots (ReportSnapshotStore): The end time and fights of the fetched reports, reports that are in it
+                                         already were fetched and only get their new fights.
+
+    Returns:
+        done_codes (list): The reports that are saved in the short storage folder.
+    """
+    # Codes that already have a file in the short storage folder are not fetched again.
+    done_codes = []
+    codes_to_fetch = []
+    for code in codes:
+        if os.path.exists(staging_path(code)) or os.path.exists(os.path.join(RAW_DATA_DIR, f"{code}.json")):
+            print(f"File for '{code}' already exists. Skipping API call.")
+            if fingerprints is not None:
+                fingerprints.confirm(code)
+            done_codes.append(code)
+            continue
+        codes_to_fetch.append(code)
+
+    #Used for printing the progress.
+    number_of_codes = len(codes_to_fetch)
+
+    # Counter for printing the progress of the report codes. 
+    counter_1 = 1
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_and_save_report, client, code, journal, fingerprints, snapshots): code for code in codes_to_fetch}
+
+        for future in as_completed(futures):
+            code = futures[future]
+            try:
+                fight_count, content_hash = future.result()
+            except Exception as e:
+                old_codes.add(code, status='failed')
+                if fingerprints is not None:
+                    fingerprints.release(code)
+                metrics.count('reports_failed')
+                log_error(code, e)
+                continue
+
+            old_codes.add(code, fight_count=fight_count, content_hash=content_hash)
+            if fingerprints is not None:
+                fingerprints.confirm(code)
+            metrics.count('reports_done')
+            done_codes.append(code)
+            logger.info(f"Done with code {counter_1} of {number_of_codes} ({client.rate_limiter.points_used(code):.1f} points used)")
+            counter_1 = counter_1 + 1
+    return done_codes
+
+def log_error(code: str, e: Exception):
+    """
+    Saves an error for a report code to error_log.txt.
+
+    Args:
+        code (str): The reportcode that failed.
+        e (Exception): The error.
+    """
+    error_message = f"Error processing code '{code}': {e}\n"
+    error_details = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+
+    # Get the current timestamp
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # Save the error to a separate file.
+    # 'a' stands for 'append' so you don't overwrite previous errors.
+    with open("error_log.txt", "a") as error_file:
+        error_file.write(f"--- Timestamp: {timestamp} ---\n")
+        error_file.write(error_message)
+        error_file.write(error_details)
+        error_file.write("-" * 50 + "\n\n")
+
+    print(f"An error occurred for code '{code}'. The details have been saved to error_log.txt. Continuing to the next code...")
+
+# Historical backfill.
+# When a new user is added, all of their old reports are needed and not only the last week. The reports in the date range
+# are saved in a work queue in STATE_DB, and are then fetched in batches of BACKFILL_FLUSH_REPORTS reports. After every
+# batch the data is appended to the dataset, so the memory and the short storage folder never grow with the number of reports.
+# If the backfill is stopped it continues with the reports that are left the next time it's started.
+
+class BackfillQueue:
+    """
+    Work queue with the reports to backfill, saved in a SQLite file.
+
+    A report is 'pending' until its data is in the dataset, then it's 'done'. Reports that fail are
+    'failed' and are put back in the queue the next time the backfill is started. Safe to use from several threads at once.
+
+    Args:
+        path (str): Path to the SQLite file.
+    """
+
+    def __init__(self, path: str = STATE_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS backfill_queue (
+                                       report_code TEXT PRIMARY KEY,
+                                       status TEXT NOT NULL,
+                                       start_time REAL,
+                                       attempts INTEGER NOT NULL DEFAULT 0,
+                                       added_at REAL NOT NULL,
+                                       updated_at REAL NOT NULL)""")
+        self.connection.commit()
+
+    def add(self, reports: list) -> int:
+        """
+        Adds reports to the queue, reports that are already in the queue are skipped.
+
+        Args:
+            reports (list): Dicts with code and startTime, from discover_reports().
+
+        Returns:
+            number_of_reports (int): Number of reports that were added.
+        """
+        now = time.time()
+        rows = [(report['code'], report.get('startTime'), now, now) for report in reports]
+        with self.lock:
+            before = self.connection.total_changes
+            self.connection.executemany("""INSERT OR IGNORE INTO backfill_queue (report_code, status, start_time, added_at, updated_at)
+                                           VALUES (?, 'pending', ?, ?, ?)""", rows)
+            self.connection.commit()
+            return self.connection.total_changes - before
+
+    def retry_failed(self) -> int:
+        """
+        Puts the failed reports back in the queue.
+
+        Returns:
+            number_of_reports (int): Number of reports that were put back.
+        """
+        with self.lock:
+            cursor = self.connection.execute("UPDATE backfill_queue SET status = 'pending', updated_at = ? WHERE status = 'failed'",
+                                             (time.time(),))
+            self.connection.commit()
+            return cursor.rowcount
+
+    def next_batch(self, size: int) -> list:
+        """
+        Gets the next reports to fetch, the oldest reports first.
+
+        Args:
+            size (int): Max number of reports.
+
+        Returns:
+            codes (list): The report codes.
+        """
+        with self.lock:
+            rows = self.connection.execute("""SELECT report_code FROM backfill_queue WHERE status = 'pending'
+                                              ORDER BY start_time, report_code LIMIT ?""", (size,)).fetchall()
+        return [row[0] for row in rows]
+
+    def mark(self, codes: list, status: str):
+        """
+        Sets the status for reports.
+
+        Args:
+            codes (list): The report codes.
+            status (str): 'done', 'failed' or 'pending'.
+        """
+        now = time.time()
+        with self.lock:
+            self.connection.executemany("UPDATE backfill_queue SET status = ?, attempts = attempts + 1, updated_at = ? WHERE report_code = ?",
+                                        [(status, now, code) for code in codes])
+            self.connection.commit()
+
+    def counts(self) -> dict:
+        """
+        Counts the reports with every status.
+
+        Returns:
+            counts (dict): status as key and number of reports as value.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT status, COUNT(*) FROM backfill_queue GROUP BY status").fetchall()
+        return dict(rows)
+
+    def close(self):
+        """
+        Closes the connection to the SQLite file.
+        """
+        with self.lock:
+            self.connection.close()
+
+def format_duration(seconds: float) -> str:
+    """
+    Formats a number of seconds as hours, minutes and seconds.
+
+    Args:
+        seconds (float): The number of seconds.
+
+    Returns:
+        text (str): The time, example: '2h 05m 10s'.
+    """
+    seconds = int(seconds)
+    return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m {seconds % 60:02d}s"
+
+def backfill(client: WarcraftLogsClient, queue: BackfillQueue, journal: CheckpointJournal, fingerprints: FightFingerprintIndex,
+             old_codes: ProcessedReportsStore, config: dict, start, end=None, max_workers: int = MAX_WORKERS,
+             flush_reports: int = BACKFILL_FLUSH_REPORTS, partition_by: tuple = PARTITION_SCHEME,
+             row_group_rows: int = INGEST_ROW_GROUP_ROWS, max_file_rows: int = INGEST_MAX_FILE_ROWS,
+             snapshots: ReportSnapshotStore = None):
+    """
+    Fetches all the reports in a date range for the users and guilds in the config.
+
+    Args:
+        client (WarcraftLogsClient): The client for making the API calls.
+        queue (BackfillQueue): The work queue.
+        journal (CheckpointJournal): The journal with the progress for every report and fight.
+        fingerprints (FightFingerprintIndex): The fingerprints for finding duplicate fights, None to keep duplicates.
+        old_codes (ProcessedReportsStore): The store where the processed reports are saved.
+        config (dict): The users, guilds and zones, from load_discovery_config().
+        start (str or datetime): Start of the date range.
+        end (str or datetime): End of the date range, now if None.
+        max_workers (int): Max number of reports fetched at the same time.
+        flush_reports (int): Number of reports fetched before the data is appended to the dataset.
+        partition_by (tuple): The partition keys, see PARTITION_KEYS.
+        row_group_rows (int): Number of rows in each row group when the data is appended.
+        max_file_rows (int): Max number of rows in a file when the data is appended.
+        snapshots (ReportSnapshotStore): The end time and fights of the fetched reports, so the normal runs can
+                                         get the fights that are added later.
+    """
+    # Put the reports in the date range in the queue. All the pages are fetched, and if a user or guild fails the backfill
+    # stops before anything is added, so it never finishes with the reports of some users missing.
+    reports = discover_reports(client, config, start, end, max_workers, max_pages=None, skip_failed=False)
+    added = queue.add(list(reports.values()))
+    retried = queue.retry_failed()
+    counts = queue.counts()
+    total = counts.get('pending', 0)
+    logger.info(f"Backfill: found {len(reports)} reports, {added} new in the queue, {retried} failed reports retried, "
+                f"{total} reports left to fetch ({counts.get('done', 0)} done earlier)")
+
+    started = time.monotonic()
+    processed = 0
+    while True:
+        codes = queue.next_batch(flush_reports)
+        if not codes:
+            break
+
+        # Reports that were already fetched by a normal run are not fetched again.
+        already_done = [code for code in codes if code in old_codes]
+        queue.mark(already_done, 'done')
+        codes = [code for code in codes if code not in old_codes]
+
+        done_codes = fetch_reports(client, codes, journal, fingerprints, old_codes, max_workers, snapshots)
+
+        # Append the batch to the dataset before the reports are marked as done, so a crash never loses a report.
+        new_files = append_weekly_data_to_dataset(partition_by, row_group_rows, max_file_rows)
+        if new_files:
+            update_aggregates(new_files, AGGREGATES_DIR, PROCESSED_DATA_DIR)
+        queue.mark(done_codes, 'done')
+        queue.mark([code for code in codes if code not in done_codes], 'failed')
+
+        processed += len(already_done) + len(codes)
+        elapsed = time.monotonic() - started
+        reports_per_hour = processed / elapsed * 3600 if elapsed > 0 else 0.0
+        left = max(total - processed, 0)
+        eta = format_duration(left / reports_per_hour * 3600) if reports_per_hour > 0 else 'unknown'
+        print(f"Backfill: {processed} of {total} reports ({reports_per_hour:.0f} reports/hour, ETA {eta})")
+        logger.info(f"Backfill: {processed} of {total} reports done in {format_duration(elapsed)}, "
+                    f"{reports_per_hour:.0f} reports/hour, {client.rate_limiter.points_total:.1f} points used, ETA {eta}")
+
+    counts = queue.counts()
+    logger.info(f"Backfill finished: {counts.get('done', 0)} reports done, {counts.get('failed', 0)} failed")
+
+# Reprocessing the history.
+# When the transform or DATASET_SCHEMA changes, the whole dataset can be made again from the responses in the response
+# cache without asking the API. The reports are transformed in a process pool, so it uses all the cores. Every worker
+# returns the rows for a report as Arrow IPC bytes (not a pickled dataframe), and one writer in the main process writes
+# them in the order of the report codes, so the result is the same no matter which worker finishes first.
+
+# Alias of a fight table in the cached responses (example: damage_5).
+FIGHT_TABLE_ALIAS = re.compile(r'^(' + '|'.join(FIGHT_TABLES) + r')_(\d+)$')
+
+def cached_report_codes(cache_path: str = RESPONSE_CACHE_FILE) -> set:
+    """
+    Gets the report codes that have responses in the response cache.
+
+    Args:
+        cache_path (str): Path to the response cache.
+
+    Returns:
+        codes (set): The report codes.
+    """
+    if not os.path.exists(cache_path):
+        return set()
+    with contextlib.closing(sqlite3.connect(f"file:{cache_path}?mode=ro", uri=True)) as connection:
+        return {row[0] for row in connection.execute("SELECT DISTINCT report_code FROM responses").fetchall()}
+
+def load_cached_report(connection: sqlite3.Connection, code: str) -> tuple:
+    """
+    Puts the metadata and the fight tables for a report together from the cached responses.
+    The tables for a fight can be in diffrent responses (the fights are fetched in chunks), so the alias keys
+    of all the responses are merged. The newest metadata is used if there are several.
+
+    Args:
+        connection (sqlite3.Connection): Connection to the response cache.
+        code (str): The report code.
+
+    Returns:
+        report_metadata (dict or None): The start time, characters and fights of the report, None if it isn't cached.
+        fight_tables (dict): fight ID as key and a dict with the entries for damage, healing and deaths as value.
+                             Fights that don't have all the tables are not included.
+    """
+    rows = connection.execute("SELECT data FROM responses WHERE report_code = ? ORDER BY created_at", (code,)).fetchall()
+    report_metadata = None
+    tables = {}
+    for (data,) in rows:
+        response = json.loads(zlib.decompress(data))
+        report = ((response.get('data') or {}).get('reportData') or {}).get('report')
+        if not report:
+            continue
+        if 'masterData' in report and 'fights' in report:
+            report_metadata = report
+        for key, value in report.items():
+            match = FIGHT_TABLE_ALIAS.match(key)
+            if match and value:
+                tables.setdefault(int(match.group(2)), {})[match.group(1)] = value['data']['entries']
+
+    fight_tables = {fight_id: fight for fight_id, fight in sorted(tables.items()) if len(fight) == len(FIGHT_TABLES)}
+    return report_metadata, fight_tables
+
+def transform_cached_report(cache_path: str, code: str, fight_ids: set) -> bytes:
+    """
+    Transforms a report from the response cache. Used as the task for the worker processes.
+    Only the fights in fight_ids are used, other fights in the cache (example: duplicates from a try that failed) are left out.
+
+    Args:
+        cache_path (str): Path to the response cache.
+        code (str): The report code.
+        fight_ids (set): The fights of the report that are in the dataset.
+
+    Returns:
+        payload (bytes or None): The rows for the report with DATASET_SCHEMA as an Arrow IPC stream,
+                                 None if the report or some of its fights aren't in the cache.
+    """
+    with contextlib.closing(sqlite3.connect(f"file:{cache_path}?mode=ro", uri=True)) as connection:
+        report_metadata, fight_tables = load_cached_report(connection, code)
+    if report_metadata is None or not set(fight_ids) <= set(fight_tables):
+        return None
+    fight_tables = {fight_id: fight_tables[fight_id] for fight_id in sorted(fight_ids)}
+
+    table = weekly_data_to_table(transform_report(code, report_metadata, fight_tables))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, DATASET_SCHEMA) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def ordered_results(executor, function, arguments: list, window: int):
+    """
+    Runs the function for every item in arguments in the executor and gives the results in the same order.
+    At most window tasks are started ahead of the result that is given, so the results waiting for
+    a slow task never fill up the memory.
+
+    Args:
+        executor (Executor): The process or thread pool.
+        function (callable): The function to run.
+        arguments (list): A tuple with the arguments for every call.
+        window (int): Max number of tasks that are started but not given yet.
+
+    Yields:
+        arguments (tuple): The arguments of the call.
+        result: The result of the call.
+    """
+    arguments = iter(arguments)
+    futures = collections.deque()
+    for args in arguments:
+        futures.append((args, executor.submit(function, *args)))
+        if len(futures) >= window:
+            break
+    while futures:
+        args, future = futures.popleft()
+        next_args = next(arguments, None)
+        if next_args is not None:
+            futures.append((next_args, executor.submit(function, *next_args)))
+        yield args, future.result()
+
+def reprocess_dataset(old_codes: ProcessedReportsStore, dimensions: DimensionStore, cache_path: str = RESPONSE_CACHE_FILE,
+                      path: str = PROCESSED_DATA_DIR, partition_by: tuple = PARTITION_SCHEME, max_workers: int = None,
+                      row_group_rows: int = INGEST_ROW_GROUP_ROWS, max_file_rows: int = INGEST_MAX_FILE_ROWS,
+                      snapshots: ReportSnapshotStore = None, fingerprints: FightFingerprintIndex = None) -> int:
+    """
+    Makes the dataset again from the responses in the response cache, with the reports spread over a process pool.
+
+    A report is only made again if the cache has the tables for exactly the fights that are in the dataset for it
+    (from the snapshot of the report, or else the fights it owns in the fingerprint index), so fights that were
+    skipped as duplicates stay out. The rows for the other reports (not in the cache any more, some fights evicted,
+    or the fights aren't known) are copied from the old dataset. The new dataset is built in a separate folder
+    and only replaces the old one when it's complete. The summary tables are made again after.
+
+    Args:
+        old_codes (ProcessedReportsStore): The store with the processed reports.
+        dimensions (DimensionStore): The dimension tables.
+        cache_path (str): Path to the response cache.
+        path (str): Path to the dataset folder.
+        partition_by (tuple): The partition keys, see PARTITION_KEYS.
+        max_workers (int): Number of worker processes, the number of cores if None.
+        row_group_rows (int): Number of rows in each row group.
+        max_file_rows (int): Max number of rows in a file.
+        snapshots (ReportSnapshotStore): The fights that were saved for every report.
+        fingerprints (FightFingerprintIndex): The fights every report owns, used for reports without saved fights in the snapshot.
+
+    Returns:
+        number_of_rows (int): Number of rows in the new dataset.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    codes = sorted(cached_report_codes(cache_path) & old_codes.done_codes)
+
+    # The fights that are in the dataset for every report, the reports where they aren't known are copied.
+    owned_fights = fingerprints.owned_fights() if fingerprints is not None else {}
+    saved_fights = {}
+    unknown_codes = []
+    for code in codes:
+        fight_ids = snapshots.saved_fight_ids(code) if snapshots is not None else None
+        if fight_ids is None:
+            fight_ids = owned_fights.get(code)
+        if fight_ids is None:
+            unknown_codes.append(code)
+        else:
+            saved_fights[code] = fight_ids
+    if unknown_codes:
+        logger.info(f"The saved fights aren't known for {len(unknown_codes)} reports, copying them from the old dataset: {unknown_codes}")
+        print(f"The saved fights aren't known for {len(unknown_codes)} reports, they are copied from the old dataset.")
+    print(f"Reprocessing {len(saved_fights)} reports from '{cache_path}' with {max_workers} processes...")
+
+    recover_dataset(path)
+    new_path = path + '.reprocessing'
+    if os.path.exists(new_path):
+        shutil.rmtree(new_path)
+    writer = DatasetWriter(new_path, partition_by, row_group_rows, max_file_rows, dimensions=dimensions)
+
+    reprocessed = []
+    with metrics.stage('reprocess'), ProcessPoolExecutor(max_workers=max_workers) as executor:
+        tasks = [(cache_path, code, fight_ids) for code, fight_ids in saved_fights.items()]
+        incomplete_codes = []
+        for (_, code, _), payload in ordered_results(executor, transform_cached_report, tasks, window=max_workers * 2):
+            if payload is None:
+                incomplete_codes.append(code)
+                continue
+            table = pa.ipc.open_stream(pa.py_buffer(payload)).read_all()
+            writer.write_table(table)
+            reprocessed.append(code)
+    metrics.count('reports_reprocessed', len(reprocessed))
+    if incomplete_codes:
+        logger.info(f"{len(incomplete_codes)} reports are missing fights in the cache, copying them from the old dataset: {incomplete_codes}")
+        print(f"{len(incomplete_codes)} reports are missing fights in the cache, they are copied from the old dataset.")
+
+    # The reports that can't be made again from the cache are copied from the old dataset.
+    copied_rows = 0
+    if os.path.exists(path):
+        with metrics.stage('parquet_write'):
+            keep_filter = ~ds.field('reportCode').isin(reprocessed) if reprocessed else None
+            for batch in scan_dataset(list(DATASET_SCHEMA.names), keep_filter, path, dimensions=dimensions):
+                writer.write_table(conform_table(pa.Table.from_batches([batch])))
+                copied_rows += batch.num_rows
+    writer.close()
+
+    # Swap the folders, the old dataset is only removed when the new one is in place.
+    if os.path.exists(new_path):
+        swap_dataset(path, new_path)
+
+    logger.info(f"Reprocessed {len(reprocessed)} reports, {writer.number_of_rows} rows ({copied_rows} copied from the old dataset)")
+    print(f"Reprocessed {len(reprocessed)} reports to '{path}', {writer.number_of_rows} rows ({copied_rows} copied from the old dataset).")
+
+    dimensions.export(DIMENSIONS_DIR)
+    rebuild_aggregates(AGGREGATES_DIR, path)
+    return writer.number_of_rows
+
+# Event timelines.
+# The tables only give one summary row for every player and fight. The events (every hit, heal, death and cast) are
+# fetched with the events-query, which gives at most EVENTS_PER_PAGE events per call and the timestamp where the next
+# page starts. Every page is converted to an Arrow record batch right away and written to the timeline dataset, so a
+# report with millions of events is never kept in memory. The pages are not saved in the response cache.
+
+class TimelineStore:
+    """
+    Store for the reports that have their events in the timeline dataset, saved in a SQLite file.
+
+    Args:
+        path (str): Path to the SQLite file.
+    """
+
+    def __init__(self, path: str = STATE_DB):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS event_timelines (
+                                       report_code TEXT PRIMARY KEY,
+                                       event_count INTEGER,
+                                       data_types TEXT,
+                                       fetched_at REAL)""")
+        self.connection.commit()
+        self.codes = {row[0] for row in self.connection.execute("SELECT report_code FROM event_timelines").fetchall()}
+
+    def __contains__(self, code: str) -> bool:
+        return code in self.codes
+
+    def add(self, code: str, event_count: int, data_types: tuple):
+        """
+        Saves that the events for a report are in the timeline dataset.
+
+        Args:
+            code (str): The report code.
+            event_count (int): Number of events that were written.
+            data_types (tuple): The types of events, see EVENT_DATA_TYPES.
+        """
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO event_timelines VALUES (?, ?, ?, ?)",
+                                    (code, event_count, ','.join(data_types), time.time()))
+            self.connection.commit()
+            self.codes.add(code)
+
+    def close(self):
+        """
+        Closes the connection to the SQLite file.
+        """
+        with self.lock:
+            self.connection.close()
+
+def make_events_query(report_code: str, fight_ids: list, data_type: str, start_time: int, end_time: int,
+                      limit: int = EVENTS_PER_PAGE) -> str:
+    """
+    Creates a query-string for getting one page of events.
+
+    Args:
+        report_code (str): Uniqe code for the report used in the query.
+        fight_ids (list): The fights we want the events for.
+        data_type (str): The type of events, see EVENT_DATA_TYPES.
+        start_time (int): Start of the page, in milliseconds from the start of the report.
+        end_time (int): End of the last fight, in milliseconds from the start of the report.
+        limit (int): Max number of events on the page.
+
+    Returns:
+        query (str): Query string to be used in a api call.
+    """
+    fight_ids_string = ', '.join(str(fight_id) for fight_id in fight_ids)
+    query = f"""query PlayerDungeonMetrics{{
+                                            reportData{{
+                                                report(code: "{report_code}"){{
+                                                    events(fightIDs: [{fight_ids_string}], dataType: {data_type}, hostilityType: Friendlies,
+                                                           startTime: {start_time}, endTime: {end_time}, limit: {limit}){{
+                                                        data
+                                                        nextPageTimestamp
+                                                        }}
+                                                    }}
+                                                }}
+                                            }}"""
+    return query
+
+def iter_event_pages(client: WarcraftLogsClient, report_code: str, fight_ids: list, data_type: str, start_time: int, end_time: int):
+    """
+    Gets the events for the fights one page at a time, the next page is only fetched when the last one is used.
+
+    Args:
+        client (WarcraftLogsClient): The client for making the API calls.
+        report_code (str): The reportcode for a report on warcraftlogs.
+        fight_ids (list): The fights we want the events for.
+        data_type (str): The type of events, see EVENT_DATA_TYPES.
+        start_time (int): Start of the first fight, in milliseconds from the start of the report.
+        end_time (int): End of the last fight, in milliseconds from the start of the report.
+
+    Yields:
+        events (list): The events on a page.
+    """
+    page_start = start_time
+    while page_start is not None:
+        response = make_query(client, make_events_query(report_code, fight_ids, data_type, page_start, end_time))
+        if not response or response.get('errors') or not response['data']['reportData']['report']:
+            raise ValueError(f"Could not get the {data_type} events from {page_start} in report '{report_code}': {response}")
+
+        events = response['data']['reportData']['report']['events']
+        metrics.count('event_pages')
+        yield events['data'] or []
+
+        next_page = events.get('nextPageTimestamp')
+        # Stop if the API gives the same page again, so a bad answer can't make an endless loop.
+        page_start = next_page if next_page is not None and next_page > page_start else None
+
+def events_to_batch(report_code: str, events: list) -> pa.RecordBatch:
+    """
+    Converts a page of events to a record batch with EVENT_SCHEMA.
+    Every column is made from the list at once, and the fields that aren't in EVENT_SCHEMA are dropped.
+
+    Args:
+        report_code (str): The report the events are from.
+        events (list): The events on a page.
+
+    Returns:
+        batch (pa.RecordBatch): One row for every event.
+    """
+    # Name of the column and the key in the events from the API.
+    fields = {'fightID': 'fight', 'timestamp': 'timestamp', 'sourceID': 'sourceID', 'targetID': 'targetID',
+              'abilityGameID': 'abilityGameID', 'amount': 'amount', 'absorbed': 'absorbed', 'overheal': 'overheal',
+              'hitType': 'hitType'}
+    columns = {}
+    for name, key in fields.items():
+        columns[name] = pa.array([event.get(key) for event in events], type=EVENT_SCHEMA.field(name).type)
+    columns['type'] = pc.dictionary_encode(pa.array([event.get('type') for event in events], type=pa.string()))
+    columns['reportCode'] = pa.DictionaryArray.from_arrays(pa.array(np.zeros(len(events), dtype=np.int32)), pa.array([report_code]))
+    return pa.RecordBatch.from_arrays([columns[name] for name in EVENT_SCHEMA.names], schema=EVENT_SCHEMA)
+
+def fetch_report_events(client: WarcraftLogsClient, code: str, data_types: tuple = EVENT_DATA_TYPES,
+                        path: str = TIMELINE_DATA_DIR) -> int:
+    """
+    Fetches the events for the dungeon-runs in a report and writes them to the timeline dataset.
+
+    The report is written to the folder for the week it started in (example: fightWeek=2025-W38), the rows are
+    sorted by the type of event and then by time. The files are only renamed into the dataset when all the
+    pages are written, so a report that fails never leaves part of its events in the dataset.
+
+    Args:
+        client (WarcraftLogsClient): The client for making the API calls.
+        code (str): The reportcode for a report on warcraftlogs.
+        data_types (tuple): The types of events, see EVENT_DATA_TYPES.
+        path (str): Path to the timeline dataset.
+
+    Returns:
+        event_count (int): Number of events that were written.
+    """
+    report_metadata = get_report_metadata(client, code)
+    df_fights = pd.json_normalize(report_metadata['fights'])
+    if df_fights.empty:
+        return 0
+    df_fights = clean_fightID_df(df_fights)
+    if df_fights.empty:
+        return 0
+
+    fight_ids = df_fights['id'].tolist()
+    start_time = int(df_fights['startTime'].min())
+    end_time = int(df_fights['endTime'].max())
+    week = pd.Timestamp(report_metadata['startTime'] + start_time, unit='ms', tz='UTC').strftime('%G-W%V')
+
+    writer = DatasetWriter(os.path.join(path, f"fightWeek={week}"), partition_by=(), schema=EVENT_SCHEMA)
+    try:
+        for data_type in data_types:
+            for events in iter_event_pages(client, code, fight_ids, data_type, start_time, end_time):
+                if events:
+                    writer.write_batch(events_to_batch(code, events))
+        writer.close()
+    except Exception:
+        # The temporary files are removed, so a report that fails (and every retry) never leaves files behind.
+        writer.abort()
+        raise
+    return writer.number_of_rows
+
+def fetch_events(client: WarcraftLogsClient, codes: list, timelines: TimelineStore, data_types: tuple = EVENT_DATA_TYPES,
+                 max_workers: int = MAX_WORKERS, path: str = TIMELINE_DATA_DIR) -> int:
+    """
+    Fetches the events for the reports with max_workers reports at the same time.
+    Reports that already are in the timeline dataset are skipped, and reports that fail are logged and skipped.
+
+    Args:
+        client (WarcraftLogsClient): The client for making the API calls.
+        codes (list): The report codes.
+        timelines (TimelineStore): The store with the reports that are in the timeline dataset.
+        data_types (tuple): The types of events, see EVENT_DATA_TYPES.
+        max_workers (int): Max number of reports fetched at the same time.
+        path (str): Path to the timeline dataset.
+
+    Returns:
+        event_count (int): Number of events that were written.
+    """
+    codes = [code for code in codes if code not in timelines]
+    print(f"Fetching the events for {len(codes)} reports...")
+    event_count = 0
+    with metrics.stage('events'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_report_events, client, code, data_types, path): code for code in codes}
+        for future in as_completed(futures):
+            code = futures[future]
+            try:
+                report_events = future.result()
+            except Exception as e:
+                log_error(code, e)
+                continue
+            timelines.add(code, report_events, data_types)
+            metrics.count('events_written', report_events)
+            event_count += report_events
+            logger.info(f"Wrote {report_events} events for report '{code}'")
+    print(f"Wrote {event_count} events to the '{path}' dataset.")
+    return event_count
+
+def read_timeline(report_code: str, fight_id: int = None, columns: list = None, path: str = TIMELINE_DATA_DIR) -> pd.DataFrame:
+    """
+    Reads the events for a report (or one fight in it) from the timeline dataset, sorted by time.
+
+    Args:
+        report_code (str): The report code.
+        fight_id (int): Only the events in this fight, all the fights if None.
+        columns (list): The columns to read, all if None.
+        path (str): Path to the timeline dataset.
+
+    Returns:
+        df (pd.DataFrame): One row for every event.
+    """
+    dataset = ds.dataset(path, format='parquet', partitioning='hive', schema=pa.unify_schemas([EVENT_SCHEMA, pa.schema([('fightWeek', pa.string())])]))
+    filter = ds.field('reportCode') == report_code
+    if fight_id is not None:
+        filter = filter & (ds.field('fightID') == fight_id)
+    table = dataset.to_table(columns=columns, filter=filter)
+    if 'timestamp' in table.column_names:
+        table = table.sort_by('timestamp')
+    return table.to_pandas()
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """
+    Reads the command line arguments.
+
+    Args:
+        argv (list): The arguments, uses sys.argv if None.
+
+    Returns:
+        args (argparse.Namespace): The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Collects data from the warcraftlogs API to a parquet dataset.")
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'compact', 'aggregate', 'backfill', 'events', 'reprocess'],
+                        help="'run' gets the new reports (default), 'compact' merges the small files in the dataset, "
+                             "'aggregate' makes the summary tables again from the whole dataset, "
+                             "'backfill' gets all the reports since --since, "
+                             "'events' gets the events for the processed reports to the timeline dataset, "
+                             "'reprocess' makes the dataset again from the response cache.")
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS,
+                        help=f"Max number of reports fetched at the same time (default {MAX_WORKERS}).")
+    parser.add_argument('--keep-duplicates', action='store_true',
+                        help="Don't skip fights that are the same as a fight in another report.")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Don't read the response cache, get everything from the API again.")
+    parser.add_argument('--cache-max-mb', type=float, default=RESPONSE_CACHE_MAX_MB,
+                        help=f"Max size of the response cache in megabytes (default {RESPONSE_CACHE_MAX_MB}).")
+    parser.add_argument('--discovery-config', default=DISCOVERY_CONFIG_FILE,
+                        help=f"JSON file with the users, guilds and zones to get reports from (default {DISCOVERY_CONFIG_FILE}).")
+    parser.add_argument('--partition-by', nargs='*', default=list(PARTITION_SCHEME), choices=PARTITION_KEYS,
+                        help=f"The partition keys for the dataset folders (default {' '.join(PARTITION_SCHEME)}).")
+    parser.add_argument('--row-group-rows', type=int, default=COMPACT_ROW_GROUP_ROWS,
+                        help=f"Number of rows in each row group when compacting (default {COMPACT_ROW_GROUP_ROWS}).")
+    parser.add_argument('--ingest-row-group-rows', type=int, default=INGEST_ROW_GROUP_ROWS,
+                        help=f"Number of rows in each row group when new data is appended (default {INGEST_ROW_GROUP_ROWS}).")
+    parser.add_argument('--max-file-rows', type=int, default=INGEST_MAX_FILE_ROWS,
+                        help=f"Max number of rows in a file when new data is appended (default {INGEST_MAX_FILE_ROWS}).")
+    parser.add_argument('--metrics-file', default=RUN_SUMMARY_FILE,
+                        help=f"JSON file for the summary of the run (timings and API-calls, default {RUN_SUMMARY_FILE}).")
+    parser.add_argument('--prometheus-file',
+                        help="Also save the summary in the Prometheus textfile format (example: /var/lib/node_exporter/wlog.prom).")
+    parser.add_argument('--since', help="Backfill: start of the date range (example: 2024-09-01).")
+    parser.add_argument('--until', help="Backfill: end of the date range (default now).")
+    parser.add_argument('--user-ids', type=int, nargs='*',
+                        help="Backfill: only these users (and --guild-ids) instead of the ones in the discovery config.")
+    parser.add_argument('--guild-ids', type=int, nargs='*',
+                        help="Backfill: only these guilds (and --user-ids) instead of the ones in the discovery config.")
+    parser.add_argument('--flush-reports', type=int, default=BACKFILL_FLUSH_REPORTS,
+                        help=f"Backfill: number of reports fetched before they are appended to the dataset (default {BACKFILL_FLUSH_REPORTS}).")
+    parser.add_argument('--budget-share', type=float, default=BACKFILL_BUDGET_SHARE,
+                        help=f"Backfill: part of the hourly API budget the backfill may use (default {BACKFILL_BUDGET_SHARE}).")
+    parser.add_argument('--processes', type=int,
+                        help="Reprocess: number of worker processes (default the number of cores).")
+    parser.add_argument('--report-codes', nargs='*',
+                        help="Events: only these reports instead of all the processed reports.")
+    parser.add_argument('--event-types', nargs='*', default=list(EVENT_DATA_TYPES),
+                        help=f"Events: the types of events to fetch (default {' '.join(EVENT_DATA_TYPES)}).")
+    args = parser.parse_args(argv)
+    if args.command == 'backfill' and args.since is None:
+        parser.error("backfill needs --since")
+    return args
+
 # Main script
-def main():
-     
+def main(argv=None):
+
+    args = parse_args(argv)
+    metrics.reset(args.command)
+
+    # A dataset swap that was stopped by a crash is finished before anything reads the dataset.
+    recover_dataset(PROCESSED_DATA_DIR)
+
+    # Compacting, aggregating and reprocessing only work on the files we have, they don't need the API.
+    if args.command == 'compact':
+        with metrics.stage('compaction'):
+            compact_dataset(PROCESSED_DATA_DIR, args.partition_by, args.row_group_rows)
+        log_run_summary(metrics.write(args.metrics_file, args.prometheus_file))
+        return
+    if args.command == 'aggregate':
+        rebuild_aggregates(AGGREGATES_DIR, PROCESSED_DATA_DIR)
+        log_run_summary(metrics.write(args.metrics_file, args.prometheus_file))
+        return
+    if args.command == 'reprocess':
+        old_codes = ProcessedReportsStore(STATE_DB, CACHE_FILE)
+        dimensions = DimensionStore(STATE_DB)
+        snapshots = ReportSnapshotStore(STATE_DB)
+        fingerprints = FightFingerprintIndex(STATE_DB)
+        reprocess_dataset(old_codes, dimensions, RESPONSE_CACHE_FILE, PROCESSED_DATA_DIR, args.partition_by, args.processes,
+                          args.ingest_row_group_rows, args.max_file_rows, snapshots, fingerprints)
+        fingerprints.close()
+        snapshots.close()
+        dimensions.close()
+        old_codes.close()
+        log_run_summary(metrics.write(args.metrics_file, args.prometheus_file))
+        return
+
     logger.info("Starting the script")
 
-    # Reads the token for making API calls
-    token = read_token()
-    if not token:
-        print("No token found, fetching new one...")
-        client_id = os.getenv('CLIENT_ID')
-        client_secret = os.getenv('CLIENT_SECRET')
-        response = get_new_token(client_id, client_secret)
-        token = response.json().get("WARCRAFTLOGS_TOKEN")
-        
-    logger.info("Autherization complete")
+    # Creates the client for making API calls, reads the token or fetches a new one.
+    # Responses for reports are saved in the response cache, so a rerun doesn't need to ask the API again.
+    cache = ResponseCache(RESPONSE_CACHE_FILE, max_mb=args.cache_max_mb, refresh=args.refresh)
+    client = WarcraftLogsClient.from_env(pool_size=args.max_workers, cache=cache)
 
-    # Load cached reportcodes
-    old_codes = load_cache_codes()
+    # A backfill spreads its calls evenly over the hour and leaves a part of the budget for the normal runs.
+    if args.command == 'backfill':
+        client.rate_limiter = RateLimiter(margin=1 - args.budget_share, burst=1.0)
 
-    if token:
-        try:
-            # Load new codes (function not done yet, manually add)
-            list_of_codes = get_report_codes(token)
+    # The journal keeps track of the finished reports and fights, so a crashed run can continue where it stopped.
+    journal = CheckpointJournal(STATE_DB)
 
-            # Remove codes that were present in the cache
-            weekly_codes = check_codes(list_of_codes, old_codes)
+    # Fingerprints of all the fights processed so far, used for skipping the same fight uploaded in another report.
+    fingerprints = None if args.keep_duplicates else FightFingerprintIndex(STATE_DB)
 
-            # Counter for printing the progress of the report codes. 
-            counter_1 = 1
+    logger.info("Autherization complete")
 
-            # Start going through the report-codes from the list. 
-            for code in weekly_codes:
+    # Load the processed reportcodes
+    old_codes = ProcessedReportsStore(STATE_DB, CACHE_FILE)
 
-                #Used for printing the progress.
-                number_of_codes = len(weekly_codes)
-                
-                # Creates a JSON file in the short storages folder, will be removed if program runs successfully.
-                file_path = os.path.join(RAW_DATA_DIR, f"{code}.json")
-                if os.path.exists(file_path):
-                        print(f"JSON file for '{code}' already exists. Skipping API call.")
-                        continue
+    # The end time and fights of every report when it was fetched, for finding reports that were still being logged.
+    snapshots = ReportSnapshotStore(STATE_DB)
+
+    if client.token:
+        code = None
+        run_error = None
+
+        # Check how much of the rate limit budget is left before we start.
+        rate_limit_data = get_rate_limit(client)
+        if rate_limit_data:
+            logger.info(f"Rate limit: {rate_limit_data['pointsSpentThisHour']} of {rate_limit_data['limitPerHour']} points spent this hour, "
+                        f"reset in {rate_limit_data['pointsResetIn']} seconds")
+
+        try:
+            if args.command == 'backfill':
+                # All the reports in the date range are fetched in batches, see backfill().
+                config = load_discovery_config(args.discovery_config)
+                if args.user_ids is not None or args.guild_ids is not None:
+                    config.update(user_ids=args.user_ids or [], guild_ids=args.guild_ids or [])
+                queue = BackfillQueue(STATE_DB)
+                backfill(client, queue, journal, fingerprints, old_codes, config, args.since, args.until,
+                         args.max_workers, args.flush_reports, args.partition_by, args.ingest_row_group_rows,
+                         args.max_file_rows, snapshots)
+                queue.close()
+            elif args.command == 'events':
+                # The events for the reports that are processed, written to the timeline dataset.
+                timelines = TimelineStore(STATE_DB)
+                codes = args.report_codes if args.report_codes else sorted(old_codes.done_codes)
+                fetch_events(client, codes, timelines, tuple(args.event_types), args.max_workers, TIMELINE_DATA_DIR)
+                timelines.close()
+            else:
+                # Load new codes for the users and guilds in the discovery config
+                reports = discover_reports(client, load_discovery_config(args.discovery_config), max_workers=args.max_workers)
+                list_of_codes = set(reports)
+
+                # Reports that failed or were stopped by a crash in an earlier run are tried again.
+                for code in journal.unfinished_reports():
+                    if code not in list_of_codes:
+                        logger.info(f"Retrying unfinished report '{code}' from an earlier run")
+                        list_of_codes.add(code)
+
+                # Remove codes that were present in the cache
+                weekly_codes = check_codes(list_of_codes, old_codes)
+
+                # Processed reports that got longer since they were fetched (live logging), only their new fights are fetched.
+                changed_codes = snapshots.changed_reports(reports, old_codes)
+                if changed_codes:
+                    print(f"{len(changed_codes)} reports got longer since they were fetched, getting the new fights.")
+                    logger.info(f"Reports that got longer since they were fetched: {changed_codes}")
+
+                # Each report is saved to its own Arrow file in the short storage folder, which will be removed if program runs successfully.
+                fetch_reports(client, weekly_codes + changed_codes, journal, fingerprints, old_codes, args.max_workers, snapshots)
 
-                # Get the name, id and gameID for characters in the report.
-                gameID = get_gameID(token, code)
-
-                #Get the starting time of the report.
-                unix_report_start = get_report_start(token, code)
-
-                #Get fightID for diffrent runs and then create a dict with fightID as key and playerID's for that fightID as values.
-                df_fightID = get_fightID(token, code)
-                df_fightID = clean_fightID_df(df_fightID)
-                fightID_dict = dict(zip(df_fightID['id'], df_fightID['friendlyPlayers']))
-                
-                
-                # Create empty list of dataframes and a empty dataframe used in the fight's loop.
-                list_of_dataframes = []
-                df_weekly = pd.DataFrame()
-
-                # Used for printing the progress with the fights
-                counter_2 = 1
-
-                # Start going through each fight in the report (reminder: a fight equals a whole dungeon-run)
-                for key in fightID_dict:
-                    
-                    # Used for printing the progress of the fights.
-                    number_of_fights = len(fightID_dict)
-
-                    # Get the start time of the fight
-                    start_time_fight = convert_time(get_fight_start(token, code, key, unix_report_start))
-
-                    # Get the player names and ids for the specific run.
-                    df_name_id = gameID[gameID['id'].isin(fightID_dict[key])]
-
-                    # Get healing and damage for the players in the run.
-                    df_dmg_healing = get_damage_and_healing(token, code, key)
-
-                    # Get a list of all deaths for the run. Sum them up and merge with the name_id dataframe.
-                    # Players with no deaths will be missing in death_counts, so fillna(0) is used to set the number to 0 instead of NaN.
-                    df_deaths = get_deaths(token, code, key)
-                    df_name_id_deaths = make_name_id_death_df(df_deaths, df_name_id)
-
-                    #Merge the two dataframes on name.
-                    df_complete = pd.merge(df_name_id_deaths, df_dmg_healing, how='outer', on='name')
-
-                    # Add the dungon name and starttime to the dataframe
-                    dungeon_name = get_dungeon_name(key, df_fightID)
-                    df_complete['DungeonName'] = dungeon_name
-                    df_complete['StartTime'] = start_time_fight
-
-                    # Add the dataframe to a list for future merge
-                    list_of_dataframes.append(df_complete)
-                    
-                    logger.info(f"Done with fight {counter_2} of {number_of_fights}")
-                    counter_2 = counter_2 + 1
-
-                # Merge the dataframes from the report to one single dataframe
-                df_weekly = pd.concat(list_of_dataframes, ignore_index = True)  
-                df_weekly['reportCode'] = code
-                old_codes.append(code)
-                save_weekly_data(code, df_weekly)
-                
-                logger.info(f"Done with code {counter_1} of {number_of_codes}")
-                counter_1 = counter_1 + 1
-        
         except Exception as e:
             # If an error occurs, this block will execute
-            error_message = f"Error processing code '{code}': {e}\n"
-            error_details = traceback.format_exc()
-            
-            # Get the current timestamp
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-            # Save the error to a separate file.
-            # 'a' stands for 'append' so you don't overwrite previous errors.
-            with open("error_log.txt", "a") as error_file:
-                error_file.write(f"--- Timestamp: {timestamp} ---\n")
-                error_file.write(error_message)
-                error_file.write(error_details)
-                error_file.write("-" * 50 + "\n\n")
-
-            print(f"An error occurred for code '{code}'. The details have been saved to error_log.txt. Continuing to the next code...")
+            log_error(code, e)
+            run_error = e
         
-        # Saves the codes to the cache file    
-        save_cache_codes(old_codes)
+        if client.rate_limiter.points_spent is not None:
+            logger.info(f"Rate limit: {client.rate_limiter.points_total:.1f} points used during this run, "
+                        f"{client.rate_limiter.points_spent} of {client.rate_limiter.limit_per_hour} points spent this hour")
 
         # Appends the data to the parquet dataset.
-        append_weekly_data_to_dataset()
-
+        new_files = append_weekly_data_to_dataset(args.partition_by, args.ingest_row_group_rows, args.max_file_rows)
+
+        # Adds the new data to the summary tables for every player, dungeon and week.
+        if new_files:
+            update_aggregates(new_files, AGGREGATES_DIR, PROCESSED_DATA_DIR)
+
+        logger.info(f"Response cache: {cache.hits} hits, {cache.misses} misses")
+        client.close()
+        cache.close()
+        journal.close()
+        if fingerprints is not None:
+            fingerprints.close()
+        snapshots.close()
+        old_codes.close()
+
+        # Save the timings and API-calls for the run.
+        log_run_summary(metrics.write(args.metrics_file, args.prometheus_file))
+
+        # The data that was fetched before the error is saved, but the run doesn't count as a success.
+        if run_error is not None:
+            print(f"Program stopped with an error: {run_error}")
+            sys.exit(1)
         print("Program ran successfully")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,246 @@
+# The schema for the parquet dataset.
+# DATASET_SCHEMA has the columns you get when the dataset is read. Since version 3 the files are saved with
+# FACT_SCHEMA: the players, dungeons and reports are replaced by int32 keys to the dimension tables in
+# warcraftlogs_get_data.py, and the names are joined back when the data is read. The version is saved in the
+# metadata of the file. Files from older versions are converted with conform_table() when they are read,
+# and are rewritten with FACT_SCHEMA when the dataset is compacted (compact_dataset() in warcraftlogs_get_data.py).
+
+import os
+
+import dateutil.tz
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import pandas as pd
+
+# Change the version every time DATASET_SCHEMA or FACT_SCHEMA is changed.
+SCHEMA_VERSION = 3
+SCHEMA_VERSION_KEY = b'wlog_schema_version'
+
+# Columns with few diffrent values are dictionary-encoded, the strings are then only stored once per file.
+CATEGORY_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+DATASET_SCHEMA = pa.schema([
+    ('name', CATEGORY_TYPE),
+    ('gameID', pa.int64()),
+    ('id', pa.int32()),
+    ('deaths', pa.int32()),
+    ('class', CATEGORY_TYPE),
+    ('ilvl', pa.float64()),
+    ('Dps', pa.float64()),
+    ('Healing', pa.float64()),
+    ('DungeonName', CATEGORY_TYPE),
+    ('StartTime', pa.timestamp('ms', tz='UTC')),
+    ('reportCode', CATEGORY_TYPE),
+    # Added in version 2, null for older rows.
+    ('keystoneLevel', pa.int32()),
+    ('Duration', pa.float64()),
+    ('DamagePerSecond', pa.float64()),
+    ('HealingPerSecond', pa.float64()),
+    # Added in version 3, null for older rows.
+    ('zoneID', pa.int32()),
+])
+
+# The columns in the files since version 3. Every key column replaces the columns in DIMENSION_COLUMNS.
+FACT_SCHEMA = pa.schema([
+    ('playerKey', pa.int32()),
+    ('dungeonKey', pa.int32()),
+    ('reportKey', pa.int32()),
+    ('id', pa.int32()),
+    ('deaths', pa.int32()),
+    ('ilvl', pa.float64()),
+    ('Dps', pa.float64()),
+    ('Healing', pa.float64()),
+    ('StartTime', pa.timestamp('ms', tz='UTC')),
+    ('keystoneLevel', pa.int32()),
+    ('Duration', pa.float64()),
+    ('DamagePerSecond', pa.float64()),
+    ('HealingPerSecond', pa.float64()),
+], metadata={SCHEMA_VERSION_KEY: str(SCHEMA_VERSION).encode()})
+
+# The first version that was saved with FACT_SCHEMA.
+FACT_SCHEMA_VERSION = 3
+
+DIMENSION_COLUMNS = {'playerKey': ('name', 'gameID', 'class'),
+                     'dungeonKey': ('DungeonName', 'zoneID'),
+                     'reportKey': ('reportCode',)}
+
+# The index for looking up players and reports: every row says that a row group in a file has rows with the key.
+# The files the index is for are saved in the metadata, as a JSON list.
+KEY_INDEX_SCHEMA = pa.schema([
+    ('column', CATEGORY_TYPE),
+    ('key', pa.int32()),
+    ('file', CATEGORY_TYPE),
+    ('rowGroup', pa.int32()),
+])
+KEY_INDEX_FILES_KEY = b'wlog_indexed_files'
+
+# The schema for the event timelines (a separate dataset with one row for every event).
+# The times are milliseconds from the start of the report and the actors and abilities are the ids from the API,
+# so every event only takes a few bytes.
+EVENT_SCHEMA_VERSION = 1
+
+EVENT_SCHEMA = pa.schema([
+    ('reportCode', CATEGORY_TYPE),
+    ('fightID', pa.int32()),
+    ('timestamp', pa.int64()),
+    ('type', CATEGORY_TYPE),
+    ('sourceID', pa.int32()),
+    ('targetID', pa.int32()),
+    ('abilityGameID', pa.int32()),
+    ('amount', pa.int64()),
+    ('absorbed', pa.int64()),
+    ('overheal', pa.int64()),
+    ('hitType', pa.int8()),
+], metadata={SCHEMA_VERSION_KEY: str(EVENT_SCHEMA_VERSION).encode()})
+
+# Older versions saved StartTime as a string in the local time of the computer that ran the program.
+LEGACY_TIMEZONE = dateutil.tz.tzlocal()
+
+def schema_version(schema: pa.Schema) -> int:
+    """
+    Gets the schema version saved in the metadata of a schema.
+
+    Args:
+        schema (pa.Schema): The schema of a file or table.
+
+    Returns:
+        version (int): The version, 0 if the schema is from before the versions were added.
+    """
+    metadata = schema.metadata or {}
+    return int(metadata.get(SCHEMA_VERSION_KEY, b'0'))
+
+def conform_column(column: pa.ChunkedArray, field: pa.Field) -> pa.ChunkedArray:
+    """
+    Converts a column to the type of a field in the schema.
+
+    Args:
+        column (pa.ChunkedArray): The column to convert.
+        field (pa.Field): The field with the type we want.
+
+    Returns:
+        column (pa.ChunkedArray): The converted column.
+    """
+    if column.type == field.type:
+        return column
+
+    if pa.types.is_timestamp(field.type) and pa.types.is_string(column.type):
+        # Old StartTime strings, like '2025-09-02T20:25:40.573' in local time.
+        times = pd.to_datetime(column.to_pandas(), format='ISO8601')
+        times = times.dt.tz_localize(LEGACY_TIMEZONE, ambiguous='NaT', nonexistent='NaT').dt.tz_convert('UTC')
+        return pa.chunked_array([pa.array(times, type=field.type)])
+
+    if pa.types.is_timestamp(field.type) and pa.types.is_timestamp(column.type) and column.type.tz is None:
+        column = pc.assume_timezone(column, 'UTC')
+
+    if pa.types.is_dictionary(field.type):
+        return pc.dictionary_encode(column.cast(field.type.value_type)).cast(field.type)
+
+    return column.cast(field.type)
+
+def conform_table(table: pa.Table, schema: pa.Schema = DATASET_SCHEMA) -> pa.Table:
+    """
+    Converts a table to the schema, so tables from diffrent versions can be combined.
+    Columns that are missing are filled with nulls and columns that aren't in the schema are removed.
+
+    Args:
+        table (pa.Table): The table to convert.
+        schema (pa.Schema): The schema to convert to.
+
+    Returns:
+        table (pa.Table): The table with the columns and types of the schema.
+    """
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(conform_column(table.column(field.name), field))
+        else:
+            columns.append(pa.nulls(table.num_rows, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+def read_dataset_file(fragment: ds.ParquetFileFragment, columns: list = None, decode=None) -> pa.Table:
+    """
+    Reads one file in the dataset and converts it to DATASET_SCHEMA.
+    The partition columns (example: runDate) are added from the folder names.
+
+    Args:
+        fragment (ds.ParquetFileFragment): The file.
+        columns (list): The columns to read, all if None.
+        decode (callable): Joins the names back to a table with FACT_SCHEMA, needed for files from version 3 or newer.
+
+    Returns:
+        table (pa.Table): The data in the file.
+    """
+    schema = DATASET_SCHEMA
+    if columns is not None:
+        schema = pa.schema([field for field in DATASET_SCHEMA if field.name in columns])
+
+    if schema_version(fragment.physical_schema) >= FACT_SCHEMA_VERSION:
+        if decode is None:
+            raise ValueError(f"'{fragment.path}' has keys instead of names, the dimension tables are needed to read it")
+        table = conform_table(decode(pq.read_table(fragment.path)), schema)
+    else:
+        file_columns = [name for name in schema.names if name in fragment.physical_schema.names]
+        table = conform_table(pq.read_table(fragment.path, columns=file_columns), schema)
+
+    for key, value in ds.get_partition_keys(fragment.partition_expression).items():
+        if columns is None or key in columns:
+            table = table.append_column(key, pa.array([str(value)] * table.num_rows, type=pa.string()))
+    return table
+
+def read_dataset(path: str, columns: list = None, decode=None) -> pa.Table:
+    """
+    Reads the whole dataset, every file is converted to DATASET_SCHEMA so files from
+    diffrent versions can be read together.
+
+    Args:
+        path (str): Path to the dataset folder.
+        columns (list): The columns to read, all if None.
+        decode (callable): Joins the names back to a table with FACT_SCHEMA, see read_dataset_file().
+
+    Returns:
+        table (pa.Table): The data in the dataset.
+    """
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    tables = [read_dataset_file(fragment, columns, decode) for fragment in dataset.get_fragments()]
+    if not tables:
+        return DATASET_SCHEMA.empty_table()
+    return pa.concat_tables(tables, promote_options='permissive').unify_dictionaries()
+
+def open_dataset(path: str, known_files: set = None) -> tuple:
+    """
+    Opens the dataset for lazy scanning with FACT_SCHEMA.
+
+    Files written with FACT_SCHEMA (version 3 or newer) can be scanned together, columns that are missing in
+    a file are read as nulls. Files from older versions have the names instead of the keys, so they are
+    returned separately and have to be read with read_dataset_file().
+
+    Args:
+        path (str): Path to the dataset folder.
+        known_files (set): Files that are known to use FACT_SCHEMA (example: the files in the key index), from the
+                           dataset folder. The version of these files isn't read, which saves opening every file.
+
+    Returns:
+        dataset (ds.Dataset or None): The dataset with the files that can be scanned, None if there are none.
+        legacy_fragments (list): The files from before version 3.
+    """
+    discovered = ds.dataset(path, format='parquet', partitioning='hive')
+    current_paths = []
+    legacy_fragments = []
+    for fragment in discovered.get_fragments():
+        if known_files and os.path.relpath(fragment.path, path).replace(os.sep, '/') in known_files:
+            current_paths.append(fragment.path)
+        elif schema_version(fragment.physical_schema) < FACT_SCHEMA_VERSION:
+            legacy_fragments.append(fragment)
+        else:
+            current_paths.append(fragment.path)
+
+    if not current_paths:
+        return None, legacy_fragments
+
+    schema = pa.unify_schemas([FACT_SCHEMA, discovered.partitioning.schema])
+    dataset = ds.dataset(current_paths, schema=schema, format='parquet',
+                         partitioning=discovered.partitioning, partition_base_dir=path)
+    return dataset, legacy_fragments